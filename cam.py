@@ -10,34 +10,61 @@ with warnings.catch_warnings():
     warnings.filterwarnings("ignore", category=SyntaxWarning)
     import gerber
 try:
-    from shapely import Point, MultiPoint, LineString, LinearRing, box, Polygon
+    from shapely import Point, MultiPoint, LineString, LinearRing, box, Polygon, unary_union, STRtree
 except ImportError:
     from shapely.geometry import Point, MultiPoint, LineString, LinearRing, box, Polygon
-from matplotlib.patches import Ellipse
+    from shapely.ops import unary_union
+    from shapely.strtree import STRtree
 from copy import deepcopy
-import turtle
-import random
+from collections import OrderedDict
+from typing import Optional, Callable
 import math
+import time
 import numpy as np
-from scipy.interpolate import interp2d
-import tkinter as tk
+import shapely
+
+# NOTE: turtle, tkinter, random, matplotlib and scipy are imported lazily inside the functions that need them
+#       so importing this module stays fast and works on headless machines (no display, no GUI toolkits)
 
 # Screen Dimensions
+HEADLESS_DEVICE_W_H = (1920, 1080)  # fallback when no display is available
 def get_screen_width_height() -> tuple[int, int]:
     '''
     using tkinter to get the current display height and width
     '''
-    root = tk.Tk()
+    import tkinter as tk
+
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        # headless machine, no display to query
+        return HEADLESS_DEVICE_W_H
+
     screen_width = root.winfo_screenwidth()
     screen_height = root.winfo_screenheight()
     root.destroy()
 
     return (screen_width, screen_height)
-DEVICE_W, DEVICE_H = get_screen_width_height()
+
+_device_w_h = None
+def get_device_w_h() -> tuple[int, int]:
+    '''
+    returns the display dimensions, only queries the display the first time it's needed (visualization)
+    '''
+    global _device_w_h
+    if _device_w_h is None:
+        _device_w_h = get_screen_width_height()
+    return _device_w_h
+
 START_X = 0
 START_Y = 0
 
 DEFAULT_RESOLUTION = 5
+DEFAULT_CHORD_TOLERANCE = 0.005  # mm, maximum distance between a true arc or circle and the straight segments approximating it
+FLASH_TEMPLATE_CACHE_SIZE = 256  # maximum number of different aperture shapes kept in memory
+SERPENTINE_POINT_COUNT = 50000  # above this many holes the nearest neighbour and 2-opt ordering is replaced by a serpentine order
+NUMPY_NEIGHBOUR_POINT_COUNT = 5000  # up to this many points the nearest ones are searched with numpy, above with scipy's KD-tree (slow to import)
+MIRRORED_ARC_FUNCTIONS = {'G02': 'G03', 'G2': 'G3', 'G03': 'G02', 'G3': 'G2'}  # clockwise <-> counter clockwise
 
 ############# Adding features to imported classes #############
 
@@ -57,7 +84,166 @@ def point_getitem(self, index) -> float:
 
 Point.__getitem__ = point_getitem
 
-# 2: adding x-offset and y-offset to gerber class
+# 2: adding affine transformations (recenter, mirror and rotate in one pass) to gerber class
+def get_transform_matrix(mirrored: bool = False, rotation: float = 0) -> np.ndarray:
+    '''
+    builds the 2x2 matrix that mirrors (x = -x) then rotates counter clockwise around the origin
+
+    quarter turns use exact sines and cosines so the coordinates don't pick up floating point noise
+
+    :param mirrored: mirror the x coordinates (for DIP components)
+    :param rotation: counter clockwise rotation in degrees
+    '''
+    quarter_turns = rotation / 90
+    if quarter_turns == round(quarter_turns):
+        cos_theta, sin_theta = ((1, 0), (0, 1), (-1, 0), (0, -1))[int(quarter_turns) % 4]
+    else:
+        cos_theta, sin_theta = math.cos(math.radians(rotation)), math.sin(math.radians(rotation))
+
+    matrix = np.array([[cos_theta, -sin_theta], [sin_theta, cos_theta]], dtype=float)
+    if mirrored:
+        matrix[:, 0] *= -1
+
+    return matrix
+
+def transform_primitive(primitive: gerber.primitives.Primitive, matrix: list[list[float]], slots: list[tuple], coords: list[tuple]) -> None:
+    '''
+    applies the orientation part of the transformation to the primitive (and its sub primitives) right away:
+    arc direction, rotation, width and height.
+    The coordinates are only gathered, coords gets every absolute coordinate and slots where to write it back as (object, attribute)
+
+    :param primitive: the gerber primitive
+    :param matrix: 2x2 transformation matrix from get_transform_matrix() as nested lists (plain floats are much faster for single points)
+    '''
+    primitive_type = type(primitive)
+
+    if primitive_type == gerber.primitives.Line:
+        attributes = ('start', 'end')
+
+    elif primitive_type == gerber.primitives.Arc:
+        attributes = ('start', 'end', 'center')
+
+        # mirroring reverses the direction of arcs
+        if matrix[0][0]*matrix[1][1] - matrix[0][1]*matrix[1][0] < 0:
+            primitive.direction = 'clockwise' if primitive.direction == 'counterclockwise' else 'counterclockwise'
+
+    elif hasattr(primitive, 'position'):
+        attributes = ('position',)
+
+        has_width_height = hasattr(primitive, 'width') and hasattr(primitive, 'height')
+        if has_width_height or primitive_type == gerber.primitives.Polygon:
+            # the new rotation is the angle of the transformed direction of the old one
+            cos_theta, sin_theta = math.cos(math.radians(primitive.rotation)), math.sin(math.radians(primitive.rotation))
+            direction_x = matrix[0][0]*cos_theta + matrix[0][1]*sin_theta
+            direction_y = matrix[1][0]*cos_theta + matrix[1][1]*sin_theta
+            new_rotation = round(math.degrees(math.atan2(direction_y, direction_x)), 9) % 360
+
+            # rectangles and obrounds turned a multiple of 90 degrees stay axis aligned
+            if has_width_height and new_rotation % 90 == 0:
+                if new_rotation % 180 != 0:
+                    primitive.width, primitive.height = primitive.height, primitive.width
+                new_rotation = 0
+
+            primitive.rotation = new_rotation
+
+    else:
+        attributes = ()
+
+    for attribute in attributes:
+        slots.append((primitive, attribute))
+        coords.append(getattr(primitive, attribute)[:2])
+
+    # Region, Outline and AMGroup objects hold their shape in sub primitives with absolute coordinates
+    # NOTE: the AMGroup position is written back before its sub primitives as its setter moves them too
+    for sub_primitive in getattr(primitive, 'primitives', ()):
+        transform_primitive(sub_primitive, matrix, slots, coords)
+
+def gerber_transform(self, matrix: Optional[np.ndarray] = None, x_offset: Optional[float] = None, y_offset: Optional[float] = None) -> None:
+    '''
+    Applies a linear transformation (mirror and/or rotation, see get_transform_matrix()) then recenters the whole gerber file,
+    all in one pass over .statements and .primitives
+
+    Procedure:
+    Step-1: gather every statement and primitive coordinate into arrays
+    Step-2: multiply them all by the matrix
+    Step-3: translate so the bounds minimum is (x_offset, y_offset), bounds measured once from the transformed statement coordinates
+    Step-4: write everything back
+    Done :D
+
+    :param matrix: 2x2 transformation matrix, None for identity (recenter only)
+    :param x_offset: wanted x offset from origin. if 0 then pcb will start at 0, None keeps the current x minimum
+    :param y_offset: wanted y offset from origin. if 0 then pcb will start at 0, None keeps the current y minimum
+    '''
+    if matrix is None:
+        matrix = np.identity(2)
+
+    ### Step 1: gathering coordinates
+    # Step 1a: the .statements, the .bounds property depends on them
+    # coordinates left out of a statement are modal (same as the previous one), they are filled in as a rotation mixes x and y
+    coord_stmts, stmt_coords = [], []
+    arc_stmts, stmt_arc_offsets = [], []
+    rect_aperture_stmts = []
+    x, y = 0, 0
+    is_mirrored = np.linalg.det(matrix) < 0
+    for stmt in self.statements:
+        if type(stmt) == gerber.gerber_statements.CoordStmt:
+            # mirroring reverses the direction of arcs
+            if is_mirrored and stmt.function in MIRRORED_ARC_FUNCTIONS:
+                stmt.function = MIRRORED_ARC_FUNCTIONS[stmt.function]
+
+            if stmt.x is not None or stmt.y is not None:
+                x = stmt.x if stmt.x is not None else x
+                y = stmt.y if stmt.y is not None else y
+                coord_stmts.append(stmt)
+                stmt_coords.append((x, y))
+
+            # I and J are relative to the start point so they only need the linear part
+            if stmt.i is not None or stmt.j is not None:
+                arc_stmts.append(stmt)
+                stmt_arc_offsets.append((stmt.i or 0, stmt.j or 0))
+
+        elif type(stmt) == gerber.gerber_statements.ADParamStmt and stmt.shape in ('R', 'O'):
+            rect_aperture_stmts.append(stmt)
+
+    # Step 1b: the .primitives
+    slots, primitive_coords = [], []
+    matrix_list = matrix.tolist()
+    for primitive in self.primitives:
+        transform_primitive(primitive, matrix_list, slots, primitive_coords)
+
+    ### Step 2: applying the matrix
+    stmt_coords = np.array(stmt_coords, dtype=float).reshape(-1, 2)
+    old_min = stmt_coords.min(axis=0) if len(stmt_coords) else np.zeros(2)
+    stmt_coords = stmt_coords @ matrix.T
+    stmt_arc_offsets = np.array(stmt_arc_offsets, dtype=float).reshape(-1, 2) @ matrix.T
+    primitive_coords = np.array(primitive_coords, dtype=float).reshape(-1, 2) @ matrix.T
+
+    ### Step 3: translating
+    new_min = stmt_coords.min(axis=0) if len(stmt_coords) else np.zeros(2)
+    wanted_min = np.array([old_min[0] if x_offset is None else x_offset, old_min[1] if y_offset is None else y_offset], dtype=float)
+    translation = wanted_min - new_min
+    stmt_coords += translation
+    primitive_coords += translation
+
+    ### Step 4: writing back
+    for stmt, (x, y) in zip(coord_stmts, stmt_coords.tolist()):
+        stmt.x, stmt.y = x, y
+
+    for stmt, (i, j) in zip(arc_stmts, stmt_arc_offsets.tolist()):
+        stmt.i, stmt.j = i, j
+
+    for (primitive, attribute), coord in zip(slots, primitive_coords.tolist()):
+        setattr(primitive, attribute, tuple(coord))
+
+    # rectangular apertures turned 90 or 270 degrees swap width and height
+    if matrix[0][0] == 0:
+        for stmt in rect_aperture_stmts:
+            modifiers = tuple(stmt.modifiers[0])
+            stmt.modifiers[0] = (modifiers[1], modifiers[0], *modifiers[2:])
+
+gerber.rs274x.GerberFile.transform = gerber_transform
+
+# 3: keeping the single transformation methods
 def recenter_gerber_file(self, x_offset: int, y_offset: int) -> None:
     '''
     recenter the whole gerber file, self now contains the gerber file with recentered coordinates of everything
@@ -71,237 +257,438 @@ def recenter_gerber_file(self, x_offset: int, y_offset: int) -> None:
     :param x_offset: wanted x offset from origin. if 0 then pcb will start at 0
     :param y_offset: wanted y offset from origin. if 0 then pcb will start at 0
     '''
+    self.transform(x_offset=x_offset, y_offset=y_offset)
 
-    # Get X and Y, min and max
-    bounds = self.bounds
-    x_min = bounds[0][0]
-    x_max = bounds[0][1]
-    y_min = bounds[1][0]
-    y_max = bounds[1][1]
-
-    # Calculating the offset to be added to each coordinate in the gerber file
-    x_offset = -x_min + x_offset
-    y_offset = -y_min + y_offset
+gerber.rs274x.GerberFile.recenter_gerber_file = recenter_gerber_file
 
-    # Step 1a: Changing the statements attribute, the .bounds method is a property method depending on .statements
-    for stmt in self.statements:
-        stmt.offset(x_offset, y_offset)
+def gerber_mirror(self, x_y_axis: bool = True) -> None:
+    '''
+    Mirrors the gerber file (for DIP components), keeping it where it was
 
-    # Step 1b: Changing the primitive attribute
-    for primitive in self.primitives:
-        primitive.offset(x_offset, y_offset)
+    :param x_y_axis: determines whether to mirror in x or y axis, default is x-axis mirroring
+    '''
+    self.transform(get_transform_matrix(mirrored=True) if x_y_axis else get_transform_matrix(mirrored=True, rotation=180))
 
-gerber.rs274x.GerberFile.recenter_gerber_file = recenter_gerber_file
+gerber.rs274x.GerberFile.mirror = gerber_mirror
 
-# 3: adding mirror feature to gerber class
-def gerber_mirror(self, x_y_axis: bool = True) -> None:
+def gerber_rotate_90(self):
+    '''
+    Rotate the gerber file 90 degrees counter clockwise (for DIP components), keeping it where it was
     '''
-    Mirrors the gerber file (for DIP components)
+    self.transform(get_transform_matrix(rotation=90))
 
-    Procedure:
-    Step-1: x OR y coordinate is *-1 depending on whether we want to mirror in x or y axis
-    Step-2: recenter to (x_min, y_min) (which is measured before step 1!!) 
-    Done :D
+gerber.rs274x.GerberFile.rotate_90 = gerber_rotate_90
 
-    :param x_y_axis: determines whether to mirror in x or y axis, default is x-axis mirroring
+###############################################################
+
+
+class Toolpath:
     '''
-    # Get X and Y, min for step2
-    bounds = self.bounds
-    x_min = bounds[0][0]
-    y_min = bounds[1][0]
+    Compact array backed list of continuous tool paths (loops).
 
+    All the vertices of all loops are stored in one contiguous float64 (N, 3) array of X, Y, Z
+    and loop i is coords[offsets[i]:offsets[i+1]], so no per vertex python object is ever created.
+    Indexing or iterating returns (n, 3) numpy views of each loop.
+    '''
+    def __init__(self, coords: np.ndarray, offsets: np.ndarray):
+        '''
+        :param coords: (N, 3) float64 array of all vertices
+        :param offsets: (number of loops + 1) int array, start index of each loop followed by N
+        '''
+        self.coords = np.ascontiguousarray(coords, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.intp)
 
-    ### Step 1: *-1
-    # Step1a: *-1 the .statements, the .bounds method is a property method depending on .statements
-    for stmt in self.statements:
-        if hasattr(stmt, 'x') and hasattr(stmt, 'y'):
-            if type(stmt.x) in [int, float] and type(stmt.y) in [int, float]:
-                if x_y_axis:
-                    stmt.x = stmt.x*-1
-                else:
-                    stmt.y = stmt.y*-1
-        #TODO: does start and end angle of gerber.primitives.Arc need changing?!?!?
+    @classmethod
+    def from_loops(cls, loops: list[np.ndarray]) -> Toolpath:
+        '''
+        creates a Toolpath from a list of (n, 2) or (n, 3) coordinate arrays, missing Z values are set to 0
+        '''
+        offsets = np.zeros(len(loops)+1, dtype=np.intp)
+        np.cumsum([len(loop) for loop in loops], out=offsets[1:])
+        coords = np.zeros((offsets[-1], 3), dtype=np.float64)
+        for ind, loop in enumerate(loops):
+            loop = np.asarray(loop, dtype=np.float64)
+            coords[offsets[ind]:offsets[ind+1], :loop.shape[1]] = loop
 
-    # Step1b: *-1 the .primitives
-    for ind, primitive in enumerate(self.primitives):
+        return cls(coords, offsets)
 
-        if type(primitive) == gerber.primitives.Line:
-            if x_y_axis:
-                self.primitives[ind].start = (primitive.start[0]*-1, primitive.start[1])
-                self.primitives[ind].end = (primitive.end[0]*-1, primitive.end[1])
-            else:
-                self.primitives[ind].start = (primitive.start[0], primitive.start[1]*-1)
-                self.primitives[ind].end = (primitive.end[0], primitive.end[1]*-1)
+    @classmethod
+    def from_polygons(cls, polygons: list[Polygon], resolution: int = DEFAULT_RESOLUTION) -> Toolpath:
+        '''
+        creates a Toolpath of the exterior of every Polygon followed by the interiors of every Polygon
+        straight from the polygon coordinate arrays, X and Y rounded to resolution decimal places and Z set to 0
 
-        elif type(primitive) == gerber.primitives.Region:
-            for ind2, region_primitive in enumerate(primitive.primitives):
-                if type(region_primitive) == gerber.primitives.Line:
-                    if x_y_axis:
-                        self.primitives[ind].primitives[ind2].start = (region_primitive.start[0]*-1, region_primitive.start[1])
-                        self.primitives[ind].primitives[ind2].end = (region_primitive.end[0]*-1, region_primitive.end[1])
+        exteriors are made counter clockwise and interiors clockwise so the polygon is always on the left of the toolpath
 
-                    else:
-                        self.primitives[ind].primitives[ind2].start = (region_primitive.start[0], region_primitive.start[1]*-1)
-                        self.primitives[ind].primitives[ind2].end = (region_primitive.end[0], region_primitive.end[1]*-1)
+        :param polygons: list of shapely Polygons
+        :param resolution: the number of decimal places for coordinates
+        '''
+        rings = [polygon_.exterior for polygon_ in polygons]
+        rings.extend(interior for polygon_ in polygons for interior in polygon_.interiors)
+        if not rings:
+            return cls(np.zeros((0, 3)), np.zeros(1, dtype=np.intp))
 
-                else:
-                    # Assuming all primitives inside Region object is line
-                    raise NotImplementedError("I thought all primitives inside a Region object is Line primitives only")
+        xy, ring_inds = shapely.get_coordinates(rings, return_index=True)
+        offsets = np.zeros(len(rings)+1, dtype=np.intp)
+        np.cumsum(np.bincount(ring_inds, minlength=len(rings)), out=offsets[1:])
 
-        elif type(primitive) == gerber.primitives.Arc:
-            if x_y_axis:
-                # self.primitives[ind].center = (primitive.center[0]*-1, primitive.center[1])
-                primitive.offset(-primitive.center[0]+primitive.center[0]*-1, 0)
+        coords = np.zeros((len(xy), 3), dtype=np.float64)
+        coords[:, :2] = np.round(xy, resolution)
+        toolpath = cls(coords, offsets)
 
-            else:
-                # self.primitives[ind].center = (primitive.center[0], primitive.center[1]*-1)
-                primitive.offset(0, -primitive.center[1]+primitive.center[1]*-1)
+        is_exterior = np.arange(len(rings)) < len(polygons)
+        is_wrong_way = np.where(is_exterior, toolpath.signed_areas() < 0, toolpath.signed_areas() > 0)
+        if is_wrong_way.any():
+            toolpath = toolpath.reorder(np.arange(len(rings)), reverse=is_wrong_way)
 
-        else:
-            # Check if this Gerber type is implemented
-            try:
-                tmp = GerberToShapely(primitive)
-            except NotImplementedError:
-                print(f"\nThis Gerber Object {type(primitive)} isn't implemented! \n\n")
-                raise
-
-            if x_y_axis:
-                self.primitives[ind].position = (primitive.position[0]*-1, primitive.position[1])
-            else:
-                self.primitives[ind].position = (primitive.position[0], primitive.position[1]*-1)
+        return toolpath
 
-    ### Step 2: recenter to original position
-    self.recenter_gerber_file(x_min, y_min)
+    def keep_vertices(self, keep: np.ndarray) -> Toolpath:
+        '''
+        creates a Toolpath of only the vertices where keep is True, every loop keeps its place even if it ends up empty
 
+        :param keep: (N,) bool array
+        '''
+        loop_inds = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        offsets = np.zeros(len(self.offsets), dtype=np.intp)
+        np.cumsum(np.bincount(loop_inds[keep], minlength=len(self)), out=offsets[1:])
 
-gerber.rs274x.GerberFile.mirror = gerber_mirror
+        return Toolpath(self.coords[keep], offsets)
 
-# 4: adding 90 degree rotation to invert width and height
-def rotate_point(point: tuple[float, float], angle_degrees) -> tuple[float, float]:
+    def reorder(self, order: np.ndarray, starts: Optional[np.ndarray] = None, reverse: Optional[np.ndarray] = None) -> Toolpath:
+        '''
+        creates a Toolpath of the loops in the given order, each rotated to start (and end) at another vertex and/or reversed.
+        Only closed loops (first vertex repeated at the end) can be rotated, open ones can only be reversed
+
+        :param order: indices of the loops in their new order
+        :param starts: for each loop in the new order, index of the vertex it starts at, default 0
+        :param reverse: for each loop in the new order, whether to walk it backwards, default False
+        '''
+        order = np.asarray(order, dtype=np.intp)
+        lengths = np.diff(self.offsets)[order]
+        offsets = np.zeros(len(order)+1, dtype=np.intp)
+        np.cumsum(lengths, out=offsets[1:])
+
+        # vertex t of new loop k is vertex (start + t) or (start - t) of the old loop, modulo the number of distinct vertices
+        loop_inds = np.repeat(np.arange(len(order)), lengths)
+        t = np.arange(offsets[-1]) - offsets[:-1][loop_inds]
+        periods = np.maximum(lengths - 1, 1)[loop_inds]
+        starts = np.zeros(len(order), dtype=np.intp) if starts is None else np.asarray(starts, dtype=np.intp)
+        steps = np.ones(len(order), dtype=np.intp) if reverse is None else np.where(reverse, -1, 1)
+        local_inds = (starts[loop_inds] + steps[loop_inds]*t) % periods
+
+        # open loops are just walked backwards
+        firsts, lasts = self.offsets[:-1][order], np.maximum(self.offsets[1:][order] - 1, self.offsets[:-1][order])
+        is_open = np.any(self.coords[firsts] != self.coords[lasts], axis=1)[loop_inds]
+        local_inds = np.where(is_open, np.where(steps[loop_inds] < 0, lengths[loop_inds] - 1 - t, t), local_inds)
+
+        return Toolpath(self.coords[self.offsets[:-1][order][loop_inds] + local_inds], offsets)
+
+    def signed_areas(self) -> np.ndarray:
+        '''
+        shoelace area of every closed loop, positive for counter clockwise loops and negative for clockwise loops
+        '''
+        x, y = self.coords[:, 0], self.coords[:, 1]
+        cross = np.zeros(self.num_vertices)
+        cross[:-1] = x[:-1]*y[1:] - x[1:]*y[:-1]
+        cross[self.offsets[1:] - 1] = 0  # last vertex of a loop isn't joined to the first of the next
+
+        loop_inds = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        return np.bincount(loop_inds, weights=cross, minlength=len(self)) / 2
+
+    @property
+    def num_vertices(self) -> int:
+        return len(self.coords)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Toolpath loop index out of range")
+
+        return self.coords[self.offsets[index]:self.offsets[index+1]]
+
+    def __iter__(self):
+        for ind in range(len(self)):
+            yield self.coords[self.offsets[ind]:self.offsets[ind+1]]
+
+    def __repr__(self) -> str:
+        return f"Toolpath({len(self)} loops, {self.num_vertices} vertices)"
+
+
+class HeightMap:
     '''
-    given a shapely.Point argument, this function will use matrix dot multiplication 
-    to multiply the given 2d coordinate to rotate it angle_degrees, then 
-    return a shapely.Point
+    Surface height of the PCB measured on a grid (see GenerateHeightMap), built once and evaluated
+    for whole coordinate arrays at once with bilinear interpolation.
     '''
-    # Unpack the point tuple
-    x, y = point[0], point[1]
+    def __init__(self, height_map: list[list[float, float, float]]):
+        '''
+        :param height_map: list of [x, y, z] probe points, as saved in the height map .json file
+        '''
+        points = np.array(height_map, dtype=np.float64).reshape(-1, 3)
+        if not len(points):
+            raise ValueError("Height map is empty!")
+
+        ### Step 1: the grid lines are all the distinct X and Y probe coordinates
+        self.x_coords = np.unique(points[:, 0])
+        self.y_coords = np.unique(points[:, 1])
+
+        ### Step 2: putting every probe point directly in its grid cell
+        self.z_grid = np.full((len(self.y_coords), len(self.x_coords)), np.nan)
+        self.z_grid[np.searchsorted(self.y_coords, points[:, 1]), np.searchsorted(self.x_coords, points[:, 0])] = points[:, 2]
+
+        ### Step 3: grid cells that weren't probed take the value of the nearest probe point
+        missing = np.argwhere(np.isnan(self.z_grid))
+        if len(missing):
+            missing_xy = np.column_stack((self.x_coords[missing[:, 1]], self.y_coords[missing[:, 0]]))
+            distances = ((missing_xy[:, None, :] - points[None, :, :2])**2).sum(axis=2)
+            self.z_grid[missing[:, 0], missing[:, 1]] = points[distances.argmin(axis=1), 2]
+
+        ### Step 4: a single grid line in X or Y is extended so there is always a cell to interpolate in
+        if len(self.x_coords) == 1:
+            self.x_coords = np.append(self.x_coords, self.x_coords[0] + 1)
+            self.z_grid = np.repeat(self.z_grid, 2, axis=1)
+        if len(self.y_coords) == 1:
+            self.y_coords = np.append(self.y_coords, self.y_coords[0] + 1)
+            self.z_grid = np.repeat(self.z_grid, 2, axis=0)
 
-    # Convert angle from degrees to radians
-    angle_radians = math.radians(angle_degrees)
+    @classmethod
+    def from_json(cls, file_path: str) -> HeightMap:
+        '''
+        reads a height map .json file
+        '''
+        import json
 
-    # Calculate the cosine and sine of the angle
-    cos_theta = math.cos(angle_radians)
-    sin_theta = math.sin(angle_radians)
+        with open(file_path, 'r') as f:
+            return cls(json.load(f))
 
-    # Apply the rotation
-    x_rotated = x * cos_theta - y * sin_theta
-    y_rotated = x * sin_theta + y * cos_theta
+    def get_z(self, x: np.ndarray | float, y: np.ndarray | float) -> np.ndarray:
+        '''
+        bilinear interpolation of the surface height, coordinates outside the grid take the height of the nearest grid edge
 
-    # Return the rotated point as a tuple
-    return (round(x_rotated, 5), round(y_rotated, 5))
+        :param x: X coordinate or array of X coordinates
+        :param y: Y coordinate or array of Y coordinates, same shape as x
+        :return: Z value(s), same shape as x
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
 
-def gerber_rotate_90(self):
-    '''
-    Rotate the gerber file (for DIP components)
+        # index of the grid cell of each coordinate and the position inside that cell (0 to 1)
+        i = np.clip(np.searchsorted(self.x_coords, x, side='right') - 1, 0, len(self.x_coords) - 2)
+        j = np.clip(np.searchsorted(self.y_coords, y, side='right') - 1, 0, len(self.y_coords) - 2)
+        tx = np.clip((x - self.x_coords[i]) / (self.x_coords[i+1] - self.x_coords[i]), 0, 1)
+        ty = np.clip((y - self.y_coords[j]) / (self.y_coords[j+1] - self.y_coords[j]), 0, 1)
 
-    Procedure:
-    Step-1: switch x and y coordinates
-    Step-2: recenter to (x_min, y_min) (which is measured before step 1!!) 
-    Done :D
+        return ((1 - tx) * (1 - ty) * self.z_grid[j, i] + tx * (1 - ty) * self.z_grid[j, i+1]
+                + (1 - tx) * ty * self.z_grid[j+1, i] + tx * ty * self.z_grid[j+1, i+1])
 
-    '''
-    # Get X and Y, min for step2 and switching them
-    bounds = self.bounds
-    x_min = bounds[0][0]
-    y_min = bounds[1][0]
+    def max_chord_deviation(self, starts: np.ndarray, ends: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        For straight lines from starts to ends, finds the maximum Z deviation between the surface under each line
+        and the straight line joining the surface heights at its two ends.
 
-    # Step 1: invert x and y coordinates
-    # Step 1a: for .statements
-    for stmt in self.statements:
-        if hasattr(stmt, 'x') and hasattr(stmt, 'y'):
-            if type(stmt.x) in [int, float] and type(stmt.y) in [int, float]:
-                new_stmt_point = rotate_point((stmt.x, stmt.y), 90)
-                stmt.x = new_stmt_point[0]
-                stmt.y = new_stmt_point[1]
+        Inside one grid cell, the bilinear surface along a straight line is a parabola, so each line is cut
+        at the grid lines it crosses and the maximum of each parabola is found exactly.
 
-        elif hasattr(stmt, 'modifiers'):
-            if len(stmt.modifiers[0]) > 1:
-                stmt.modifiers[0] = (stmt.modifiers[0][1], stmt.modifiers[0][0])
+        :param starts: (n, 2) X, Y start of each line
+        :param ends: (n, 2) X, Y end of each line
+        :return: (maximum deviation, fraction along the line where it happens) of each line
+        '''
+        starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+        ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+        vectors = ends - starts
+        num_lines = len(starts)
+        z_starts = self.get_z(starts[:, 0], starts[:, 1])
+        z_ends = self.get_z(ends[:, 0], ends[:, 1])
+
+        ### Step 1: the breakpoints of each line are its two ends and where it crosses a grid line
+        line_ids = [np.arange(num_lines), np.arange(num_lines)]
+        fractions = [np.zeros(num_lines), np.ones(num_lines)]
+        for axis, grid in enumerate((self.x_coords, self.y_coords)):
+            first = np.searchsorted(grid, np.minimum(starts[:, axis], ends[:, axis]), side='right')
+            counts = np.maximum(np.searchsorted(grid, np.maximum(starts[:, axis], ends[:, axis]), side='left') - first, 0)
+            crossing_line_ids = np.repeat(np.arange(num_lines), counts)
+            grid_inds = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - first, counts)
+            line_ids.append(crossing_line_ids)
+            fractions.append((grid[grid_inds] - starts[crossing_line_ids, axis]) / vectors[crossing_line_ids, axis])
+
+        line_ids = np.concatenate(line_ids)
+        fractions = np.concatenate(fractions)
+        order = np.lexsort((fractions, line_ids))
+        line_ids = line_ids[order]
+        fractions = fractions[order]
+
+        ### Step 2: the pieces between consecutive breakpoints of the same line, each one inside a single grid cell
+        is_piece = line_ids[1:] == line_ids[:-1]
+        piece_line_ids = line_ids[:-1][is_piece]
+        u_starts = fractions[:-1][is_piece]
+        u_ends = fractions[1:][is_piece]
+
+        def deviation(u):
+            points = starts[piece_line_ids] + u[:, None]*vectors[piece_line_ids]
+            chord = z_starts[piece_line_ids] + u*(z_ends[piece_line_ids] - z_starts[piece_line_ids])
+            return self.get_z(points[:, 0], points[:, 1]) - chord
+
+        ### Step 3: the deviation is a parabola d(s) = d0 + b*s + a*s^2 along each piece (s from 0 to 1), its extremum is at -b/2a
+        d0 = deviation(u_starts)
+        d_middle = deviation((u_starts + u_ends)/2)
+        d1 = deviation(u_ends)
+        b = -3*d0 + 4*d_middle - d1
+        a = 2*d0 - 4*d_middle + 2*d1
+        s = np.clip(-b / np.where(a == 0, np.inf, 2*a), 0, 1)
+        d_extremum = d0 + b*s + a*s*s
+
+        candidates = np.abs(np.column_stack((d0, d_extremum, d1)))
+        candidate_fractions = np.column_stack((u_starts, u_starts + s*(u_ends - u_starts), u_ends))
+        best = candidates.argmax(axis=1)
+        piece_max = candidates[np.arange(len(best)), best]
+        piece_max_fraction = candidate_fractions[np.arange(len(best)), best]
+
+        ### Step 4: the maximum of each line is the maximum of its pieces
+        order = np.lexsort((-piece_max, piece_line_ids))
+        line_inds, first_pieces = np.unique(piece_line_ids[order], return_index=True)
+        max_deviation = np.zeros(num_lines)
+        max_fraction = np.full(num_lines, 0.5)
+        max_deviation[line_inds] = piece_max[order][first_pieces]
+        max_fraction[line_inds] = piece_max_fraction[order][first_pieces]
+
+        return max_deviation, max_fraction
+
+    def __repr__(self) -> str:
+        return f"HeightMap({len(self.x_coords)}x{len(self.y_coords)} grid, Z from {np.min(self.z_grid)} to {np.max(self.z_grid)})"
+
+
+class FlashTemplateCache:
+    '''
+    Bounded (least recently used) cache of aperture flash shapes built at the origin (0, 0).
 
-        #TODO: does start and end angle of gerber.primitives.Arc need rotating?!?
+    Boards flash the same few apertures hundreds of times, so the shape is built once
+    and then only translated to the position of each flash.
+    '''
+    def __init__(self, max_size: int = FLASH_TEMPLATE_CACHE_SIZE):
+        self.max_size = max_size
+        self.templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple) -> Optional[Polygon]:
+        '''
+        :return: the template shape of key, None if not cached
+        '''
+        template = self.templates.get(key)
+        if template is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.templates.move_to_end(key)
 
+        return template
 
-    # Step1b: for .primitives
-    for ind, primitive in enumerate(self.primitives):
-        if type(primitive) == gerber.primitives.Line:
-            self.primitives[ind].start = rotate_point(primitive.start, 90)
-            self.primitives[ind].end = rotate_point(primitive.end, 90)
+    def put(self, key: tuple, template: Polygon) -> None:
+        '''
+        adds template to the cache, evicting the least recently used template if the cache is full
+        '''
+        self.templates[key] = template
+        self.templates.move_to_end(key)
+        if len(self.templates) > self.max_size:
+            self.templates.popitem(last=False)
+            self.evictions += 1
 
-        elif type(primitive) == gerber.primitives.Region:
-            for ind2, region_primitive in enumerate(primitive.primitives):
-                if type(region_primitive) == gerber.primitives.Line:
-                    self.primitives[ind].primitives[ind2].start = rotate_point(region_primitive.start, 90)
-                    self.primitives[ind].primitives[ind2].end = rotate_point(region_primitive.end, 90)
+    def clear(self) -> None:
+        '''
+        empties the cache and resets the statistics
+        '''
+        self.templates.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-                else:
-                    # Assuming all primitives inside Region object is line
-                    raise NotImplementedError("I thought all primitives inside a Region object is Line primitives only")
+    def __repr__(self) -> str:
+        return f"FlashTemplateCache(size={len(self.templates)}/{self.max_size}, hits={self.hits}, misses={self.misses}, evictions={self.evictions})"
 
-        elif type(primitive) == gerber.primitives.Arc:
-            offset = rotate_point(primitive.center, 90)
-            primitive.offset(-primitive.center[0]+offset[0], -primitive.center[1]+offset[1])
+def get_flash_template_key(object_to_convert: gerber.primitives.Primitive) -> Optional[tuple]:
+    '''
+    gets the key describing the shape of a flashed aperture independently of where it's flashed
 
-        elif type(primitive) == gerber.primitives.AMGroup and primitive.stmt.name == 'RoundRect':
+    :param object_to_convert: Obround or AMGroup gerber object
+    :return: hashable key, None if the shape of this object can't be described (won't be cached)
+    '''
+    position = object_to_convert.position
+    relative = lambda coord: (round(coord[0] - position[0], 9), round(coord[1] - position[1], 9))
 
-            self.primitives[ind].position = rotate_point(primitive.position, 90)
+    if type(object_to_convert) == gerber.primitives.Obround:
+        return ('Obround', round(object_to_convert.width, 9), round(object_to_convert.height, 9), round(object_to_convert.rotation, 9))
 
-            for ind2, sub_primitive in enumerate(primitive.primitives):
-                if type(sub_primitive) == gerber.rs274x.Outline:
-                    for ind3, l in enumerate(sub_primitive.primitives):
+    elif type(object_to_convert) == gerber.primitives.AMGroup:
+        # The sub primitives of an AMGroup hold absolute coordinates, so the key is their geometry relative to the flash position
+        key = ['AMGroup', object_to_convert.stmt.name]
+        for primitive in object_to_convert.primitives:
+            if type(primitive) == gerber.primitives.Outline:
+                key.append(('Outline', tuple((relative(l.start), relative(l.end), l.aperture.diameter) for l in primitive.primitives)))
 
-                        if type(l) != gerber.primitives.Line:
-                            raise NotImplementedError("I thought Outline only contains Line object ;(")
+            elif type(primitive) == gerber.primitives.Circle:
+                key.append(('Circle', relative(primitive.position), round(primitive.diameter, 9)))
 
-                        if l.aperture.diameter != 0:
-                            raise NotImplementedError("I thought outline gerber.primitives.Line objects don't have a thickness ;(")
+            else:
+                return None
 
-                        self.primitives[ind].primitives[ind2].primitives[ind3].start = rotate_point(l.start, 90)
-                        self.primitives[ind].primitives[ind2].primitives[ind3].end = rotate_point(l.end, 90)
+        return tuple(key)
 
-                elif type(sub_primitive) == gerber.rs274x.Circle:
-                    self.primitives[ind].primitives[ind2].position = rotate_point(sub_primitive.position, 90)
+    return None
 
-                else:
-                    raise NotImplementedError(f"I thought AMGroup Object named 'RoundRect' in .stmt will only have primitive Outline and Cirle in their primitives list, found {primitive}")
 
+def get_arc_segments(radius: float | np.ndarray, sweep_angle: float, chord_tolerance: float = DEFAULT_CHORD_TOLERANCE) -> int | np.ndarray:
+    '''
+    gets the least number of straight segments approximating an arc so that none of them is further than chord_tolerance from it,
+    a chord spanning the angle theta is r*(1 - cos(theta/2)) away from the arc at its middle
 
-        else:
-            # Check if this Gerber type is implemented
-            try:
-                tmp = GerberToShapely(primitive)
-            except NotImplementedError:
-                print(f"\nThis Gerber Object {type(primitive)} isn't implemented how to recenter!\n\n")
-                raise
-
-            self.primitives[ind].position = rotate_point(primitive.position, 90)
-            
-            # must invert height and width when rotating 90 degrees
-            if hasattr(primitive, 'width') and hasattr(primitive, 'height'):
-                self.primitives[ind].width, self.primitives[ind].height = primitive.height, primitive.width
+    :param radius: radius of the arc (or array of radii)
+    :param sweep_angle: angle the arc spans in radians
+    :param chord_tolerance: maximum chord error in mm
+    '''
+    # arcs smaller than the tolerance get the minimum, a single segment per pi
+    max_step = 2*np.arccos(1 - chord_tolerance/np.maximum(radius, chord_tolerance))
+    segments = np.maximum(np.ceil(sweep_angle/max_step - 1e-9), 1).astype(int)
 
-    ### Step 2: recenter to original position
-    self.recenter_gerber_file(x_min, y_min)
+    return segments if isinstance(segments, np.ndarray) and segments.ndim else int(segments)
 
+def get_quad_segs(radius: float | np.ndarray, chord_tolerance: float = DEFAULT_CHORD_TOLERANCE) -> int | np.ndarray:
+    '''
+    gets shapely's buffer quad_segs (segments per quarter circle) for a buffer radius, see get_arc_segments()
+    '''
+    return get_arc_segments(radius, math.pi/2, chord_tolerance)
 
-gerber.rs274x.GerberFile.rotate_90 = gerber_rotate_90
+def buffer_to_tolerance(shapes: np.ndarray, radii: np.ndarray, chord_tolerance: float = DEFAULT_CHORD_TOLERANCE) -> np.ndarray:
+    '''
+    vectorized buffer of each shape by its radius with the segment count the radius needs,
+    shapely only takes one quad_segs per call so the shapes are buffered in groups of equal quad_segs
 
-###############################################################
+    :param shapes: numpy array of shapely objects
+    :param radii: numpy array of buffer radius of each shape
+    :param chord_tolerance: maximum chord error in mm
+    :return: numpy array of the buffered shapes
+    '''
+    quad_segs = get_quad_segs(radii, chord_tolerance)
+    buffered = np.empty(len(shapes), dtype=object)
+    for segs in np.unique(quad_segs):
+        group = quad_segs == segs
+        buffered[group] = shapely.buffer(shapes[group], radii[group], quad_segs=int(segs))
+
+    return buffered
 
 
 class GerberToShapely:
     '''
     This class converts gerber shape objects (also known as primitives) to shapely shape objects
     '''
+    CONVERT_METHOD_MAP = None
+    FLASH_TEMPLATE_CACHE = FlashTemplateCache()
+    CHORD_TOLERANCE = DEFAULT_CHORD_TOLERANCE
+
     def __new__(cls, object_to_convert):
         '''
         special constructor to returnt the correct shapely object
@@ -309,8 +696,9 @@ class GerberToShapely:
         if not issubclass(type(object_to_convert), gerber.primitives.Primitive):
             raise ValueError("The object passed is not a gerber library shape object. (not a Primitive() object)")
 
-        # setting the mapping method
-        cls.set_class_convert_map()
+        # setting the mapping method, only once
+        if cls.CONVERT_METHOD_MAP is None:
+            cls.set_class_convert_map()
 
         return cls.CONVERT_METHOD_MAP[type(object_to_convert)](object_to_convert)
 
@@ -340,11 +728,113 @@ class GerberToShapely:
                           gerber.primitives.SquareRoundDonut: cls.to_square_round_donut,
                           gerber.primitives.TestRecord: cls.to_test_record}
 
+    @classmethod
+    def set_chord_tolerance(cls, chord_tolerance: float) -> None:
+        '''
+        sets the maximum chord error in mm of every arc, circle and rounded corner the conversion methods approximate.
+        The cached flash shapes were built with the old tolerance so they're dropped when it changes
+        '''
+        if chord_tolerance <= 0:
+            raise ValueError(f"chord tolerance must be positive, got {chord_tolerance}")
+
+        if chord_tolerance != cls.CHORD_TOLERANCE:
+            cls.CHORD_TOLERANCE = chord_tolerance
+            cls.FLASH_TEMPLATE_CACHE.clear()
+
+    @classmethod
+    def convert_all(cls, primitives: list[gerber.primitives.Primitive]) -> np.ndarray:
+        '''
+        Bulk version of GerberToShapely(primitive) for a whole list of primitives.
+
+        Lines, Circles and Rectangles (the vast majority of any board) are grouped by type and each group is built
+        with one call to Shapely's vectorized constructors and buffer, every other type goes through its normal conversion method.
+
+        :param primitives: list of gerber primitives, e.g. gerber_obj.primitives
+        :return: numpy array of shapely objects aligned with primitives (item i is the shape of primitives[i])
+        '''
+        shapely_objects = np.empty(len(primitives), dtype=object)
+
+        ### Step 1: grouping the primitives by type and extracting their parameters
+        line_inds, line_coords, line_radii = [], [], []
+        circle_inds, circle_coords, circle_radii = [], [], []
+        rectangle_inds, rectangle_bounds, rectangle_rotations = [], [], []
+        for ind, primitive in enumerate(primitives):
+            primitive_type = type(primitive)
+
+            if primitive_type == gerber.primitives.Line:
+                line_inds.append(ind)
+                line_coords.append((primitive.start[:2], primitive.end[:2]))
+                line_radii.append(primitive.aperture.diameter/2)
+
+            elif primitive_type == gerber.primitives.Circle:
+                circle_inds.append(ind)
+                circle_coords.append(primitive.position[:2])
+                circle_radii.append(primitive.diameter/2)
+
+            elif primitive_type == gerber.primitives.Rectangle:
+                rectangle_inds.append(ind)
+                rectangle_bounds.append((primitive.position[0] - primitive.width/2, primitive.position[1] - primitive.height/2,
+                                         primitive.position[0] + primitive.width/2, primitive.position[1] + primitive.height/2))
+                rectangle_rotations.append(primitive.rotation)
+
+            else:
+                shapely_objects[ind] = GerberToShapely(primitive)
+
+        ### Step 2: building each group in one go
+        # Lines, zero width lines stay as LineStrings like in to_line()
+        if line_inds:
+            line_radii = np.array(line_radii, dtype=float)
+            lines = shapely.linestrings(np.array(line_coords, dtype=float))
+            is_thick = line_radii != 0
+            lines[is_thick] = buffer_to_tolerance(lines[is_thick], line_radii[is_thick], cls.CHORD_TOLERANCE)
+            shapely_objects[line_inds] = lines
+
+        if circle_inds:
+            points = shapely.points(np.array(circle_coords, dtype=float))
+            shapely_objects[circle_inds] = buffer_to_tolerance(points, np.array(circle_radii, dtype=float), cls.CHORD_TOLERANCE)
+
+        if rectangle_inds:
+            rectangles = shapely.box(*np.array(rectangle_bounds, dtype=float).T)
+            for ind in np.flatnonzero(rectangle_rotations):
+                rectangles[ind] = shapely.affinity.rotate(rectangles[ind], rectangle_rotations[ind], origin='center')
+            shapely_objects[rectangle_inds] = rectangles
+
+        return shapely_objects
+
+    @classmethod
+    def from_flash_template(cls, object_to_convert: gerber.primitives.Primitive, convert_method: Callable) -> Polygon:
+        '''
+        Converts a flashed aperture using the shape cached in FLASH_TEMPLATE_CACHE translated to the flash position.
+        On a cache miss, the shape is built by convert_method and its copy moved to the origin is cached.
+
+        :param object_to_convert: the flashed gerber object
+        :param convert_method: the method that builds the shape from scratch
+        '''
+        key = get_flash_template_key(object_to_convert)
+        if key is None:
+            return convert_method(object_to_convert)
+
+        position = np.array(object_to_convert.position[:2], dtype=float)
+        template = cls.FLASH_TEMPLATE_CACHE.get(key)
+        if template is None:
+            shape = convert_method(object_to_convert)
+            cls.FLASH_TEMPLATE_CACHE.put(key, shapely.transform(shape, lambda coords: coords - position))
+            return shape
+
+        return shapely.transform(template, lambda coords: coords + position)
+
     @classmethod
     def to_amgroup(cls, object_to_convert: gerber.primitives.Primitive) -> Polygon:
         '''
         AMGroup stands for Apt Macro Group, it's made of a list of Outline objects and other shapes like Circle or Obround
         '''
+        return cls.from_flash_template(object_to_convert, cls.build_amgroup)
+
+    @classmethod
+    def build_amgroup(cls, object_to_convert: gerber.primitives.Primitive) -> Polygon:
+        '''
+        builds the AMGroup shape from scratch, see to_amgroup()
+        '''
         ### DETECTING ROUND RECT AMGroup CORNERCASE
         if object_to_convert.stmt.name == 'RoundRect':
             return GerberToShapely.to_round_rectangle(object_to_convert)
@@ -372,32 +862,26 @@ class GerberToShapely:
         start_angle = object_to_convert.start_angle  # Start angle in degrees
         end_angle = object_to_convert.end_angle # End angle in degrees
         clockwise = False if object_to_convert.direction == 'counterclockwise' else True # Direction of the arc
-        num_points = 50  # the resolution of the arc
 
+        # a clockwise arc covers the same ring as the counter clockwise one from its end to its start (mirrored files have them)
         if clockwise:
-            if start_angle > end_angle:
-                pass
-            else:
-                pass
-            raise NotImplementedError("")
+            start_angle, end_angle = end_angle, start_angle
 
-        else:
-            if start_angle < end_angle:
-                angle_offset = 0
-            else:
-                angle_offset = math.pi
+        # counter clockwise sweep crossing the -pi/pi boundary
+        if end_angle <= start_angle:
+            end_angle += 2*math.pi
+
+        # the resolution of the arc, the outer edge has the biggest chord error
+        num_points = get_arc_segments(radius + thickness/2, end_angle - start_angle, cls.CHORD_TOLERANCE) + 1
 
         ### Step2: Creating a shapely Polygon Object
         radius_in = radius - thickness/2
-        arc_coords_in = [ (center[0] + radius_in * np.cos(angle+angle_offset), center[1] + radius_in * np.sin(angle+angle_offset)) for angle in np.linspace(start_angle, end_angle, num_points)]
+        arc_coords_in = [ (center[0] + radius_in * np.cos(angle), center[1] + radius_in * np.sin(angle)) for angle in np.linspace(start_angle, end_angle, num_points)]
 
         radius_out = radius + thickness/2
-        arc_coords_out = [ (center[0] + radius_out * np.cos(angle+angle_offset), center[1] + radius_out * np.sin(angle+angle_offset)) for angle in np.linspace(start_angle, end_angle, num_points)]
+        arc_coords_out = [ (center[0] + radius_out * np.cos(angle), center[1] + radius_out * np.sin(angle)) for angle in np.linspace(start_angle, end_angle, num_points)]
 
-        if clockwise:
-            arc_coords_out = arc_coords_out[::-1]
-        else:
-            arc_coords_in = arc_coords_in[::-1]
+        arc_coords_in = arc_coords_in[::-1]
         
         polygon_points = arc_coords_in
         polygon_points.extend(arc_coords_out)
@@ -418,7 +902,8 @@ class GerberToShapely:
         '''
 
         '''
-        return Point(object_to_convert.position[0], object_to_convert.position[1]).buffer(object_to_convert.diameter/2)
+        radius = object_to_convert.diameter/2
+        return Point(object_to_convert.position[0], object_to_convert.position[1]).buffer(radius, quad_segs=get_quad_segs(radius, cls.CHORD_TOLERANCE))
 
     @classmethod
     def to_diamond(cls, object_to_convert: gerber.primitives.Primitive) -> Polygon:
@@ -446,6 +931,8 @@ class GerberToShapely:
         '''
 
         '''
+        from matplotlib.patches import Ellipse
+
         ellipse = Ellipse((object_to_convert.position[0], object_to_convert.position[1]), object_to_convert.height*0.8, object_to_convert.width*0.8)
 
         return Polygon(LinearRing(ellipse.get_verts()))
@@ -456,7 +943,8 @@ class GerberToShapely:
 
         '''
         if object_to_convert.aperture.diameter != 0:
-            return Polygon(LineString([(object_to_convert.start[0], object_to_convert.start[1]), (object_to_convert.end[0], object_to_convert.end[1])]).buffer(object_to_convert.aperture.diameter/2).exterior)
+            radius = object_to_convert.aperture.diameter/2
+            return Polygon(LineString([(object_to_convert.start[0], object_to_convert.start[1]), (object_to_convert.end[0], object_to_convert.end[1])]).buffer(radius, quad_segs=get_quad_segs(radius, cls.CHORD_TOLERANCE)).exterior)
 
         else:
             return LineString([(object_to_convert.start[0], object_to_convert.start[1]), (object_to_convert.end[0], object_to_convert.end[1])])
@@ -466,65 +954,30 @@ class GerberToShapely:
         '''
 
         '''
-        # Step 1: create the base circle
-        diameter = object_to_convert.height if object_to_convert.height < object_to_convert.width else object_to_convert.width
-        radius = diameter/2
-        circle = Point(object_to_convert.position).buffer(radius)
-
-        # Step 2: divide the circle into 4 quarters
-        x_min = object_to_convert.position[0] - radius
-        x_max = object_to_convert.position[0] + radius
-        y_min = object_to_convert.position[1] - radius
-        y_max = object_to_convert.position[1] + radius
-
-        circle_coords = list(circle.exterior.coords) 
-
-        top_coord = (object_to_convert.position[0], y_max)
-        right_coord = (x_max, object_to_convert.position[1])
-        bottom_coord = (object_to_convert.position[0], y_min)
-        left_coord = (x_min, object_to_convert.position[1])
-
-        top_coord_ind = circle_coords.index(top_coord)
-        top_coord_ind2 = top_coord_ind if circle_coords.count(top_coord) == 1 else -1
-        right_coord_ind = circle_coords.index(right_coord)
-        right_coord_ind2 = right_coord_ind if circle_coords.count(right_coord) == 1 else -1
-        bottom_coord_ind = circle_coords.index(bottom_coord)
-        bottom_coord_ind2 = bottom_coord_ind if circle_coords.count(bottom_coord) == 1 else -1
-        left_coord_ind = circle_coords.index(left_coord)
-        left_coord_ind2 = left_coord_ind if circle_coords.count(left_coord) == 1 else -1
-
-        top_right_coords = circle_coords[top_coord_ind : right_coord_ind2]
-        bottom_right_coords = circle_coords[right_coord_ind : bottom_coord_ind2]
-        bottom_left_coords = circle_coords[bottom_coord_ind: left_coord_ind2]
-        top_left_coords = circle_coords[left_coord_ind : top_coord_ind2]
-
-        # Step 3: Find the 2 shifting transformations (if they exist)
-        if object_to_convert.height > object_to_convert.width:
-            # 2 vertical transformations for each two quarters
-            shifting_value = (object_to_convert.height - object_to_convert.width)/2
-            top_right_coords = [(coord[0], coord[1]+shifting_value) for coord in top_right_coords]
-            top_left_coords = [(coord[0], coord[1]+shifting_value) for coord in top_left_coords]
-            bottom_right_coords = [(coord[0], coord[1]-shifting_value) for coord in bottom_right_coords]
-            bottom_left_coords = [(coord[0], coord[1]-shifting_value) for coord in bottom_left_coords]
-
-        elif object_to_convert.height < object_to_convert.width:
-            # 2 horizontal transformations for each two quarters
-            shifting_value = (object_to_convert.width - object_to_convert.height)/2
-            top_right_coords = [(coord[0]+shifting_value, coord[1]) for coord in top_right_coords]
-            bottom_right_coords = [(coord[0]+shifting_value, coord[1]) for coord in bottom_right_coords]
-            top_left_coords = [(coord[0]-shifting_value, coord[1]) for coord in top_left_coords]
-            bottom_left_coords = [(coord[0]-shifting_value, coord[1]) for coord in bottom_left_coords]
+        return cls.from_flash_template(object_to_convert, cls.build_obround)
 
+    @classmethod
+    def build_obround(cls, object_to_convert: gerber.primitives.Primitive) -> LinearRing:
+        '''
+        builds the Obround shape from scratch, see to_obround()
+        '''
+        # an obround is the straight segment between the centers of its two semicircles widened by their radius,
+        # so its round ends are sampled like any other circle (the pieces of a circle shifted apart missed a vertex at every joint)
+        x, y = object_to_convert.position[0], object_to_convert.position[1]
+        radius = min(object_to_convert.width, object_to_convert.height)/2
+        half_width = object_to_convert.width/2 - radius
+        half_height = object_to_convert.height/2 - radius
+        quad_segs = get_quad_segs(radius, cls.CHORD_TOLERANCE)
+
+        if half_width == 0 and half_height == 0:
+            obround = Point(x, y).buffer(radius, quad_segs=quad_segs)
         else:
-            # No transformations
-            pass
+            obround = LineString([(x - half_width, y - half_height), (x + half_width, y + half_height)]).buffer(radius, quad_segs=quad_segs)
 
-        joined_quarters_coords = top_right_coords
-        joined_quarters_coords.extend(bottom_right_coords)
-        joined_quarters_coords.extend(bottom_left_coords)
-        joined_quarters_coords.extend(top_left_coords)
+        if object_to_convert.rotation:
+            obround = shapely.affinity.rotate(obround, object_to_convert.rotation, origin=object_to_convert.position)
 
-        return Polygon(LinearRing(joined_quarters_coords))
+        return obround
 
     @classmethod
     def to_outline(cls, object_to_convert: gerber.primitives.Primitive) -> LinearRing:
@@ -559,7 +1012,11 @@ class GerberToShapely:
         '''
 
         '''
-        rectangle = box(object_to_convert.lower_left[0], object_to_convert.lower_left[1], object_to_convert.upper_right[0], object_to_convert.upper_right[1])
+        x, y = object_to_convert.position[0], object_to_convert.position[1]
+        half_width, half_height = object_to_convert.width/2, object_to_convert.height/2
+        rectangle = box(x - half_width, y - half_height, x + half_width, y + half_height)
+        if object_to_convert.rotation:
+            rectangle = shapely.affinity.rotate(rectangle, object_to_convert.rotation, origin=(x, y))
         return Polygon(LinearRing(list(rectangle.exterior.coords)))
 
     @classmethod
@@ -631,9 +1088,18 @@ class GerberToShapely:
                 if corner_diameter == -1:
                     raise NotImplementedError("didn't find any Circle objects in this AMGroup named 'RoundRect' in .stmt, thus don't know the diameter of the corners!")
 
+            center = object_to_convert.position
+
+            # a file rotated by an angle that isn't a multiple of 90 degrees has tilted outlines, they're measured turned back straight
+            first_line = lines[0].coords
+            rotation = math.degrees(math.atan2(first_line[1][1] - first_line[0][1], first_line[1][0] - first_line[0][0])) % 90
+            rotation = 0 if math.isclose(rotation, 0, abs_tol=1e-9) or math.isclose(rotation, 90, abs_tol=1e-9) else rotation
+            if rotation:
+                lines = [shapely.affinity.rotate(line, -rotation, origin=center) for line in lines]
+
             ### Step 2: find which of the lines represent the height and which represent the width
-            is_height = lambda line: line.coords[0][0] == line.coords[1][0]
-            is_width = lambda line: line.coords[0][1] == line.coords[1][1]
+            is_height = lambda line: math.isclose(line.coords[0][0], line.coords[1][0], abs_tol=1e-9)
+            is_width = lambda line: math.isclose(line.coords[0][1], line.coords[1][1], abs_tol=1e-9)
             heights = []
             widths = []
             for line in lines:
@@ -647,15 +1113,14 @@ class GerberToShapely:
             height = max(heights)
             width = max(widths)
 
-            center = object_to_convert.position
-
             ### Step 3: now that I have the height, width and rounded corner I can construct the rounded rectangle object easily
             # Ensure the corner radius is not greater than half the width or height
             corner_radius = min((corner_diameter/2), width / 2, height / 2)
 
             # Create the corner arcs
             # Each corner arc is defined by a sequence of points
-            def generate_arc(corner_radius, start_angle, end_angle, center=(0, 0), num_points=10):
+            corner_num_points = get_arc_segments(corner_radius, np.pi/2, cls.CHORD_TOLERANCE) + 1
+            def generate_arc(corner_radius, start_angle, end_angle, center=(0, 0), num_points=corner_num_points):
                 """Generate points for an arc centered at a specified point."""
                 return [
                     (center[0] + corner_radius * np.cos(angle), center[1] + corner_radius * np.sin(angle))
@@ -693,7 +1158,11 @@ class GerberToShapely:
                 exterior_points.extend(lines[i])
             
             # Create and return the polygon
-            return Polygon(exterior_points)
+            round_rectangle = Polygon(exterior_points)
+            if rotation:
+                round_rectangle = shapely.affinity.rotate(round_rectangle, rotation, origin=center)
+
+            return round_rectangle
 
         else:
             raise NotImplementedError("still didn't implement a gerber round rect object only an AMGroup named RoundRect in .stmt")
@@ -730,7 +1199,7 @@ def _turtle_move_trace(turtle, coord_list, x_offset, y_offset, multiplier):
     '''
 
     '''
-    if coord_list:
+    if len(coord_list):
         turtle.up()
         turtle.setpos((coord_list[0][0] - x_offset) * multiplier, (coord_list[0][1] - y_offset) * multiplier)
         turtle.down()
@@ -747,10 +1216,14 @@ def visualize(shape_to_sim: LineString | LinearRing | Polygon | list[Point], hid
     '''
     visualizes the shape object
     '''
+    import turtle
+    import random
+
+    device_w, device_h = get_device_w_h()
 
     # Set up the turtle screen
     screen = turtle.Screen()
-    screen.setup(width=DEVICE_W, height=DEVICE_H, startx=START_X, starty=START_Y)
+    screen.setup(width=device_w, height=device_h, startx=START_X, starty=START_Y)
 
     skk = turtle.Turtle()
     turtle.width(line_width)
@@ -778,6 +1251,9 @@ def visualize(shape_to_sim: LineString | LinearRing | Polygon | list[Point], hid
         coord_list = list(shape_to_sim.coords)
         _turtle_move_trace(turtle, coord_list, x_offset, y_offset, multiplier)
 
+    elif type(shape_to_sim) == np.ndarray:
+        _turtle_move_trace(turtle, shape_to_sim, x_offset, y_offset, multiplier)
+
     elif all((type(val) == Point) for val in shape_to_sim):
         coord_list = shape_to_sim
         _turtle_move_trace(turtle, coord_list, x_offset, y_offset, multiplier)
@@ -797,6 +1273,8 @@ def visualize_group(group, gbr_obj=None):
     '''
     visualizes a group of LineString or LinearRing
     '''
+    group = list(group)
+
     # Calculating Offset by finding center to draw PCB in the center
     if gbr_obj:
         x_center = 2 + (gbr_obj.size[0]//2)
@@ -810,8 +1288,9 @@ def visualize_group(group, gbr_obj=None):
     # multiplier = (DEVICE_W/gbr_obj.size[0]) if (gbr_obj.size[0] > gbr_obj.size[1]) else (DEVICE_H/gbr_obj.size[1])
     # multiplier /= 2
     # multiplier = 50
-    multiplier_width = DEVICE_W/gbr_obj.size[0]/4
-    multiplier_height = DEVICE_H/gbr_obj.size[1]/4
+    device_w, device_h = get_device_w_h()
+    multiplier_width = device_w/gbr_obj.size[0]/4
+    multiplier_height = device_h/gbr_obj.size[1]/4
     multiplier = max(multiplier_width, multiplier_height)
 
     len_group = len(group)
@@ -823,12 +1302,940 @@ def visualize_group(group, gbr_obj=None):
     print(f"Visualizaing Trace number: {num+2} out of {len_group}")
     visualize(group[-1], x_offset=x_center, y_offset=y_center, multiplier=multiplier, terminate=True)
 
+def union_shapely_objects(shapely_objects: list[Polygon], resolution: Optional[int] = None) -> list[Polygon]:
+    '''
+    Union all the given shapes in one cascaded pass (shapes are merged pairwise in a balanced tree inside GEOS)
+    instead of folding them one by one into an ever growing polygon, which is quadratic on dense boards.
+
+    :param shapely_objects: the shapes to union, LineStrings (zero width Lines) are accepted but dropped from the result
+    :param resolution: if given, all coordinates are snapped to a 10^-resolution mm grid while merging.
+                       this removes slivers and near coincident vertices and makes the union more robust
+    :return: list of the resultant Polygons, always a list even if everything merged into a single Polygon
+    '''
+    if not shapely_objects:
+        return []
+
+    if resolution is None:
+        whole_thing = unary_union(shapely_objects)
+    else:
+        whole_thing = unary_union(shapely_objects, grid_size=10**-resolution)
+
+    # the union returns a Polygon if everything touches, a MultiPolygon or a GeometryCollection otherwise
+    if type(whole_thing) == Polygon:
+        geoms = [whole_thing]
+    elif hasattr(whole_thing, 'geoms'):
+        geoms = list(whole_thing.geoms)
+    else:
+        geoms = []
+
+    return [geom for geom in geoms if type(geom) == Polygon and not geom.is_empty]
+
+def subtract_clear_shapely_objects(shapely_objects_dark: list[tuple[int, Polygon]], 
+        shapely_objects_clear: list[tuple[int, Polygon]], 
+        debug: bool=False) -> list[Polygon]:
+    '''
+    Applies the level polarity (%LPD*% / %LPC*%) of the gerber file.
+
+    A gerber image is drawn in statement order, a clear object erases the dark copper drawn BEFORE it only,
+    dark objects drawn after it are drawn on top of the cleared area.
+    The clear shapes are put in a spatial index (STRtree) so each dark shape is only tested against
+    the clear shapes whose bounding boxes it actually overlaps.
+
+    :param shapely_objects_dark: list of (statement order, shape) of the dark objects
+    :param shapely_objects_clear: list of (statement order, shape) of the clear objects
+    :param debug: prints how many dark/clear pairs were skipped
+    :return: list of the dark shapes, in the same order, with the clear shapes subtracted
+    '''
+    dark_shapes = [shape for _, shape in shapely_objects_dark]
+    if not shapely_objects_dark or not shapely_objects_clear:
+        return dark_shapes
+
+    clear_shapes = [shape for _, shape in shapely_objects_clear]
+    dark_order = np.array([order for order, _ in shapely_objects_dark])
+    clear_order = np.array([order for order, _ in shapely_objects_clear])
+
+    # Step 1: get all (dark, clear) pairs that intersect using the spatial index
+    tree = STRtree(clear_shapes)
+    dark_inds, clear_inds = tree.query(dark_shapes, predicate='intersects')
+    num_intersecting = len(dark_inds)
+
+    # Step 2: only keep the pairs where the clear shape is drawn after the dark shape
+    is_after = clear_order[clear_inds] > dark_order[dark_inds]
+    dark_inds = dark_inds[is_after]
+    clear_inds = clear_inds[is_after]
+
+    # Step 3: subtract all the erasing clear shapes from each dark shape in one difference operation
+    sorted_inds = np.argsort(dark_inds, kind='stable')
+    dark_inds = dark_inds[sorted_inds]
+    clear_inds = clear_inds[sorted_inds]
+    unique_dark_inds, group_starts = np.unique(dark_inds, return_index=True)
+    for dark_ind, clear_group in zip(unique_dark_inds, np.split(clear_inds, group_starts[1:])):
+        dark_shapes[dark_ind] = dark_shapes[dark_ind].difference(unary_union([clear_shapes[ind] for ind in clear_group]))
+
+    if debug:
+        num_pairs = len(dark_shapes) * len(clear_shapes)
+        print(f"Clear polarity: {num_pairs} dark/clear pairs, {num_pairs - num_intersecting} not intersecting, "
+              f"{num_intersecting - len(dark_inds)} dark shapes drawn after the clear shape (not erased), {len(dark_inds)} subtracted")
+
+    return dark_shapes
+
+def subdivide_toolpath_to_height_map(toolpath: Toolpath, 
+        height_map: HeightMap, 
+        z_tolerance: float, 
+        Z_offset_from_0: float = 0, 
+        resolution: int = DEFAULT_RESOLUTION, 
+        max_depth: int = 16) -> Toolpath:
+    '''
+    Adds vertices to the segments of the toolpath where the height map surface deviates from the straight segment
+    by more than z_tolerance, so the tool follows the surface between the original vertices.
+
+    Like Douglas-Peucker, each segment (all segments at once) is split at the point where the surface deviates
+    the most from it until every sub segment is within z_tolerance of the surface.
+    Segments over flat (or planar) areas aren't split at all.
+
+    :param toolpath: Toolpath with Z already applied from the height map
+    :param height_map: the height map
+    :param z_tolerance: maximum allowed Z deviation from the surface between two vertices in mm
+    :param Z_offset_from_0: the Z offset added to the height map surface
+    :param resolution: the number of decimal places for the added coordinates
+    :param max_depth: maximum number of times a segment is split
+    :return: new Toolpath with the added vertices
+    '''
+    coords = toolpath.coords
+    offsets = toolpath.offsets
+
+    # every vertex that isn't the last of its loop starts a segment
+    is_segment_start = np.ones(len(coords), dtype=bool)
+    is_segment_start[offsets[1:] - 1] = False
+    segment_starts = np.flatnonzero(is_segment_start)
+    segment_vectors = coords[segment_starts+1, :2] - coords[segment_starts, :2]
+
+    # each interval is a part of a segment: (segment index, t start, t end) where t goes from 0 to 1 along the segment
+    segment_inds = np.arange(len(segment_starts))
+    t_starts = np.zeros(len(segment_starts))
+    t_ends = np.ones(len(segment_starts))
+
+    added_segment_inds = []
+    added_ts = []
+    for _ in range(max_depth):
+        if not len(segment_inds):
+            break
+
+        starts = coords[segment_starts[segment_inds], :2]
+        vectors = segment_vectors[segment_inds]
+        deviation, fraction = height_map.max_chord_deviation(starts + t_starts[:, None]*vectors, starts + t_ends[:, None]*vectors)
+
+        # splitting the intervals that deviate too much where they deviate the most
+        split = deviation > z_tolerance
+        segment_inds, t_starts, t_ends = segment_inds[split], t_starts[split], t_ends[split]
+        t_splits = t_starts + fraction[split]*(t_ends - t_starts)
+        added_segment_inds.append(segment_inds)
+        added_ts.append(t_splits)
+
+        segment_inds = np.concatenate((segment_inds, segment_inds))
+        t_starts, t_ends = np.concatenate((t_starts, t_splits)), np.concatenate((t_splits, t_ends))
+
+    if not sum(len(inds) for inds in added_segment_inds):
+        return toolpath
+
+    ### Creating the added vertices
+    added_segment_inds = np.concatenate(added_segment_inds)
+    added_ts = np.concatenate(added_ts)
+    added_coords = np.zeros((len(added_ts), 3))
+    added_coords[:, :2] = np.round(coords[segment_starts[added_segment_inds], :2] + added_ts[:, None]*segment_vectors[added_segment_inds], resolution)
+    added_coords[:, 2] = height_map.get_z(added_coords[:, 0], added_coords[:, 1]) + Z_offset_from_0
+
+    ### Merging them in between the original vertices, sorted by the vertex they come after then by t
+    vertex_inds = np.concatenate((np.arange(len(coords)), segment_starts[added_segment_inds]))
+    ts = np.concatenate((np.zeros(len(coords)), added_ts))
+    order = np.lexsort((ts, vertex_inds))
+
+    loop_inds = np.repeat(np.arange(len(toolpath)), np.diff(offsets))
+    new_offsets = np.zeros(len(offsets), dtype=np.intp)
+    np.cumsum(np.bincount(loop_inds[vertex_inds], minlength=len(toolpath)), out=new_offsets[1:])
+
+    return Toolpath(np.concatenate((coords, added_coords))[order], new_offsets)
+
+def douglas_peucker_mask(toolpath: Toolpath, tolerance: float) -> np.ndarray:
+    '''
+    Douglas-Peucker on every loop at once: each interval (starting with the whole loop) is split at its vertex furthest
+    (in 3D so Z bends are kept too) from the straight segment joining its ends until every vertex left out is within tolerance.
+
+    :param toolpath: the Toolpath
+    :param tolerance: maximum distance in mm between a removed vertex and the simplified path
+    :return: (N,) bool array of the vertices to keep, the first and last vertex of every loop are always kept
+    '''
+    coords = toolpath.coords
+    keep = np.zeros(len(coords), dtype=bool)
+    starts, ends = toolpath.offsets[:-1], toolpath.offsets[1:] - 1
+    non_empty = ends >= starts
+    starts, ends = starts[non_empty], ends[non_empty]
+    keep[starts] = True
+    keep[ends] = True
+
+    while True:
+        num_inside = ends - starts - 1
+        has_inside = num_inside > 0
+        starts, ends, num_inside = starts[has_inside], ends[has_inside], num_inside[has_inside]
+        if not len(starts):
+            break
+
+        # every vertex inside an interval, with the interval it's in
+        interval_inds = np.repeat(np.arange(len(starts)), num_inside)
+        first_inside = np.zeros(len(starts), dtype=np.intp)
+        np.cumsum(num_inside[:-1], out=first_inside[1:])
+        vertex_inds = np.arange(len(interval_inds)) - first_inside[interval_inds] + starts[interval_inds] + 1
+
+        # distance to the segment (not the line, so spikes going back along it are kept)
+        a = coords[starts[interval_inds]]
+        ab = coords[ends[interval_inds]] - a
+        ap = coords[vertex_inds] - a
+        t = np.clip(np.einsum('ij,ij->i', ap, ab)/np.maximum(np.einsum('ij,ij->i', ab, ab), 1e-300), 0, 1)
+        distances = np.linalg.norm(ap - t[:, None]*ab, axis=1)
+
+        # the furthest vertex of each interval
+        max_distances = np.maximum.reduceat(distances, first_inside)
+        furthest = np.flatnonzero(distances == max_distances[interval_inds])
+        _, first_furthest = np.unique(interval_inds[furthest], return_index=True)
+        split_inds = vertex_inds[furthest[first_furthest]]
+
+        split = max_distances > tolerance
+        split_inds = split_inds[split]
+        keep[split_inds] = True
+        starts, ends = np.concatenate((starts[split], split_inds)), np.concatenate((split_inds, ends[split]))
+
+    return keep
+
+def min_segment_length_mask(toolpath: Toolpath, min_segment_length: float) -> np.ndarray:
+    '''
+    Marks the vertices reached by a segment shorter than min_segment_length for removal.
+    Removing one lengthens the next segment, so every pass only removes every other vertex of a run of short segments
+    and the passes go on until no short segment is left (or only ones ending a loop)
+
+    :param toolpath: the Toolpath
+    :param min_segment_length: minimum segment length in mm
+    :return: (N,) bool array of the vertices to keep, the first and last vertex of every loop are always kept
+    '''
+    coords = toolpath.coords
+    offsets = toolpath.offsets
+    loop_inds = np.repeat(np.arange(len(toolpath)), np.diff(offsets))
+    keep = np.ones(len(coords), dtype=bool)
+
+    is_end = np.zeros(len(coords), dtype=bool)
+    is_end[offsets[:-1][np.diff(offsets) > 0]] = True
+    is_end[offsets[1:][np.diff(offsets) > 0] - 1] = True
+
+    while True:
+        kept = np.flatnonzero(keep)
+        lengths = np.zeros(len(kept))
+        lengths[1:] = np.linalg.norm(coords[kept[1:]] - coords[kept[:-1]], axis=1)
+
+        # a short segment reaching the end of a loop removes the vertex before instead
+        is_short = (lengths < min_segment_length) & (loop_inds[kept] == np.roll(loop_inds[kept], 1)) & (np.arange(len(kept)) > 0)
+        candidates = is_short & ~is_end[kept]
+        ends_short = np.flatnonzero(is_short & is_end[kept])
+        candidates[ends_short - 1] |= ~is_end[kept[ends_short - 1]]
+        if not candidates.any():
+            break
+
+        # the vertices at an even position of each run of candidates
+        run_starts = candidates & ~np.concatenate(([False], candidates[:-1]))
+        run_position = np.arange(len(kept)) - np.maximum.accumulate(np.where(run_starts, np.arange(len(kept)), 0))
+        keep[kept[candidates & (run_position % 2 == 0)]] = False
+
+    return keep
+
+def simplify_toolpath(toolpath: Toolpath, 
+        tolerance: float, 
+        min_segment_length: float = 0, 
+        resolution: int = DEFAULT_RESOLUTION, 
+        debug: bool = False) -> tuple[Toolpath, dict[str, int]]:
+    '''
+    Removes the vertices that don't change the toolpath shape by more than tolerance. Long runs of tiny segments starve
+    the GRBL planner (it can't look ahead far enough to keep the feedrate up), so the machine stutters.
+
+    Step-1: collinear merge, vertices within the coordinate resolution of the segment joining their neighbours
+    Step-2: Douglas-Peucker with tolerance
+    Step-3: vertices reached by a segment shorter than min_segment_length
+    Step-4: loops that stop being simple (start crossing themselves) or collapse are restored as they were
+    Step-5: loops that now cross or touch a neighbouring loop they were apart from are restored, with the neighbour if simplified too
+    Done :D
+
+    :param toolpath: the Toolpath
+    :param tolerance: maximum distance in mm between a removed vertex and the simplified path, 0 to skip Douglas-Peucker
+    :param min_segment_length: minimum segment length in mm, 0 to skip
+    :param resolution: the number of decimal places for coordinates
+    :param debug: print the number of G-code lines removed by each step
+    :return: the simplified Toolpath and the number of vertices (G-code lines) removed by each step
+    '''
+    steps = ('collinear', 'douglas_peucker', 'min_segment_length')
+    removed_by = np.full(toolpath.num_vertices, -1)
+
+    ### Step 1, 2 and 3
+    simplified = toolpath
+    original_inds = np.arange(toolpath.num_vertices)
+    for step_ind, step_tolerance in enumerate((10**-resolution, tolerance, min_segment_length)):
+        if not step_tolerance or not simplified.num_vertices:
+            continue
+
+        if steps[step_ind] == 'min_segment_length':
+            keep = min_segment_length_mask(simplified, step_tolerance)
+        else:
+            keep = douglas_peucker_mask(simplified, step_tolerance)
+
+        removed_by[original_inds[~keep]] = step_ind
+        simplified = simplified.keep_vertices(keep)
+        original_inds = original_inds[keep]
+
+    ### Step 4: restoring the loops that collapsed or now cross themselves
+    loop_lengths = np.diff(toolpath.offsets)
+    simplified_loop_lengths = np.diff(simplified.offsets)
+    is_restored = (simplified_loop_lengths < 4) & (simplified_loop_lengths < loop_lengths)
+
+    checked = ~is_restored & (simplified_loop_lengths < loop_lengths)
+    if checked.any():
+        def rings(path: Toolpath) -> np.ndarray:
+            loop_inds = np.repeat(np.arange(len(path)), np.diff(path.offsets))
+            in_checked = checked[loop_inds]
+            return shapely.linearrings(path.coords[in_checked, :2], indices=(np.cumsum(checked) - 1)[loop_inds[in_checked]])
+
+        is_restored[checked] = shapely.is_simple(rings(toolpath)) & ~shapely.is_simple(rings(simplified))
+
+    ### Step 5: restoring the loops simplified into their neighbours
+    # a simplified loop keeps a subset of its vertices so it stays in the bounding box of the original loop,
+    # the neighbours to check are the original loops whose bounding boxes overlap
+    is_simplified = ~is_restored & (simplified_loop_lengths < loop_lengths)
+    if is_simplified.any() and len(toolpath) > 1:
+        def lines(path: Toolpath) -> np.ndarray:
+            # one LineString per loop, None for the loops without a segment
+            lengths = np.diff(path.offsets)
+            loop_inds = np.repeat(np.arange(len(path)), lengths)
+            has_line = lengths >= 2
+            in_line = has_line[loop_inds]
+            path_lines = np.full(len(path), None, dtype=object)
+            path_lines[has_line] = shapely.linestrings(path.coords[in_line, :2], indices=(np.cumsum(has_line) - 1)[loop_inds[in_line]])
+            return path_lines
+
+        original_lines, simplified_lines = lines(toolpath), lines(simplified)
+        simplified_inds = np.flatnonzero(is_simplified)
+        loops_a, loops_b = shapely.STRtree(original_lines).query(original_lines[simplified_inds])
+        loops_a = simplified_inds[loops_a]
+        is_apart = (loops_a != loops_b) & ~shapely.intersects(original_lines[loops_a], original_lines[loops_b])
+        loops_a, loops_b = loops_a[is_apart], loops_b[is_apart]
+
+        # restoring a loop can make it cross a simplified neighbour in turn
+        while len(loops_a):
+            current_lines = np.where(is_simplified, simplified_lines, original_lines)
+            is_crossing = shapely.intersects(current_lines[loops_a], current_lines[loops_b])
+            if not is_crossing.any():
+                break
+
+            is_restored[loops_a[is_crossing]] = True
+            is_restored[loops_b[is_crossing]] |= is_simplified[loops_b[is_crossing]]
+            is_simplified &= ~is_restored
+
+            is_active = is_simplified[loops_a] | is_simplified[loops_b]
+            loops_a, loops_b = loops_a[is_active], loops_b[is_active]
+
+    vertex_loop_inds = np.repeat(np.arange(len(toolpath)), loop_lengths)
+    removed_by[is_restored[vertex_loop_inds]] = -1
+
+    removed = dict(zip(steps, np.bincount(removed_by[removed_by >= 0], minlength=len(steps)).tolist()))
+    if debug:
+        print(f"Toolpath simplification removed {removed['collinear']} collinear, {removed['douglas_peucker']} Douglas-Peucker "
+              f"and {removed['min_segment_length']} short segment vertices from {toolpath.num_vertices}, restored {is_restored.sum()} loops")
+
+    return toolpath.keep_vertices(removed_by < 0), removed
+
+def get_circumcircles(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    vectorized circle through each triplet of 2D points
+
+    :param a, b, c: (n, 2) arrays of points
+    :return: (n, 2) centers, (n,) radii and (n,) turn direction, +1 counter clockwise (left turn), -1 clockwise, 0 collinear (center and radius are inf)
+    '''
+    # relative to b so the determinant doesn't lose precision far from the origin
+    ba, bc = a - b, c - b
+    cross = ba[..., 0]*bc[..., 1] - ba[..., 1]*bc[..., 0]
+    ba_squared, bc_squared = np.einsum('...i,...i->...', ba, ba), np.einsum('...i,...i->...', bc, bc)
+
+    is_collinear = np.abs(cross) <= 1e-12*np.sqrt(ba_squared*bc_squared)
+    d = np.where(is_collinear, np.inf, 2*cross)
+    offsets = np.stack(((bc[..., 1]*ba_squared - ba[..., 1]*bc_squared)/d, (ba[..., 0]*bc_squared - bc[..., 0]*ba_squared)/d), axis=-1)
+    centers = np.where(is_collinear[..., None], np.inf, b + offsets)
+    radii = np.where(is_collinear, np.inf, np.linalg.norm(offsets, axis=-1))
+
+    return centers, radii, -np.sign(cross)*~is_collinear
+
+def fit_arcs(toolpath: Toolpath, tolerance: float, min_points: int = 4, max_sweep: float = math.pi) -> list[list[tuple[int, int, tuple[float, float], bool]]]:
+    '''
+    Finds the runs of consecutive vertices of every loop that lie on a circular arc, so they can be a single G2/G3 move.
+
+    Step-1: circle through every 3 consecutive vertices of all loops at once, neighbouring triplets turning the same way
+            around about the same circle are candidate runs, every other vertex stays a straight line
+    Step-2: each candidate run is greedily cut into the longest arcs that fit, the arc is the circle through the first,
+            middle and last vertex of the part and it fits if every vertex is within tolerance of it, every chord is within
+            tolerance of it (a few points on a circle aren't an arc, e.g. the corners of a square) and Z is linear
+            along it (GRBL helical arc)
+    Done :D
+
+    :param toolpath: the Toolpath
+    :param tolerance: maximum distance in mm between the arcs and the original path
+    :param min_points: minimum number of vertices replaced by an arc
+    :param max_sweep: maximum angle of one arc in radians
+    :return: for each loop, list of (start index, end index, center, clockwise) with indices in the loop,
+             arcs are in order and the end of one can be the start of the next
+    '''
+    arcs = [[] for _ in range(len(toolpath))]
+    if toolpath.num_vertices < max(min_points, 3) or not tolerance:
+        return arcs
+
+    coords = toolpath.coords
+    xy = coords[:, :2]
+    loop_inds = np.repeat(np.arange(len(toolpath)), np.diff(toolpath.offsets))
+
+    ### Step 1: candidate runs
+    centers, radii, turns = get_circumcircles(xy[:-2], xy[1:-1], xy[2:])
+    with np.errstate(invalid='ignore'):
+        half_chords = np.linalg.norm(np.diff(xy, axis=0), axis=1)/2
+        sagittas = radii - np.sqrt(np.maximum(radii**2 - np.maximum(half_chords[:-1], half_chords[1:])**2, 0))
+        is_arc_like = (turns != 0) & (sagittas <= tolerance) & (loop_inds[:-2] == loop_inds[2:])
+
+        # the local centers are only a filter (rounded coordinates make them jitter on short chords), the final fit is exact
+        linked = (is_arc_like[:-1] & is_arc_like[1:] & (turns[:-1] == turns[1:]) 
+                  & (np.linalg.norm(np.diff(centers, axis=0), axis=1) <= 4*tolerance) & (np.abs(np.diff(radii)) <= 4*tolerance))
+
+    # a run of links k0..k1 joins the triplets k0..k1+1 which cover the vertices k0..k1+3
+    edges = np.diff(np.concatenate(([0], linked.astype(np.int8), [0])))
+    run_starts, run_ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) + 2
+
+    def fit(start: int, end: int) -> Optional[tuple[tuple[float, float], bool]]:
+        # circle through the first, middle and last vertex
+        (ax, ay), (bx, by), (cx, cy) = xy[start].tolist(), xy[(start + end)//2].tolist(), xy[end].tolist()
+        cross = (bx - ax)*(cy - by) - (by - ay)*(cx - bx)
+        if cross == 0:
+            return None
+
+        a_squared, b_squared, c_squared = ax*ax + ay*ay, bx*bx + by*by, cx*cx + cy*cy
+        d = 2*(ax*(by - cy) + bx*(cy - ay) + cx*(ay - by))
+        center = ((a_squared*(by - cy) + b_squared*(cy - ay) + c_squared*(ay - by))/d,
+                  (a_squared*(cx - bx) + b_squared*(ax - cx) + c_squared*(bx - ax))/d)
+        turn = 1 if cross > 0 else -1
+
+        vectors = xy[start:end+1] - center
+        distances = np.sqrt(vectors[:, 0]**2 + vectors[:, 1]**2)
+        radius = distances[0]
+        if np.abs(distances - radius).max() > tolerance:
+            return None
+
+        steps = np.diff(np.arctan2(vectors[:, 1], vectors[:, 0]))
+        steps = (steps + math.pi) % (2*math.pi) - math.pi
+        if not np.all(steps*turn > 0):
+            return None
+
+        abs_steps = np.abs(steps)
+        sweep = abs_steps.sum()
+        if sweep > max_sweep or radius*(1 - math.cos(abs_steps.max()/2)) > tolerance:
+            return None
+
+        if coords.shape[1] > 2:
+            z = coords[start:end+1, 2]
+            along = np.concatenate(([0], np.cumsum(abs_steps)))/sweep
+            if np.abs(z - (z[0] + along*(z[-1] - z[0]))).max() > tolerance:
+                return None
+
+        return center, turn < 0
+
+    ### Step 2: cutting each run into the longest arcs that fit
+    for run_start, run_end in zip(run_starts.tolist(), run_ends.tolist()):
+        loop_ind = int(loop_inds[run_start])
+        loop_start = int(toolpath.offsets[loop_ind])
+
+        start = run_start
+        while run_end - start + 1 >= min_points:
+            end = start + min_points - 1
+            arc = fit(start, end)
+            if arc is None:
+                start += 1
+                continue
+
+            # doubling the arc length until it doesn't fit then bisecting
+            step, too_long = min_points, None
+            while end < run_end:
+                candidate = min(end + step, run_end)
+                candidate_arc = fit(start, candidate)
+                if candidate_arc is None:
+                    too_long = candidate
+                    break
+                end, arc, step = candidate, candidate_arc, step*2
+
+            while too_long is not None and too_long - end > 1:
+                candidate = (end + too_long)//2
+                candidate_arc = fit(start, candidate)
+                if candidate_arc is None:
+                    too_long = candidate
+                else:
+                    end, arc = candidate, candidate_arc
+
+            arcs[loop_ind].append((start - loop_start, end - loop_start, *arc))
+            start = end
+
+    return arcs
+
+def reverse_arcs(arcs: list[tuple[int, int, tuple[float, float], bool]], num_vertices: int) -> list[tuple[int, int, tuple[float, float], bool]]:
+    '''
+    gets the arcs of a loop (see fit_arcs()) for the same loop walked backwards (loop[::-1])
+
+    :param arcs: the arcs of the loop
+    :param num_vertices: number of vertices in the loop
+    '''
+    return [(num_vertices - 1 - end, num_vertices - 1 - start, center, not clockwise) for start, end, center, clockwise in arcs[::-1]]
+
+def get_rapid_distance(toolpath: Toolpath, start: tuple[float, float] = (0, 0)) -> float:
+    '''
+    XY distance travelled (rapid moves) from start to the first loop then from the end of each loop to the start of the next
+
+    :param toolpath: the Toolpath, no empty loops
+    :param start: where the tool is before the first loop
+    '''
+    if not len(toolpath):
+        return 0.0
+
+    loop_starts = toolpath.coords[toolpath.offsets[:-1], :2]
+    loop_ends = toolpath.coords[toolpath.offsets[1:] - 1, :2]
+    previous_ends = np.vstack((start, loop_ends[:-1]))
+
+    return float(np.linalg.norm(loop_starts - previous_ends, axis=1).sum())
+
+def get_nearest_neighbours(points: np.ndarray, k: int) -> np.ndarray:
+    '''
+    the k nearest other points of every point, brute force with numpy for small point counts (a block of rows at a time)
+    and a KD-tree above NUMPY_NEIGHBOUR_POINT_COUNT
+
+    :param points: (n, 2) X, Y array
+    :param k: number of neighbours, at most n - 1
+    :return: (n, k) indices of the neighbours of each point, nearest first
+    '''
+    k = min(k, len(points) - 1)
+    if len(points) > NUMPY_NEIGHBOUR_POINT_COUNT:
+        from scipy.spatial import cKDTree
+        return cKDTree(points).query(points, k=k + 1)[1][:, 1:]
+
+    nearest = np.empty((len(points), k), dtype=np.intp)
+    if k <= 0:
+        return nearest
+
+    for row_start in range(0, len(points), 256):
+        rows = points[row_start:row_start+256]
+        distances = (rows[:, None, 0] - points[None, :, 0])**2 + (rows[:, None, 1] - points[None, :, 1])**2
+        distances[np.arange(len(rows)), np.arange(row_start, row_start + len(rows))] = np.inf  # not itself
+
+        candidates = np.argpartition(distances, k - 1, axis=1)[:, :k] if k < len(points) - 1 else np.argsort(distances, axis=1)[:, :k]
+        candidates_order = np.argsort(np.take_along_axis(distances, candidates, axis=1), axis=1, kind='stable')
+        nearest[row_start:row_start+len(rows)] = np.take_along_axis(candidates, candidates_order, axis=1)
+
+    return nearest
+
+def nearest_neighbour_tour(points: np.ndarray, 
+        groups: Optional[np.ndarray] = None, 
+        start: tuple[float, float] = (0, 0), 
+        exits: Optional[np.ndarray] = None) -> np.ndarray:
+    '''
+    Greedy nearest neighbour path: from start go to the nearest point left, then the nearest to that one and so on.
+    With groups, visiting a point visits its whole group (e.g. the vertices of a loop) so only one point of each group is visited.
+    Up to NUMPY_NEIGHBOUR_POINT_COUNT points, every step measures the distance to all the points left with numpy.
+    Above, visited points stay in a KD-tree (lazy deletion) until they are half of it, then it's rebuilt with the rest
+
+    :param points: (n, 2) X, Y array
+    :param groups: (n,) group index of every point (0 to number of groups - 1), default every point is its own group
+    :param start: where the path starts
+    :param exits: (n,) index of the point the path continues from after visiting each point, e.g. the other end of
+                  an open path entered at one end. Default the visited point itself
+    :return: indices of the visited points in order, one per group
+    '''
+    groups = np.arange(len(points)) if groups is None else np.asarray(groups, dtype=np.intp)
+    group_sizes = np.bincount(groups)
+    if not len(points):
+        return np.zeros(0, dtype=np.intp)
+
+    visited = []
+    is_left = group_sizes > 0
+    if len(points) <= NUMPY_NEIGHBOUR_POINT_COUNT:
+        xs, ys = np.ascontiguousarray(points[:, 0], dtype=float), np.ascontiguousarray(points[:, 1], dtype=float)
+        distances_left = np.zeros(len(points))  # inf once visited
+        position = start
+        for _ in range(int(is_left.sum())):
+            point = int(np.argmin((xs - position[0])**2 + (ys - position[1])**2 + distances_left))
+            visited.append(point)
+            is_left[groups[point]] = False
+            distances_left[groups == groups[point]] = np.inf
+            position = points[point if exits is None else exits[point]]
+
+        return np.array(visited, dtype=np.intp)
+
+    from scipy.spatial import cKDTree
+
+    tree_inds = np.arange(len(points))
+    tree = cKDTree(points)
+    num_visited_in_tree = 0
+    position = start
+    for _ in range(int(is_left.sum())):
+        k = 8
+        while True:
+            _, nearest = tree.query(position, k=min(k, len(tree_inds)))
+            nearest = tree_inds[np.atleast_1d(nearest)]
+            is_left_nearest = is_left[groups[nearest]]
+            if is_left_nearest.any() or k >= len(tree_inds):
+                break
+            k *= 4
+
+        point = nearest[np.argmax(is_left_nearest)]
+        visited.append(point)
+        is_left[groups[point]] = False
+        position = points[point if exits is None else exits[point]]
+
+        num_visited_in_tree += group_sizes[groups[point]]
+        if is_left.any() and num_visited_in_tree*2 > len(tree_inds):
+            tree_inds = np.flatnonzero(is_left[groups])
+            tree = cKDTree(points[tree_inds])
+            num_visited_in_tree = 0
+
+    return np.array(visited, dtype=np.intp)
+
+def serpentine_order(points: np.ndarray, start: tuple[float, float] = (0, 0)) -> np.ndarray:
+    '''
+    Boustrophedon order: the points are cut into horizontal strips, bottom to top (or top to bottom, whichever is nearer start)
+    and each strip is walked in the opposite X direction to the previous one.
+    About sqrt(n / 2) strips, so a strip is roughly as long as its points are apart. Instant for any number of points
+
+    :param points: (n, 2) X, Y array
+    :param start: where the path starts
+    :return: the visiting order
+    '''
+    if len(points) < 2:
+        return np.arange(len(points))
+
+    (x_min, y_min), (x_max, y_max) = points.min(axis=0), points.max(axis=0)
+    num_strips = max(int(math.ceil(math.sqrt(len(points) / 2))), 1)
+    strips = np.minimum(((points[:, 1] - y_min) / max(y_max - y_min, 1e-9) * num_strips).astype(np.intp), num_strips - 1)
+    if abs(start[1] - y_max) < abs(start[1] - y_min):
+        strips = num_strips - 1 - strips
+
+    # starting the first strip from the side nearer start
+    x_sign = 1 if abs(start[0] - x_min) <= abs(start[0] - x_max) else -1
+    x_keys = np.where(strips % 2 == 0, x_sign, -x_sign) * points[:, 0]
+
+    return np.lexsort((x_keys, strips))
+
+def two_opt(points: np.ndarray, 
+        order: Optional[np.ndarray] = None, 
+        start: tuple[float, float] = (0, 0), 
+        neighbours: int = 8, 
+        time_budget: float = 1) -> np.ndarray:
+    '''
+    Shortens the open path starting at start and visiting every point once by reversing parts of it (2-opt).
+    Only the moves joining a point to one of its nearest neighbours are tried (neighbour lists), the others hardly ever help
+
+    :param points: (n, 2) X, Y array
+    :param order: the visiting order to improve (e.g. nearest neighbour), default the given order
+    :param start: where the path starts, it isn't part of the order
+    :param neighbours: number of nearest neighbours tried for each point
+    :param time_budget: stops improving after this many seconds, the path is still valid
+    :return: the improved visiting order
+    '''
+    order = np.arange(len(points)) if order is None else np.asarray(order, dtype=np.intp)
+    if len(order) < 3:
+        return order
+    deadline = time.perf_counter() + time_budget
+
+    # node 0 is the start, node i+1 is points[i]
+    nodes = np.vstack((start, points)).tolist()
+    path = np.concatenate(([0], order + 1))
+    positions = np.empty(len(path), dtype=np.intp)
+    positions[path] = np.arange(len(path))
+    last = len(path) - 1
+
+    nearest = get_nearest_neighbours(np.array(nodes), neighbours).tolist()
+
+    def distance(u: int, v: int) -> float:
+        return math.dist(nodes[u], nodes[v])
+
+    def reverse(i: int, j: int) -> None:
+        path[i:j+1] = path[i:j+1][::-1]
+        positions[path[i:j+1]] = np.arange(i, j+1)
+
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for a in range(len(nodes)):
+            i = positions[a]
+            b = path[i+1] if i < last else None
+            a_b = distance(a, b) if b is not None else 0
+
+            for c in nearest[a]:
+                j = positions[c]
+
+                # a -> b ... c -> d becomes a -> c ... b -> d
+                if j > i + 1:
+                    d = path[j+1] if j < last else None
+                    gain = a_b - distance(a, c) + (distance(c, d) - distance(b, d) if d is not None else 0)
+                    if gain > 1e-9:
+                        reverse(i+1, j)
+                        improved = True
+                        break
+
+                # c -> d ... a -> b becomes c -> a ... d -> b
+                elif j < i - 1:
+                    d = path[j+1]
+                    gain = distance(c, d) - distance(c, a) + (a_b - distance(d, b) if b is not None else 0)
+                    if gain > 1e-9:
+                        reverse(j+1, i)
+                        improved = True
+                        break
+
+            if time.perf_counter() > deadline:
+                break
+
+    return path[1:] - 1
+
+def order_toolpath(toolpath: Toolpath, 
+        start: tuple[float, float] = (0, 0), 
+        reverse: bool = False,
+        time_budget: float = 1,
+        debug: bool = False) -> tuple[Toolpath, tuple[float, float]]:
+    '''
+    Orders the closed loops of a toolpath to shorten the rapid moves between them. Each loop is rotated to start (its seam)
+    at the vertex nearest the end of the previous loop, closed loops end where they start.
+
+    Step-1: greedy nearest neighbour, from the tool go to the nearest vertex of any loop left (KD-tree of the vertices)
+    Step-2: 2-opt on the seams, then the seams are chosen again for the new order, repeated while it gets shorter
+            and time_budget isn't used up
+    Step-3: rotating (and reversing) the loops
+    Done :D
+
+    :param toolpath: the Toolpath, every loop closed (first vertex repeated at the end)
+    :param start: where the tool is before the first loop
+    :param reverse: walk every loop backwards, e.g. with Toolpath.from_polygons() loops the polygon is on the left and
+                    reversing puts it on the right (climb milling with a clockwise spindle)
+    :param time_budget: seconds given to 2-opt, 0 for only nearest neighbour
+    :param debug: print the rapid distance before and after
+    :return: the ordered Toolpath and the rapid distance in mm before and after
+    '''
+
+    lengths = np.diff(toolpath.offsets)
+    loop_inds = np.flatnonzero(lengths)
+    before = get_rapid_distance(toolpath.reorder(loop_inds), start)
+    if len(loop_inds) < 2 and not reverse:
+        return toolpath, (before, before)
+
+    # the distinct vertices of every loop (without the closing one) and the loop they belong to
+    vertex_lengths = np.maximum(lengths[loop_inds] - 1, 1)
+    vertex_loops = np.repeat(np.arange(len(loop_inds)), vertex_lengths)
+    vertex_inds = np.arange(len(vertex_loops)) - np.repeat(np.cumsum(vertex_lengths) - vertex_lengths, vertex_lengths)
+    vertices = toolpath.coords[toolpath.offsets[loop_inds][vertex_loops] + vertex_inds, :2]
+
+    ### Step 1: nearest neighbour
+    visited = nearest_neighbour_tour(vertices, vertex_loops, start)
+    order, seams = vertex_loops[visited], vertex_inds[visited]
+
+    vertex_offsets = np.concatenate(([0], np.cumsum(vertex_lengths)))
+    def get_seams_distance(order: np.ndarray) -> tuple[np.ndarray, float]:
+        # the seam of each loop is its vertex nearest the seam of the previous loop
+        seams, total = np.zeros(len(order), dtype=np.intp), 0.0
+        position = np.asarray(start, dtype=float)
+        for ind, loop in enumerate(order.tolist()):
+            distances = np.linalg.norm(vertices[vertex_offsets[loop]:vertex_offsets[loop+1]] - position, axis=1)
+            seams[ind] = np.argmin(distances)
+            total += float(distances[seams[ind]])
+            position = vertices[vertex_offsets[loop] + seams[ind]]
+        return seams, total
+
+    ### Step 2: 2-opt
+    after = float(np.linalg.norm(np.diff(np.vstack((start, vertices[vertex_offsets[order] + seams])), axis=0), axis=1).sum())
+    deadline = time.perf_counter() + time_budget
+    while time_budget and time.perf_counter() < deadline:
+        new_order = order[two_opt(vertices[vertex_offsets[order] + seams], start=start, time_budget=deadline - time.perf_counter())]
+        new_seams, new_after = get_seams_distance(new_order)
+        if new_after >= after - 1e-9:
+            break
+        order, seams, after = new_order, new_seams, new_after
+
+    ### Step 3: rotating the loops
+    ordered = toolpath.reorder(loop_inds[order], seams, np.full(len(order), reverse))
+    if debug:
+        print(f"Travel optimization: rapid moves between {len(order)} loops {before:.1f} mm -> {after:.1f} mm")
+
+    return ordered, (before, after)
+
+def order_open_paths(toolpath: Toolpath, start: tuple[float, float] = (0, 0), debug: bool = False) -> tuple[Toolpath, tuple[float, float]]:
+    '''
+    Orders the open loops of a toolpath (e.g. hatch segments) to shorten the rapid moves between them by nearest neighbour,
+    each loop can be entered at either end and is reversed when entered at its last vertex
+
+    :param toolpath: the Toolpath, no empty loops
+    :param start: where the tool is before the first loop
+    :param debug: print the rapid distance before and after
+    :return: the ordered Toolpath and the rapid distance in mm before and after
+    '''
+    before = get_rapid_distance(toolpath, start)
+
+    # point 2i is the start of loop i and point 2i + 1 its end, leaving from the other one
+    ends = np.empty((2 * len(toolpath), 2))
+    ends[0::2] = toolpath.coords[toolpath.offsets[:-1], :2]
+    ends[1::2] = toolpath.coords[toolpath.offsets[1:] - 1, :2]
+    visited = nearest_neighbour_tour(ends, np.arange(len(ends)) // 2, start, exits=np.arange(len(ends)) ^ 1)
+
+    ordered = toolpath.reorder(visited // 2, reverse=visited % 2 == 1)
+    after = get_rapid_distance(ordered, start)
+    if debug:
+        print(f"Travel optimization: rapid moves between {len(ordered)} paths {before:.1f} mm -> {after:.1f} mm")
+
+    return ordered, (before, after)
+
+def order_points(points: np.ndarray, 
+        start: tuple[float, float] = (0, 0), 
+        time_budget: float = 1, 
+        max_points: int = SERPENTINE_POINT_COUNT, 
+        debug: bool = False) -> tuple[np.ndarray, tuple[float, float]]:
+    '''
+    Orders points (e.g. holes to drill) to shorten the rapid moves between them: nearest neighbour then 2-opt
+    with time_budget, or a serpentine order when there are more than max_points
+
+    :param points: (n, 2) X, Y array
+    :param start: where the tool is before the first point
+    :param time_budget: seconds given to 2-opt, 0 for only nearest neighbour
+    :param max_points: above this many points only the serpentine order is used
+    :param debug: print the rapid distance before and after
+    :return: the visiting order and the rapid distance in mm before and after
+    '''
+    def path_length(order: np.ndarray) -> float:
+        return float(np.linalg.norm(np.diff(np.vstack((start, points[order])), axis=0), axis=1).sum())
+
+    before = path_length(np.arange(len(points)))
+    if len(points) > max_points:
+        order = serpentine_order(points, start)
+    else:
+        order = nearest_neighbour_tour(points, start=start)
+        if time_budget:
+            order = two_opt(points, order, start, time_budget=time_budget)
+
+    # never worse than as given
+    after = path_length(order)
+    if after > before:
+        order, after = np.arange(len(points)), before
+
+    if debug:
+        print(f"Travel optimization: rapid moves between {len(points)} points {before:.1f} mm -> {after:.1f} mm")
+
+    return order, (before, after)
+
+def get_scanline_spans(toolpath: Toolpath, y_start: float, spacing: float, num_lines: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Intersects the horizontal lines y = y_start + (line + 0.5) * spacing with the closed loops of a toolpath (even-odd rule,
+    e.g. a from_polygons() Toolpath). Every crossing of every line with every loop segment is found at once,
+    sorted along the lines and paired up into the spans inside the loops
+
+    :param toolpath: the Toolpath, every loop closed
+    :param y_start: y of the bottom of the first line
+    :param spacing: distance between the lines
+    :param num_lines: number of lines
+    :return: line index, start X and end X of every span, sorted by line then X
+    '''
+    if toolpath.num_vertices < 2:
+        return np.zeros(0, dtype=np.intp), np.zeros(0), np.zeros(0)
+
+    # segments of every loop, not the ones joining the end of a loop to the start of the next
+    is_segment = np.ones(toolpath.num_vertices - 1, dtype=bool)
+    is_segment[toolpath.offsets[1:-1] - 1] = False
+    starts, ends = toolpath.coords[:-1, :2][is_segment], toolpath.coords[1:, :2][is_segment]
+
+    # lines whose y is in [min y, max y) of a segment, half open so a vertex is crossed once
+    def to_line(y: np.ndarray) -> np.ndarray:
+        return np.clip(np.ceil((y - y_start) / spacing - 0.5), 0, num_lines).astype(np.intp)
+    first_lines = to_line(np.minimum(starts[:, 1], ends[:, 1]))
+    num_crossed = to_line(np.maximum(starts[:, 1], ends[:, 1])) - first_lines
+
+    segment_inds = np.repeat(np.arange(len(starts)), num_crossed)
+    lines = first_lines[segment_inds] + np.arange(len(segment_inds)) - np.repeat(np.cumsum(num_crossed) - num_crossed, num_crossed)
+    line_ys = y_start + (lines + 0.5) * spacing
+    segment_starts, segment_ends = starts[segment_inds], ends[segment_inds]
+    xs = segment_starts[:, 0] + (line_ys - segment_starts[:, 1]) / (segment_ends[:, 1] - segment_starts[:, 1]) * (segment_ends[:, 0] - segment_starts[:, 0])
+
+    # every line is crossed an even number of times, so after sorting the crossings pair up into spans
+    order = np.lexsort((xs, lines))
+    lines, xs = lines[order], xs[order]
+
+    return lines[::2], xs[::2], xs[1::2]
+
+def rasterize_toolpath(toolpath: Toolpath, pixel_size: float, bounds: tuple[tuple[float, float], tuple[float, float]]) -> np.ndarray:
+    '''
+    Scanline fill of the closed loops of a toolpath into a bitmap, a pixel is filled if its center is inside (see get_scanline_spans())
+
+    :param toolpath: the Toolpath, every loop closed
+    :param pixel_size: size of the square pixels in mm
+    :param bounds: ((x_min, x_max), (y_min, y_max)) of the bitmap, same as gerber_obj.bounds
+    :return: (rows, columns) bool array, row 0 is at y_min and column 0 at x_min
+    '''
+    (x_min, x_max), (y_min, y_max) = bounds
+    num_rows = max(int(math.ceil((y_max - y_min) / pixel_size)), 1)
+    num_columns = max(int(math.ceil((x_max - x_min) / pixel_size)), 1)
+
+    rows, span_starts, span_ends = get_scanline_spans(toolpath, y_min, pixel_size, num_rows)
+    first_columns = np.clip(np.ceil((span_starts - x_min) / pixel_size - 0.5), 0, num_columns).astype(np.intp)
+    end_columns = np.clip(np.ceil((span_ends - x_min) / pixel_size - 0.5), 0, num_columns).astype(np.intp)
+
+    bitmap = np.zeros((num_rows, num_columns + 1), dtype=np.int32)
+    np.add.at(bitmap, (rows, first_columns), 1)
+    np.add.at(bitmap, (rows, end_columns), -1)
+
+    return np.cumsum(bitmap[:, :-1], axis=1) > 0
+
+def get_hatch_toolpath(toolpath: Toolpath, spacing: float, angle: float = 0) -> Toolpath:
+    '''
+    Fills the closed loops of a toolpath (e.g. a from_polygons() Toolpath) with parallel hatch lines spacing apart,
+    each span of a line inside the loops is a 2 vertex (open) loop of the returned Toolpath.
+    Spans are in boustrophedon order: line by line, every other line walked backwards
+
+    :param toolpath: the Toolpath, every loop closed
+    :param spacing: distance between the hatch lines in mm (pen tip thickness, laser spot size)
+    :param angle: counter clockwise angle of the hatch lines from the X axis in degrees
+    :return: Toolpath of the hatch segments, Z set to 0
+    '''
+    # hatching along X in a frame rotated by -angle
+    matrix = get_transform_matrix(rotation=angle)
+    rotated = Toolpath(toolpath.coords.copy(), toolpath.offsets)
+    rotated.coords[:, :2] = toolpath.coords[:, :2] @ matrix
+    if not rotated.num_vertices:
+        return Toolpath(np.zeros((0, 3)), np.zeros(1, dtype=np.intp))
+
+    y_min, y_max = rotated.coords[:, 1].min(), rotated.coords[:, 1].max()
+    num_lines = max(int(math.ceil((y_max - y_min) / spacing)), 1)
+    # centering the lines in the fill
+    y_start = y_min - (num_lines * spacing - (y_max - y_min)) / 2
+    lines, span_starts, span_ends = get_scanline_spans(rotated, y_start, spacing, num_lines)
+
+    # boustrophedon, odd lines right to left
+    is_backwards = lines % 2 == 1
+    order = np.lexsort((np.where(is_backwards, -span_starts, span_starts), lines))
+    lines, span_starts, span_ends, is_backwards = lines[order], span_starts[order], span_ends[order], is_backwards[order]
+    span_starts, span_ends = np.where(is_backwards, span_ends, span_starts), np.where(is_backwards, span_starts, span_ends)
+
+    coords = np.zeros((2 * len(lines), 3))
+    coords[0::2, 0], coords[1::2, 0] = span_starts, span_ends
+    coords[:, 1] = np.repeat(y_start + (lines + 0.5) * spacing, 2)
+    coords[:, :2] = coords[:, :2] @ matrix.T
+
+    return Toolpath(coords, np.arange(0, len(coords) + 1, 2))
+
 def get_traces_outlines(gerber_obj: gerber.rs274x.GerberFile, 
         offset:Optional[float] = None, 
         resolution: int = DEFAULT_RESOLUTION, 
-        height_map: Optional[tuple[tuple[float, float, float]]] = None,
+        height_map: Optional[HeightMap] = None,
         Z_offset_from_0: Optional[float] = 0,
-        debug: bool=False) -> list[list[Point]]:
+        z_tolerance: Optional[float] = None,
+        snap_to_grid: bool = False,
+        chord_tolerance: float = DEFAULT_CHORD_TOLERANCE,
+        debug: bool=False) -> Toolpath:
     '''
     Get list of list of coordinates, each list is one continious piece of trace.
 
@@ -841,123 +2248,237 @@ def get_traces_outlines(gerber_obj: gerber.rs274x.GerberFile,
     :param resolution: the number of decimal places for coordinates
     :param height_map: if given, will interpolate resultant trace coord list Z value to match the grid coords of height map
     :param Z_offset_from_0: how much up from 0 should the spindle bit be. useful for V-bits which should be slightly above 0
+    :param z_tolerance: if given with height_map, segments are subdivided wherever the height map surface deviates from them by more than z_tolerance
+    :param snap_to_grid: snap the union of all traces to the grid defined by resolution
+    :param chord_tolerance: maximum distance in mm between the true arcs and circles and the segments approximating them
     :param debug: enable debugging info and display laser motion
 
-    :return: list of list of coordinates of one continious trace
+    :return: Toolpath, each loop is the (n, 3) X, Y, Z coordinates of one continious trace
 
     #TODO: implement include_edge_cuts functionality
     #TODO: think about whether to round here or in the gcode_tools functions
-    #TODO: apply height map
     '''
 
     # Converting the Gerber Object to Shapely Objects into a dark group and a light group
-    shapely_objects_dark = {}
-    shapely_objects_clear = {}
-    for gerber_primitive in gerber_obj.primitives:
+    # each shape is kept with its index in gerber_obj.primitives which is the order it's drawn in the gerber file
+    GerberToShapely.set_chord_tolerance(chord_tolerance)
+    shapely_objects = GerberToShapely.convert_all(gerber_obj.primitives)
+    shapely_objects_dark = []
+    shapely_objects_clear = []
+    for order, (gerber_primitive, shapely_object) in enumerate(zip(gerber_obj.primitives, shapely_objects)):
         if gerber_primitive.level_polarity == 'dark':
-            shapely_objects_dark[GerberToShapely(gerber_primitive)] = gerber_primitive
+            shapely_objects_dark.append((order, shapely_object))
 
         elif gerber_primitive.level_polarity == 'clear':
-            shapely_objects_clear[GerberToShapely(gerber_primitive)] = gerber_primitive
+            shapely_objects_clear.append((order, shapely_object))
 
         else:
             raise ValueError(f"Unsupported level_polarity: {gerber_primitive.level_polarity}")
 
-    # Subtracting each dark group from all light groups, 
-    # (as there is no way to know which shape is supposed to subtract which shape (as far as I know))
-    shapely_objects_dark_subtracted = []
-    for shapely_obj_d, gbr_obj_d in shapely_objects_dark.items():
-
-        #NOTE: I assume that the only Gerber Objects that have difference operation applied to them by clear objects are 'Region'
-        if type(gbr_obj_d) == gerber.rs274x.Region:
-            for light_obj in shapely_objects_clear.keys():
-                shapely_obj_d = shapely_obj_d.difference(light_obj)
+    if debug:
+        print(GerberToShapely.FLASH_TEMPLATE_CACHE)
 
-        shapely_objects_dark_subtracted.append(shapely_obj_d)
+    # Subtracting from each dark shape the clear shapes drawn after it
+    shapely_objects_dark_subtracted = subtract_clear_shapely_objects(shapely_objects_dark, shapely_objects_clear, debug=debug)
 
-    # Union all dark group shapes together to form a MultiPolygon Object with all the Polygons that intersect joined
-    whole_thing = shapely_objects_dark_subtracted[0]
-    for shapely_object in shapely_objects_dark_subtracted[1:]:
-        whole_thing = whole_thing.union(shapely_object)
-    whole_thing = list(whole_thing.geoms)
+    # Union all dark group shapes together to form a list of Polygons with all the Polygons that intersect joined
+    whole_thing = union_shapely_objects(shapely_objects_dark_subtracted, resolution if snap_to_grid else None)
+    if debug:
+        print(f"Merged {len(shapely_objects_dark_subtracted)} shapes into {len(whole_thing)} traces")
 
     # Applying Offset to coords if exists
     if offset:
         whole_thing_offseted = []
         for polygon_ in whole_thing:
-            whole_thing_offseted.append(polygon_.buffer(offset))
-        whole_thing = whole_thing_offseted
-
-    # Getting list of list of extrior coordinate of each Shapley Polygon
-    coord_list_list = [list(polygon_.exterior.coords) for polygon_ in whole_thing]
-    coord_list_list = [ [ Point( round(coord[0], resolution), round(coord[1], resolution) ) for coord in coord_list ] for coord_list in coord_list_list]
-
-    # Getting list of list of all interiors coordinate lists of each Shapely Polygon
-    tmp = [list(interior.coords) for polygon_ in whole_thing for interior in polygon_.interiors]
-    tmp = [ [ Point( round(coord[0], resolution), round(coord[1], resolution) ) for coord in tmp_ ] for tmp_ in tmp ]
-
-    # Joinging the exterior and interiors lists of Points
-    coord_list_list.extend(tmp)
-
-    # Get function to return Z value
-    if height_map:
-        ### Applying height map, interpolating Z value from height map
-        # preparing the variables that needs to be passed to the interpolate function
-        x_coords = sorted({point[0] for point in height_map})
-        y_coords = sorted({point[1] for point in height_map})
-        z_grid = np.zeros((len(y_coords), len(x_coords)))
-        for point in height_map:
-            x, y, z = point
-            i = y_coords.index(y)
-            j = x_coords.index(x)
-            z_grid[i, j] = z+Z_offset_from_0
-        # get the interpolate function 
-        get_z = interp2d(x_coords, y_coords, z_grid, kind='linear')
+            whole_thing_offseted.append(polygon_.buffer(offset, quad_segs=get_quad_segs(abs(offset), chord_tolerance)))
 
-    else:
-        get_z = lambda x, y: [Z_offset_from_0]
+        # a negative offset can split a polygon in pieces or make it vanish
+        whole_thing = [polygon_ for polygon_ in shapely.get_parts(whole_thing_offseted) if not polygon_.is_empty]
 
-    # applying appropriate Z value to coord_list_list
-    for coord_list_ind, coord_list in enumerate(coord_list_list):
-        for coord_ind, coord in enumerate(coord_list):
-                coord_list_list[coord_list_ind][coord_ind] = Point(coord.x, coord.y, get_z(coord.x, coord.y)[0])
+    # Getting the exterior coordinates of each Shapely Polygon followed by all the interiors coordinates as one Toolpath
+    toolpath = Toolpath.from_polygons(whole_thing, resolution)
+
+    # applying appropriate Z value to the toolpath, interpolating Z value from height map if given
+    if height_map is not None:
+        toolpath.coords[:, 2] = height_map.get_z(toolpath.coords[:, 0], toolpath.coords[:, 1]) + Z_offset_from_0
+
+        if z_tolerance:
+            num_vertices = toolpath.num_vertices
+            toolpath = subdivide_toolpath_to_height_map(toolpath, height_map, z_tolerance, Z_offset_from_0, resolution)
+            if debug:
+                print(f"Height map subdivision added {toolpath.num_vertices - num_vertices} vertices to {num_vertices}")
+    else:
+        toolpath.coords[:, 2] = Z_offset_from_0
 
     # Visualizing the traces
     if debug:
-        visualize_group(coord_list_list, gbr_obj=gerber_obj)
+        visualize_group(toolpath, gbr_obj=gerber_obj)
 
-    return coord_list_list
+    return toolpath
 
-def get_holes_coords(gerber_obj: gerber.rs274x.GerberFile, resolution: int = DEFAULT_RESOLUTION, debug: bool=False) -> list[Point]:
+def get_aperture_pad_sizes(gerber_obj: gerber.rs274x.GerberFile) -> dict[int, tuple[Optional[str], Optional[float]]]:
     '''
-    Gets list of coordinates where the spindle must go straight down in the Z axis to drill
+    Reads the aperture definitions of the gerber file with the .AperFunction attribute (%TA.AperFunction,ComponentPad*%)
+    in effect when each was defined
 
     :param gerber: Gerber Object from the gerber library
-    :param resolution: the number of decimal places for coordinates
-    :return: list of holes coordinates
+    :return: {D code: (aperture function, pad size)}, pad size is the circle or polygon diameter, the smaller side of
+             rectangles and obrounds or None for macros. Aperture function is None when the file doesn't say
+    '''
+    apertures = {}
+    aperture_function = None
+    for stmt in gerber_obj.statements:
+        if type(stmt) == gerber.gerber_statements.UnknownStmt:
+            # %TA.AperFunction,SMDPad,CuDef*% sets it, %TD*% or %TD.AperFunction*% deletes it
+            line = stmt.line.strip('%*')
+            if line.startswith('TA.AperFunction,'):
+                aperture_function = line.split(',')[1]
+            elif line in ('TD', 'TD.AperFunction'):
+                aperture_function = None
+
+        elif type(stmt) == gerber.gerber_statements.ADParamStmt:
+            modifiers = stmt.modifiers[0] if stmt.modifiers else ()
+            if stmt.shape in ('C', 'P') and modifiers:
+                pad_size = float(modifiers[0])
+            elif stmt.shape in ('R', 'O') and len(modifiers) >= 2:
+                pad_size = float(min(modifiers[:2]))
+            else:
+                pad_size = None
+
+            apertures[stmt.d] = (aperture_function, pad_size)
+
+    return apertures
+
+def merge_close_points(points: np.ndarray, distance: float) -> np.ndarray:
+    '''
+    Groups the points closer than distance to the first point of a group, using a spatial hash (dict of grid cells
+    of size distance) so only the 9 cells around a point are searched
+
+    :param points: (n, 2) X, Y array
+    :param distance: points closer than this are merged
+    :return: (n,) index of the first point of the group each point belongs to
+    '''
+    groups = np.arange(len(points))
+    if not distance:
+        return groups
+
+    cells = {}
+    for ind, (x, y) in enumerate(points.tolist()):
+        cell_x, cell_y = math.floor(x / distance), math.floor(y / distance)
+        merged = next((first for dx in (-1, 0, 1) for dy in (-1, 0, 1) for first in cells.get((cell_x + dx, cell_y + dy), ())
+                       if math.dist(points[first], (x, y)) < distance), None)
+        if merged is None:
+            cells.setdefault((cell_x, cell_y), []).append(ind)
+        else:
+            groups[ind] = merged
+
+    return groups
+
+def get_holes_coords(gerber_obj: gerber.rs274x.GerberFile, 
+        aperture_functions: tuple[str] = ('ComponentPad', 'ViaPad'),
+        merge_distance: float = 0.05,
+        resolution: int = DEFAULT_RESOLUTION, 
+        debug: bool=False) -> tuple[np.ndarray, np.ndarray]:
     '''
-    coord_list = []
-    for primitive in gerber_obj.primitives:
+    Gets list of coordinates where the spindle must go straight down in the Z axis to drill, with the size of their pads
 
-        # Add any position of any Gerber object that is not a Trace; thus a ComponentPad
-        if type(primitive) not in [gerber.rs274x.Line, gerber.rs274x.Region]:
-            coord_list.append(Point( round(primitive.position[0], resolution), round(primitive.position[1], resolution)))
+    Step-1: aperture function and pad size of every aperture from its definition
+    Step-2: position of every flash (D03) of an aperture with a drilled function (through hole pads and vias, not SMD pads).
+            If no aperture in the file has a function (older CAD programs), every flash is a hole
+    Step-3: merging coincident flashes (pads drawn twice, e.g. a pad and its thermal relief) with the largest pad size
+    Done :D
+
+    :param gerber: Gerber Object from the gerber library
+    :param aperture_functions: .AperFunction values of the apertures that are holes
+    :param merge_distance: holes closer than this in mm are drilled once
+    :param resolution: the number of decimal places for coordinates
+    :return: (N, 2) array of holes X, Y coordinates and (N,) array of their pad sizes (nan if unknown)
+    '''
+    ### Step 1: apertures
+    apertures = get_aperture_pad_sizes(gerber_obj)
+    has_functions = any(aperture_function is not None for aperture_function, _ in apertures.values())
+
+    ### Step 2: flashes
+    coord_list, pad_sizes = [], []
+    x, y, aperture = 0, 0, None
+    num_skipped = 0
+    for stmt in gerber_obj.statements:
+        if type(stmt) == gerber.gerber_statements.ApertureStmt:
+            aperture = stmt.d
+
+        elif type(stmt) == gerber.gerber_statements.CoordStmt:
+            x = stmt.x if stmt.x is not None else x
+            y = stmt.y if stmt.y is not None else y
+
+            if stmt.op in ('D03', 'D3'):
+                aperture_function, pad_size = apertures.get(aperture, (None, None))
+                if has_functions and aperture_function not in aperture_functions:
+                    num_skipped += 1
+                    continue
+
+                coord_list.append((x, y))
+                pad_sizes.append(np.nan if pad_size is None else pad_size)
+
+    coord_list = np.round(np.array(coord_list, dtype=np.float64).reshape(-1, 2), resolution)
+    pad_sizes = np.array(pad_sizes, dtype=np.float64)
+
+    ### Step 3: merging
+    groups = merge_close_points(coord_list, merge_distance)
+    firsts = np.unique(groups)
+    merged_pad_sizes = np.full(len(coord_list), np.nan)
+    np.fmax.at(merged_pad_sizes, groups, pad_sizes)
 
     if debug:
-        print(f"Number of holes to drill: {len(coord_list)}")
+        print(f"Number of holes to drill: {len(firsts)}, skipped {num_skipped} flashes of other aperture functions and merged {len(coord_list) - len(firsts)} coincident ones")
 
-    return coord_list
+    return coord_list[firsts], merged_pad_sizes[firsts]
 
-def get_pen_coords(gerber_obj: gerber.rs274x.GerberFile, debug: bool=False) -> list[Point]:
+def get_hatch_fill(gerber_obj: gerber.rs274x.GerberFile, 
+        line_width: float, 
+        angle: float = 0, 
+        chord_tolerance: float = DEFAULT_CHORD_TOLERANCE, 
+        debug: bool=False) -> tuple[Toolpath, Toolpath]:
     '''
+    Gets the toolpaths to fill the copper with a tool drawing line_width wide lines (pen, laser spot)
+
+    Step-1: the outlines of the copper shrunk by half the line width, so the edge of the line follows the edge of the copper.
+            Copper thinner than line_width vanishes, it can't be drawn without spilling over
+    Step-2: hatch lines line_width apart inside the shrunk outlines
+    Done :D
+
+    :param gerber: Gerber Object from the gerber library
+    :param line_width: width of the line the tool draws in mm
+    :param angle: counter clockwise angle of the hatch lines from the X axis in degrees
+    :param chord_tolerance: maximum distance in mm between the true arcs and circles and the segments approximating them
+    :param debug: print the number of outlines and hatch lines
+    :return: Toolpath of the closed outlines and Toolpath of the hatch segments (see get_hatch_toolpath()), Z set to 0
+    '''
+    outlines = get_traces_outlines(gerber_obj, -line_width / 2, chord_tolerance=chord_tolerance)
+    hatch = get_hatch_toolpath(outlines, line_width, angle)
+
+    if debug:
+        print(f"Hatch fill: {len(outlines)} outlines and {len(hatch)} hatch lines {line_width} mm apart")
+
+    return outlines, hatch
+
+def get_pen_coords(gerber_obj: gerber.rs274x.GerberFile, tip_thickness: float, debug: bool=False) -> tuple[Toolpath, Toolpath]:
     '''
-    pass
+    Gets the toolpaths for laying ink on the copper with a pen, see get_hatch_fill()
 
-def get_spindle_edge_cut_coords(gerber_obj: gerber.rs274x.GerberFile, resolution: int = DEFAULT_RESOLUTION, debug: bool=False) -> list[list[Point]]:
+    :param gerber: Gerber Object from the gerber library
+    :param tip_thickness: number to convey thickness of pen tip in mm
+    :return: Toolpath of the closed outlines and Toolpath of the hatch segments
     '''
+    return get_hatch_fill(gerber_obj, tip_thickness, debug=debug)
 
+def get_spindle_edge_cut_coords(gerber_obj: gerber.rs274x.GerberFile, 
+        offset: Optional[float] = None, 
+        resolution: int = DEFAULT_RESOLUTION, 
+        debug: bool=False):
+    '''
+    NOT IMPLEMENTED YET: the coordinates of the spindle path cutting the PCB out
     '''
-    pass
+    raise NotImplementedError("Spindle edge cut isn't implemented yet (cam.get_spindle_edge_cut_coords)")
 
 
 if __name__ == '__main__':
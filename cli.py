@@ -6,7 +6,6 @@ To test the laser gcode for example
 python3 cli.py -D test.gcode --laser --debug-laser gerber_files/mirrored_and_offseted.gbr
 '''
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from main import Settings, main
 from default_settings import default_settings_dict
 from typing import Optional
 
@@ -73,25 +72,25 @@ def addArg(name: str, help_str: str, var_type, one_letter: Optional[str]=None, t
 
 
 if __name__ == '__main__':
-    # Initiating Settings object
-    settings = Settings()
-
     ### Creating the CLI argument parser
     parser = ArgumentParser(description="Generates Custom Gcode Required by my PCB Manufacturing Machine :)", 
             formatter_class=ArgumentDefaultsHelpFormatter)
 
     ### Adding the positional arguments
-    parser.add_argument('src', help="Source Gerber file to be converted to Gcode\n")
+    parser.add_argument('src', help="Source Gerber file to be converted to Gcode (the Gcode file to send with --stream)\n")
 
     ### Adding keyword Arguments
     # File management settings
     addArg('dest', "Destination Gcode file", str, 'D')
+    addArg('estimate_machining_time', "Estimate the machining time of each operation, put at the top of the Gcode file and in a .json file next to it", bool)
+    addArg('compress_gcode', "Leave out the G-code words the machine already knows (repeated modes, unchanged axes and feedrates), the comments and extra zeros", bool)
     addArg('dont_export_gbr', "Doesn't allow exporting of the mirrored_and_offseted gerber file", bool)
     addArg('new_gbr_name', "The name of the newly created Gerber File after mirroring and offsetting", str)
 
     # Gerber file modifications seFalsettings
     addArg('mirrored', "Mirror Gerber file. (All coordinates are mirrored)", bool, 'M')
     addArg('rotated', "Rotate Gerber file 90 degrees. (All coordinates are rotated 90d)", bool, 'R')
+    addArg('rotation', "Rotate Gerber file counter clockwise by this angle in degrees. (added to --rotated)", float)
     addArg('x_offset', "Value PCB offseted from X axis", int)
     addArg('y_offset', "Value PCB offseted from Y axis", int)
 
@@ -100,7 +99,7 @@ if __name__ == '__main__':
     # addArg('ink', "Adds ink laying gcode to Gcode file", bool)  # deprecated
     addArg('laser', "Adds laser engraving gcode to Gcode file", bool)
     addArg('spindle', "Adds spindle engraving gcode to Gcode file", bool)
-    addArg('spindle_edge_cut', "Using Spindle to cut the edges of the PCB", bool)
+    addArg('spindle_edge_cut', "Using Spindle to cut the edges of the PCB (not implemented yet)", bool)
 
     # Tool Head change ( kinematic mounting mechanisms / spindle bit change )
     addArg('spindle_bit_change', "Adds support for CNC machines with the ability to change spindle bits.\n(Please note that the id of bit, type and size must be defined in the default_settings file or added as an argument here.)", bool)
@@ -109,8 +108,29 @@ if __name__ == '__main__':
     # Extra settings for a specific operation
     addArg('include_edge_cuts', "Include Edge cuts in laser marking process", bool)
     addArg('laser_passes', "Number of passes for laser marking Gcode", int)
+    addArg('laser_raster', "Laser fills the copper line by line (raster) instead of tracing its outlines", bool)
+    addArg('laser_raster_dpi', "Resolution of the laser raster in dots per inch, lines are 25.4 / DPI mm apart", float)
+    addArg('laser_raster_negative', "Laser raster burns everything but the copper", bool)
+    addArg('laser_hatch', "Laser fills the copper with vector hatch lines instead of tracing its outlines", bool)
+    addArg('laser_spot_size', "Diameter of the laser spot in mm, distance between the laser hatch lines", float)
+    addArg('hatch_angle', "Angle of the hatch lines in degrees, counter clockwise from the X axis", float)
     addArg('spindle_bit_offset', "The Diameter of the spindle bit offset to make sure when engraving trace width, it is as intended", float)
+    addArg('rapid_feedrate', "G0 speed of the machine in mm/min (GRBL $110/$111), only used for time estimates", float)
+    addArg('z_max_rate', "Z axis maximum rate of the machine in mm/min (GRBL $112), only used for time estimates", float)
+    addArg('xy_acceleration', "X and Y axes acceleration of the machine in mm/sec^2 (GRBL $120/$121), only used for time estimates", float)
+    addArg('z_acceleration', "Z axis acceleration of the machine in mm/sec^2 (GRBL $122), only used for time estimates", float)
+    addArg('junction_deviation', "Junction deviation of the machine in mm (GRBL $11), only used for time estimates", float)
+    addArg('min_annular_ring', "Minimum width in mm of the copper ring left around a drilled hole, each hole gets the biggest of the 'drill_bits' settings that fits", float)
     addArg('add_spindle_trace_ccw_path', "This means that the spindle will move through the trace (A->B) then (B->A). This is useful for bad bits.", bool)
+    addArg('spindle_milling_direction', "Direction the spindle engraves the traces in: 'climb' (copper on the right of the bit) or 'conventional' (copper on the left)", str)
+
+    # Geometry processing settings
+    addArg('union_snap_to_grid', "Snap the merged copper traces to the coordinate resolution grid while merging them", bool)
+    addArg('chord_tolerance', "Maximum distance in mm between true arcs and circles (pads, vias, rounded corners) and the straight segments approximating them", float)
+    addArg('simplify_tolerance', "Maximum distance in mm the engraving toolpaths may move when removing redundant vertices (Douglas-Peucker). 0 to disable", float)
+    addArg('min_segment_length', "Remove engraving toolpath segments shorter than this in mm, they stall the GRBL planner. 0 to disable", float)
+    addArg('travel_optimization_time', "Seconds spent shortening the rapid moves between engraving loops or holes (2-opt) after ordering them by nearest neighbour. 0 for only nearest neighbour", float)
+    addArg('arc_tolerance', "Emit engraving toolpath vertices lying on a circular arc within this distance in mm as one G2/G3 arc move. 0 to disable", float)
 
     addArg('debug', "Shows Simulation of the PCB laser trace coordinates as well as other debug Info.", bool)
 
@@ -119,11 +139,28 @@ if __name__ == '__main__':
     addArg('serial_port', "Serial Port Path to connect to the grbl Controller and get create height map", str)
     addArg('serial_baud', "Baud Rate of grbl Controller serial port", int)
     addArg('height_map_resolution', "When creating height map, resolution of height map in mm; take measurements every how much mm", int)
+    addArg('height_map_clearance', "When creating height map, height in mm above the last probed Z the probe travels at between grid points", float)
+    addArg('probe_seek_feedrate', "When creating height map, feedrate in mm/min of the fast probing that finds the PCB surface", float)
+    addArg('probe_latch_feedrate', "When creating height map, feedrate in mm/min of the slow probing that measures the PCB surface", float)
+    addArg('probe_backoff', "When creating height map, distance in mm to back off from the first contact before probing slowly", float)
     addArg('height_map', "A path to a .json file containing height map to be taken into account in the creation of gcode", str, three_state=True)
+    addArg('height_map_z_tolerance', "When using a height map, add vertices to the traces wherever the height map surface deviates more than this value in mm from them. 0 to disable", float)
+
+    # Streaming command
+    addArg('stream', "Sends the src Gcode file to the grbl controller on the serial port, keeping its RX buffer full (character counting)", bool)
+    addArg('grbl_rx_buffer_size', "Size in bytes of the grbl controller serial RX buffer, when streaming", int)
+    addArg('status_report_interval', "Seconds between the grbl status reports requests while streaming, 0 for none", float)
 
     ### Extracting User inputs!
     # Getting arguments
-    settings.settings_dict.update(vars(parser.parse_args()))
+    args = parser.parse_args()
+
+    # Importing the CAM machinery only after parsing, so '--help' and bad arguments return instantly
+    from main import Settings, main
+
+    # Initiating Settings object
+    settings = Settings()
+    settings.settings_dict.update(vars(args))
 
     ### Executing the Program!
     main(settings)
@@ -39,14 +39,22 @@ default_settings_dict = {
     "spindle_feedrate_Z_engrave": 30,
     "spindle_feedrate_Z_hole": 5,
     "spindle_feedrate_Z_up": 100,
+    "rapid_feedrate": 500,  # G0 speed, the GRBL $110/$111 X and Y max rates. Only used for time estimates
     # Power intensities
     "spindle_speed": 400,
     # Dwell time in seconds for spindle to reach full RPM
     "spindle_dwell_time": 2,
     # Spindle Bit Offset for engraving
     "spindle_bit_offset": 0.2,
+    # Hole drilling, the drill bits available (mm) and the copper ring to leave around the holes, each hole gets the biggest bit that fits
+    'drill_bits': [0.8],
+    'min_annular_ring': 0.25,
+    # .AperFunction attribute of the pads drilled, SMD pads and traces are never drilled
+    'hole_aperture_functions': ['ComponentPad', 'ViaPad'],
     # spindle will move through the trace (A->B) then (B->A). This is useful for bad bits.
     'add_spindle_trace_ccw_path': False,
+    # 'climb' (copper on the right of the bit, cleaner edges) or 'conventional' (copper on the left) milling of the traces
+    'spindle_milling_direction': 'climb',
 
     # ### Pen Tweaking Values
     # # Z positions
@@ -67,9 +75,26 @@ default_settings_dict = {
     "include_edge_cuts": False,
     # Laser Gcode Passes
     "laser_passes": 1,
+    # Raster mode, fills the copper line by line (bidirectional, M4 dynamic power) instead of tracing the outlines
+    "laser_raster": False,
+    "laser_raster_dpi": 254,  # 0.1 mm between lines, about the laser spot size
+    "laser_raster_negative": False,  # burn everything but the copper (e.g. removing paint resist before etching)
+    # Hatch mode, fills the copper with the outlines shrunk by half the laser spot then hatch lines one spot apart
+    "laser_hatch": False,
+    "laser_spot_size": 0.1,  # mm
+    "hatch_angle": 0,  # degrees counter clockwise from the X axis
 
     # destination
     'dest': './default.gcode',
+    # machining time, lengths, plunge and line counts of each operation estimated at the top of the gcode and in dest + '.json'
+    'estimate_machining_time': False,
+    # the machine's GRBL settings used by the estimate, the X and Y max rates are 'rapid_feedrate'
+    'z_max_rate': 500,  # mm/min, $112
+    'xy_acceleration': 10,  # mm/sec^2, $120 and $121
+    'z_acceleration': 10,  # mm/sec^2, $122
+    'junction_deviation': 0.01,  # mm, $11
+    # leave out the words the machine already knows (repeated G1, unchanged axes and feedrates), the comments and the extra zeros, fewer bytes to stream
+    'compress_gcode': False,
 
     # mirrored
     'mirrored': False,
@@ -77,6 +102,9 @@ default_settings_dict = {
     # rotated
     'rotated': False,
 
+    # extra counter clockwise rotation in degrees, any angle (added to the 90 degrees of 'rotated')
+    'rotation': 0,
+
     # Gcode Modes
     # 'ink': False, # deprecated
     'laser': False,
@@ -84,6 +112,19 @@ default_settings_dict = {
     'holes': False,
     "spindle_edge_cut": False,
 
+    ### Geometry processing settings
+    # snap the merged copper to the coordinate resolution grid (removes slivers, more robust union)
+    'union_snap_to_grid': False,
+    # maximum distance in mm between true arcs and circles and the straight segments approximating them
+    'chord_tolerance': 0.005,
+    # toolpath simplification, long runs of tiny segments starve the GRBL planner and the feedrate drops (0 disables each)
+    'simplify_tolerance': 0.005,  # mm, Douglas-Peucker maximum deviation
+    'min_segment_length': 0.01,  # mm
+    # vertices lying on a circular arc within this distance (mm) are emitted as one G2/G3 move, 0 for only straight G1 moves
+    'arc_tolerance': 0.005,
+    # seconds spent shortening the rapid moves between engraving loops or holes (2-opt) after the nearest neighbour ordering, 0 for only nearest neighbour
+    'travel_optimization_time': 1,
+
     # Show Gcode Creation Debugging info and visualization :)
     'debug': False,
 
@@ -96,8 +137,17 @@ default_settings_dict = {
     'serial_port': "/dev/ttyACM0",
     'serial_baud': 115200,
     'height_map_resolution': 5,
+    'height_map_clearance': 1,  # mm above the last probed Z the probe travels at between the height map grid points
+    'probe_seek_feedrate': 100,  # mm/min, fast probing down to the PCB
+    'probe_latch_feedrate': 10,  # mm/min, slow probing again after backing off, gives the height map value
+    'probe_backoff': 0.2,  # mm above the first contact the slow probing starts from
     'created_height_map_default_file_name': "height_map.json",
     'height_map': "height_map.json", # default height map to use
+    'height_map_z_tolerance': 0, # subdivide traces where the height map surface deviates more than this (mm) from them, 0 to disable
+
+    'stream': False,  # sends the src gcode file to the grbl controller, executed when triggered
+    'grbl_rx_buffer_size': 128,  # bytes, RX_BUFFER_SIZE of the grbl firmware
+    'status_report_interval': 0.2,  # seconds between the '?' status reports while streaming, 0 for none
 
 }
 
@@ -1,20 +1,26 @@
 '''
 This file has function to generate the gcode we want
 '''
+from __future__ import annotations
+
 from enum import Enum
-from typing import Callable, Optional
-from math import floor, ceil
+from typing import Callable, Optional, Iterable, Iterator
+from math import floor, ceil, atan2, sqrt, pi
 import re
 from contextlib import contextmanager
-import serial
 from dataclasses import dataclass
 import json
+import os
+import shutil
+import time
+from collections import deque
+import numpy as np
 import warnings
 with warnings.catch_warnings():
     # suppressing a stupid syntax warning to convert 'is not' to '!='
     warnings.filterwarnings("ignore", category=SyntaxWarning)
     import gerber
-from cam import get_traces_outlines, get_holes_coords, get_pen_coords, Point
+from cam import get_traces_outlines, get_holes_coords, get_pen_coords, get_spindle_edge_cut_coords, simplify_toolpath, fit_arcs, reverse_arcs, order_toolpath, order_open_paths, order_points, rasterize_toolpath, get_hatch_fill, Point, Toolpath, HeightMap
 
 def get_max_decimal_place(value: float) -> int:
     '''
@@ -393,6 +399,136 @@ def move(*modal_options, **non_modal_options_and_coordinates) -> str:
     
     return gcode
 
+TRAILING_ZEROS_REGEX = re.compile(r'(\.\d[1-9]?)0+(?=\D)')
+
+class MoveTemplate:
+    '''
+    A precompiled move(): the modal options, the fixed coordinates and the non modal options are checked and formatted once
+    when the template is made, every line after that only formats the values of the variable axes.
+
+    The variable axes come right after the modal options, in the order given by axes, then the fixed coordinates and non modal options,
+    the values are written with '%.3f' and trimmed, which gives exactly str(round(value, 3)) for floats e.g. X12.0, X10.75
+    NOTE: ints given to a variable axis come out as floats (Z1.0 instead of Z1), pass them as fixed coordinates to keep move()'s output
+
+    rapid = MoveTemplate(MotionMode.RAPID, axes='XY', z=1)
+    rapid(10.5, 2) -> 'G0X10.5Y2.0Z1\n'
+    rapid.format(np.array([[0, 0], [1.25, 3]])) -> 'G0X0.0Y0.0Z1\nG0X1.25Y3.0Z1\n'
+    '''
+    def __init__(self, *modal_options, axes: str = 'XYZ', **non_modal_options_and_coordinates):
+        '''
+        :param modal_options: same as move(), default motion mode is MotionMode.USE_FEEDRATE
+        :param axes: the variable axes, any of 'XYZ', e.g. 'XY' for one X, Y value pair per line, '' for a constant line
+        :param non_modal_options_and_coordinates: same as move(), the coordinates given here are fixed, comments aren't supported
+        '''
+        if 'comment' in non_modal_options_and_coordinates.keys():
+            raise ValueError("MoveTemplate lines can't have comments, use move() instead")
+
+        axes = axes.upper()
+        if len(set(axes)) != len(axes) or not set(axes) <= set('XYZ'):
+            raise ValueError(f"axes must be made of X, Y and Z at most once each, passed: {axes}")
+
+        # Modal Options
+        if MotionMode not in [type(modal_option) for modal_option in modal_options]:
+            modal_options = (MotionMode.USE_FEEDRATE, *modal_options)
+        line_start = set_modal_options(*modal_options, return_after=False)
+
+        # Seperating fixed coordinate kwargs from non_modal_options kwargs
+        non_modal_options_kwargs = {key: value for key, value in non_modal_options_and_coordinates.items() if key in non_modal_options.keys()}
+        coordinates_kwargs = {key: value for key, value in non_modal_options_and_coordinates.items() if key not in non_modal_options_kwargs.keys()}
+        if set(key.upper() for key in coordinates_kwargs.keys()) & set(axes):
+            raise ValueError("An axis can't be both variable and fixed")
+
+        line_end = get_coordinate_from_kwargs(coordinates_kwargs) + set_non_modal_options(**non_modal_options_kwargs, return_after=False) + '\n'
+
+        self.axes = axes
+        self.line_format = line_start.replace('%', '%%') + ''.join(f"{axis}%.3f" for axis in axes) + line_end.replace('%', '%%')
+
+    def __call__(self, *values) -> str:
+        '''
+        :param values: one value for each variable axis
+        :return: one gcode line
+        '''
+        return TRAILING_ZEROS_REGEX.sub(r'\1', self.line_format % values)
+
+    def format(self, coordinates: np.ndarray) -> str:
+        '''
+        :param coordinates: (n, len(axes)) array, one line per row
+        :return: the gcode lines
+        '''
+        return format_moves((self,), coordinates)
+
+def format_moves(templates: Iterable[MoveTemplate], coordinates: np.ndarray) -> str:
+    '''
+    formats a block of lines, one line from every template, for each row of coordinates.
+    The templates' line formats are joined into one format string that's applied to all the rows at once
+
+    e.g. drilling holes: format_moves((MoveTemplate(MotionMode.RAPID, axes='XY'), MoveTemplate(axes='Z', feedrate=30), retract), holes)
+    with one (x, y, z) row per hole
+
+    :param templates: the MoveTemplate of each line in the block
+    :param coordinates: (n, m) array, m is the number of variable axes of all the templates together, their values in the templates' order
+    :return: the gcode lines
+    '''
+    block_format = ''.join(template.line_format for template in templates)
+    values_count = sum(len(template.axes) for template in templates)
+
+    coordinates = np.asarray(coordinates, dtype=float)
+    if coordinates.ndim != 2 or coordinates.shape[1] != values_count:
+        raise ValueError(f"Expected a (n, {values_count}) coordinates array, passed shape: {coordinates.shape}")
+
+    # formatting all the rows with a single % operation instead of one per line
+    gcode = (block_format * len(coordinates)) % tuple(coordinates.ravel().tolist())
+
+    return TRAILING_ZEROS_REGEX.sub(r'\1', gcode)
+
+def move_path(coordinates: np.ndarray, *modal_options) -> str:
+    '''
+    generates one movement Gxx gcode command for each row of a coordinates array.
+    Same output as calling move(*modal_options, coordinate=Point(*row)) for every row
+    but without creating any per vertex object
+
+    :param coordinates: (n, 2) X, Y or (n, 3) X, Y, Z array, e.g. one loop of a Toolpath
+    :param modal_options: same as move(), default motion mode is MotionMode.USE_FEEDRATE
+
+    :return: the gcode lines
+    '''
+    return MoveTemplate(*modal_options, axes='XYZ'[:coordinates.shape[1]]).format(coordinates)
+
+def move_path_arcs(coordinates: np.ndarray, arcs: list[tuple[int, int, tuple[float, float], bool]], *modal_options) -> str:
+    '''
+    generates the movement gcode from coordinates[0] (where the tool already is) through every following row like move_path(coordinates[1:]),
+    except that the runs of rows lying on a circular arc become a single G2/G3 move with I, J (and Z for helical arcs),
+    GRBL runs those at full feedrate instead of planning lots of short chords
+
+    :param coordinates: (n, 2) X, Y or (n, 3) X, Y, Z array, e.g. one loop of a Toolpath
+    :param arcs: the arcs found in coordinates by fit_arcs(), empty for only straight moves
+    :param modal_options: same as move(), except the motion mode which is always G1 or G2/G3
+
+    :return: the gcode lines
+    '''
+    # the line formats are the same for the whole path
+    axes = 'XYZ'[:coordinates.shape[1]]
+    line = MoveTemplate(*modal_options, axes=axes)
+    arc_line_formats = {clockwise: MoveTemplate(MotionMode.CIRCULAR_CW if clockwise else MotionMode.CIRCULAR_CCW, *modal_options, axes=axes).line_format[:-1] + "I%.3fJ%.3f\n"
+                        for clockwise in (True, False)}
+
+    gcode = ''
+    position = 0
+    for start, end, center, clockwise in arcs:
+        # straight moves up to the start of the arc
+        gcode += line.format(coordinates[position+1:start+1])
+
+        # I and J are relative to the start of the arc, as the machine sees it (rounded)
+        start_x, start_y = np.round(coordinates[start, :2], 3).tolist()
+        arc_values = (*coordinates[end].tolist(), round(center[0] - start_x, 3) + 0.0, round(center[1] - start_y, 3) + 0.0)  # + 0.0 turns -0.0 into 0.0
+        gcode += TRAILING_ZEROS_REGEX.sub(r'\1', arc_line_formats[clockwise] % arc_values)
+
+        position = end
+
+    gcode += line.format(coordinates[position+1:])
+
+    return gcode
+
 
 def dwell(seconds: int, comment: Optional[str]=None) -> str:
     '''
@@ -400,6 +536,38 @@ def dwell(seconds: int, comment: Optional[str]=None) -> str:
     '''
     return f"G4 P{seconds}  ; {comment}\n"
 
+def simplification_comment(removed_lines: dict[str, int]) -> str:
+    '''
+    returns Gcode comment reporting how many movement lines each toolpath simplification step removed, see simplify_toolpath()
+    '''
+    return (f"; Toolpath simplification removed {sum(removed_lines.values())} lines: {removed_lines['collinear']} collinear, "
+            f"{removed_lines['douglas_peucker']} Douglas-Peucker, {removed_lines['min_segment_length']} short segments\n\n")
+
+def travel_comment(rapid_distances: tuple[float, float], between: str = 'loops', rapid_feedrate: Optional[float] = None) -> str:
+    '''
+    returns Gcode comment reporting the rapid distance before and after ordering, see order_toolpath() and order_points()
+
+    :param between: what the rapid moves are between
+    :param rapid_feedrate: if given, the time saved at this feedrate (mm/min) is reported too
+    '''
+    comment = f"; Travel optimization: rapid moves between {between} {rapid_distances[0]:.1f} mm -> {rapid_distances[1]:.1f} mm"
+    if rapid_feedrate:
+        comment += f", {(rapid_distances[0] - rapid_distances[1]) / rapid_feedrate * 60:.0f} s saved at {rapid_feedrate:g} mm/min"
+
+    return comment + "\n\n"
+
+def is_climb_milling(milling_direction: str) -> bool:
+    '''
+    whether the spindle engraving loops must be reversed, from_polygons() loops have the copper on their left which is
+    conventional milling with a clockwise spindle (M3), climb milling keeps the copper on the right
+
+    :param milling_direction: 'climb' or 'conventional'
+    '''
+    if milling_direction not in ('climb', 'conventional'):
+        raise ValueError(f"Unknown milling direction: {milling_direction}, expected 'climb' or 'conventional'")
+
+    return milling_direction == 'climb'
+
 
 def get_tool_func(latch_offset_distance_in: int, latch_offset_distance_out: int, tool_home_coordinates: dict[int: tuple[int, int, int]], tool_offsets: dict[int: tuple[int, int, int]], attach_detach_time: int) -> Callable:
     '''
@@ -494,30 +662,78 @@ def get_tool_func(latch_offset_distance_in: int, latch_offset_distance_out: int,
     return tool
 
 
-def generate_holes_gcode(gerber_obj: gerber.rs274x.GerberFile, settings) -> str:
+_loaded_height_maps = {}
+def get_height_map(settings) -> Optional[HeightMap]:
+    '''
+    loads the height map .json file given in settings, only once per file so spindle engraving and holes share it
+
+    :return: HeightMap object, None if no height map is used
+    '''
+    if not settings.height_map:
+        return None
+
+    if settings.height_map not in _loaded_height_maps:
+        _loaded_height_maps[settings.height_map] = HeightMap.from_json(settings.height_map)
+
+    return _loaded_height_maps[settings.height_map]
+
+
+def get_drill_bits(pad_sizes: np.ndarray, drill_bits: list[float], min_annular_ring: float) -> np.ndarray:
+    '''
+    picks the drill bit for each hole, the biggest bit leaving at least min_annular_ring of copper around the hole,
+    the smallest bit if none does or the pad size is unknown (nan)
+
+    :param pad_sizes: (N,) pad size of every hole
+    :param drill_bits: diameters of the available drill bits in mm
+    :param min_annular_ring: minimum width of the copper ring left around a hole in mm
+    :return: (N,) drill bit diameter of every hole
+    '''
+    drill_bits = np.sort(np.asarray(drill_bits, dtype=np.float64))
+    if not len(drill_bits):
+        raise ValueError("No drill bits given")
+
+    fitting = np.searchsorted(drill_bits, pad_sizes - 2*min_annular_ring, side='right') - 1
+
+    return drill_bits[np.maximum(np.where(np.isnan(pad_sizes), 0, fitting), 0)]
+
+def generate_holes_gcode(gerber_obj: gerber.rs274x.GerberFile, settings) -> Iterator[str]:
     '''
     Takes in String gerber file content, identifies the PCB holes and generates the Gcode to drill the holes from begging to end!
 
     :param gerber: Gerber object from the gerber library
     :param settings:
-    :return: This function creates the gcode content as string according to the input coordinates
+    :return: yields the gcode content piece by piece as it's created, see GcodeWriter
     '''
     ### Preparations
-    #TODO: fix this line to return the coordinates using the python gerber library. I am still not sure how to extract componentPad coords
-    coordinates = get_holes_coords(gerber_obj, debug=settings.debug)
+    coordinates, pad_sizes = get_holes_coords(gerber_obj, settings.hole_aperture_functions, debug=settings.debug)
+    drill_bits = get_drill_bits(pad_sizes, settings.drill_bits, settings.min_annular_ring)
+
+    # one batch of holes per drill bit, smallest bit first, each batch ordered starting where the previous one ended
+    batches = []
+    rapid_distances = (0, 0)
+    position = (0, 0)
+    for drill_bit in np.unique(drill_bits).tolist():
+        batch = coordinates[drill_bits == drill_bit]
+        order, batch_rapid_distances = order_points(batch, position, time_budget=settings.travel_optimization_time, debug=settings.debug)
+        batches.append((drill_bit, batch[order]))
+        rapid_distances = (rapid_distances[0] + batch_rapid_distances[0], rapid_distances[1] + batch_rapid_distances[1])
+        position = tuple(batches[-1][1][-1])
+
+    # Drilling depth is relative to the PCB surface
+    height_map = get_height_map(settings)
 
     ### Gcode
-    gcode = ''
 
-    gcode += '\n; PCB hole drilling Gcode\n\n'
+    yield '\n; PCB hole drilling Gcode\n\n'
+    yield travel_comment(rapid_distances, 'holes', settings.rapid_feedrate)
 
     #  Starting Spindle and Setting the correct spindle speed
-    gcode += set_non_modal_options(spindle_speed=settings.spindle_speed,
+    yield set_non_modal_options(spindle_speed=settings.spindle_speed,
             feedrate=settings.spindle_feedrate_Z_hole,
             comment="Settings Non Modal Groups")
 
     # Making sure Modal Group settings are correct
-    gcode += set_modal_options(MotionMode.USE_FEEDRATE, 
+    yield set_modal_options(MotionMode.USE_FEEDRATE, 
             DistanceMode.ABSOLUTE, 
             UnitMode.MM, 
             PlaneSelect.XY, 
@@ -525,29 +741,42 @@ def generate_holes_gcode(gerber_obj: gerber.rs274x.GerberFile, settings) -> str:
             comment="Setting Modal Groups\n")
 
     # Starting Spindle Away from surface
-    gcode += move(MotionMode.RAPID,
+    yield move(MotionMode.RAPID,
             DistanceMode.ABSOLUTE,
             Z=2,
             comment="Going Up from surface to start spindle")
-    gcode += set_modal_options(SpindleState.ON_CW, 
+    yield set_modal_options(SpindleState.ON_CW, 
             comment="Spindle ON CW")
-    gcode += dwell(settings.spindle_dwell_time, comment="dwell for {settings.spindle_dwell_time} seconds so motor reaches full RPM\n")
+    yield dwell(settings.spindle_dwell_time, comment=f"dwell for {settings.spindle_dwell_time} seconds so motor reaches full RPM\n")
+
+    # One rapid, plunge and retract per hole, the drilling depth is only variable with a height map
+    rapid_to_hole = MoveTemplate(MotionMode.RAPID, axes='XY')
+    if height_map is not None:
+        plunge = MoveTemplate(MotionMode.USE_FEEDRATE, axes='Z', feedrate=settings.spindle_feedrate_Z_hole)
+    else:
+        plunge = MoveTemplate(MotionMode.USE_FEEDRATE, axes='', z=settings.spindle_Z_down_hole, feedrate=settings.spindle_feedrate_Z_hole)
+    retract = MoveTemplate(MotionMode.RAPID, axes='', z=settings.spindle_Z_up_position)
 
     # Cutting starts here :)
-    for coordinate in coordinates:
-        gcode += move(MotionMode.RAPID, 
-                coordinate=coordinate)
-        gcode += move(MotionMode.USE_FEEDRATE,
-                z=settings.spindle_Z_down_hole, 
-                feedrate=settings.spindle_feedrate_Z_hole)
-        gcode += move(MotionMode.RAPID,
-                z=settings.spindle_Z_up_position)
-    gcode += '\n'
+    for batch_ind, (drill_bit, batch) in enumerate(batches):
+        yield f"; Drill bit {drill_bit:g} mm: {len(batch)} holes\n"
+
+        # Pausing to change the bit with the spindle stopped
+        if batch_ind:
+            yield set_modal_options(SpindleState.OFF, comment="Spindle OFF to change the bit")
+            yield f"M0 ; Change to the {drill_bit:g} mm drill bit then resume\n"
+            yield set_modal_options(SpindleState.ON_CW, comment="Spindle ON CW")
+            yield dwell(settings.spindle_dwell_time, comment=f"dwell for {settings.spindle_dwell_time} seconds so motor reaches full RPM")
+
+        if height_map is not None:
+            batch = np.column_stack((batch, settings.spindle_Z_down_hole + height_map.get_z(batch[:, 0], batch[:, 1])))
+
+        yield format_moves((rapid_to_hole, plunge, retract), batch)
+        yield '\n'
 
     # deactivating the tool PWM
-    gcode += f'M5 ; disabling spindle PWM\n\n'
+    yield f'M5 ; disabling spindle PWM\n\n'
 
-    return gcode
 
 #def generate_ink_laying_gcode(gerber: gerber.rs274x.GerberFile, tool: Callable, tip_thickness: float, pen_down_position: int, 
 #        feedrate: int, debug: bool=False) -> str:
@@ -659,99 +888,275 @@ def generate_holes_gcode(gerber_obj: gerber.rs274x.GerberFile, settings) -> str:
 #    return gcode
 
 
-def generate_laser_engraving_trace_gcode(gerber_obj: gerber.rs274x.GerberFile, settings) -> str:
+def generate_laser_engraving_trace_gcode(gerber_obj: gerber.rs274x.GerberFile, settings) -> Iterator[str]:
     '''
     :param gerber_file: the file that we want to get the holes coordinate from
 
     :param settings: number of passes done by laser
 
-    :return: This function creates the gcode content as string according to the input coordinates
+    :return: yields the gcode content piece by piece as it's created, see GcodeWriter
     '''
-    gcode = ''
 
-    gcode += '\n; PCB trace laser engraving Gcode\n\n'
+    yield '\n; PCB trace laser engraving Gcode\n\n'
 
     # Setting GRBL mode to laser mode
-    gcode += "; Please Check $32 is equal to 1 for Laser Mode\n\n"
+    yield "; Please Check $32 is equal to 1 for Laser Mode\n\n"
 
     # Activiate Tool number 1, The Laser Module
     if settings.tool:
-        gcode += settings.tool(ToolChange.Select, settings.Tool.Laser)
+        yield settings.tool(ToolChange.Select, settings.Tool.Laser)
     
     # Setting the laser module movment feedrate
-    gcode += f'F{settings.feedrate} ; setting default feedrate\n\n'
+    yield f'F{settings.feedrate} ; setting default feedrate\n\n'
+
+    # Making sure Modal Group settings are correct
+    yield set_modal_options(MotionMode.USE_FEEDRATE, 
+            DistanceMode.ABSOLUTE, 
+            UnitMode.MM, 
+            PlaneSelect.XY, 
+            FeedRateMode.UNIT_PER_MIN,
+            comment="Setting Modal Groups")
 
     # Setting the Optimum focal distance by moving the Z position in the correct coordinate
-    gcode += move(MotionMode.RAPID, comment='Moving to correct focal length Z position\n', z=settings.optimum_focal_distance)
+    yield move(MotionMode.RAPID, comment='Moving to correct focal length Z position\n', z=settings.optimum_focal_distance)
 
     # Setting the correct laser Power
-    gcode += f"S{settings.laser_power} ; Setting Laser Power\n\n"
+    yield f"S{settings.laser_power} ; Setting Laser Power\n\n"
 
     ### PCB trace laser marking Gcode
     # Getting Offset Points for laser module to burn in 
     # The bulk of the code is in this single line ;)
     coordinate_lists = get_traces_outlines(gerber_obj, settings.include_edge_cuts, debug=settings.debug)  
+    coordinate_lists, removed_lines = simplify_toolpath(coordinate_lists, settings.simplify_tolerance, settings.min_segment_length, debug=settings.debug)
+    coordinate_lists, rapid_distances = order_toolpath(coordinate_lists, time_budget=settings.travel_optimization_time, debug=settings.debug)
+    yield simplification_comment(removed_lines)
+    yield travel_comment(rapid_distances)
 
-    gcode += f"; Number of passes: {settings.laser_passes}\n\n"
+    yield f"; Number of passes: {settings.laser_passes}\n\n"
+    loops_arcs = fit_arcs(coordinate_lists, settings.arc_tolerance)
     for pass_num in range(laser_passes):
-        gcode += f'; Pass number: {settings.pass_num+1}\n'
+        yield f'; Pass number: {settings.pass_num+1}\n'
 
-        for coordinate_list in coordinate_lists:
-            gcode += move(coordinate=coordinate_list[0])
-            gcode += "M3\n"
+        for ind, coordinate_list in enumerate(coordinate_lists):
+            yield move_path(coordinate_list[:1])
+            yield "M3\n"
 
-            for coordinate in coordinate_list[1:]:
-                gcode += move(coordinate=coordinate)
+            yield move_path_arcs(coordinate_list, loops_arcs[ind])
 
-            gcode += move(coordinate=coordinate_list[0])  #TODO: ??!??!?! what is this ???!?!
-            gcode += "M5\n"
+            yield move_path(coordinate_list[:1])  #TODO: ??!??!?! what is this ???!?!
+            yield "M5\n"
 
-    gcode += '\n'
+    yield '\n'
 
     # Deactivate End Effector Signal
-    gcode += f'M5 ; Disable End-Effector Signal\n\n'
+    yield f'M5 ; Disable End-Effector Signal\n\n'
 
     # Get the tool back and deselect it
     if settings.tool:
-        gcode += tool(ToolChange.Deselect, settings.Tool.Laser)
+        yield tool(ToolChange.Deselect, settings.Tool.Laser)
+
+
+def generate_laser_raster_gcode(gerber_obj: gerber.rs274x.GerberFile, settings) -> Iterator[str]:
+    '''
+    Laser fill of the copper (or of everything but the copper with laser_raster_negative) line by line instead of tracing outlines
+
+    Step-1: rasterize the merged copper into a bitmap of laser_raster_dpi
+    Step-2: run-length encode each row, one G1 move per run of burnt or blank pixels, blank ends and blank rows skipped
+    Step-3: rows are burnt in alternate directions (bidirectional) with M4 dynamic laser power, GRBL scales the power
+            with the actual speed so the accelerations at the ends of the runs aren't burnt darker
+    Done :D
+
+    :param gerber_obj: the gerber file object
+    :param settings: the settings parameter
+
+    :return: yields the gcode content piece by piece as it's created, see GcodeWriter
+    '''
+    ### Preparations
+    # Step 1: the bitmap
+    pixel_size = 25.4 / settings.laser_raster_dpi
+    toolpath = get_traces_outlines(gerber_obj, chord_tolerance=settings.chord_tolerance, debug=settings.debug)
+    (x_min, x_max), (y_min, y_max) = gerber_obj.bounds
+    bitmap = rasterize_toolpath(toolpath, pixel_size, gerber_obj.bounds)
+    if settings.laser_raster_negative:
+        bitmap = ~bitmap
+
+    # Step 2: runs, each row starts and ends with a burnt run so there are 2 * runs - 1 moves per row
+    edges = np.diff(np.pad(bitmap, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    run_rows, run_starts = np.nonzero(edges == 1)
+    run_ends = np.nonzero(edges == -1)[1]
+    rows, row_first_runs = np.unique(run_rows, return_index=True)
+    row_first_runs = np.append(row_first_runs, len(run_rows))
+    if settings.debug:
+        print(f"Laser raster: {bitmap.shape[1]}x{bitmap.shape[0]} pixels, {len(rows)} rows with {len(run_rows)} runs to burn")
+
+    ### Gcode
+
+    yield '\n; PCB laser raster engraving Gcode\n\n'
+    yield f"; {settings.laser_raster_dpi} DPI ({pixel_size:.4f} mm between rows), {len(rows)} rows with {len(run_rows)} burnt runs\n\n"
+
+    # Setting GRBL mode to laser mode
+    yield "; Please Check $32 is equal to 1 for Laser Mode\n\n"
+
+    # Activiate Tool number 1, The Laser Module
+    if settings.tool:
+        yield settings.tool(ToolChange.Select, Tool.Laser)
+
+    # Making sure Modal Group settings are correct
+    yield set_modal_options(MotionMode.USE_FEEDRATE, 
+            DistanceMode.ABSOLUTE, 
+            UnitMode.MM, 
+            PlaneSelect.XY, 
+            FeedRateMode.UNIT_PER_MIN,
+            comment="Setting Modal Groups")
+
+    # Setting the Optimum focal distance by moving the Z position in the correct coordinate
+    yield move(MotionMode.RAPID, z=settings.optimum_laser_Z_position, comment='Moving to correct focal length Z position\n')
+
+    # Laser on in dynamic power mode, not burning until a G1 move with power
+    yield set_non_modal_options(feedrate=settings.pcb_trace_feedrate, spindle_speed=0, comment="setting default feedrate")
+    yield set_modal_options(SpindleState.ON_CCW, comment="Laser ON, dynamic power (M4)\n")
+
+    # Step 3: the rows
+    burn = f"G1X%.3fS{settings.laser_power}\n"
+    skip = "G1X%.3fS0\n"
+    for pass_num in range(settings.laser_passes):
+        yield f'; Pass number: {pass_num+1}\n'
+
+        for row_ind, row in enumerate(rows.tolist()):
+            run_slice = slice(row_first_runs[row_ind], row_first_runs[row_ind+1])
+            starts = (x_min + run_starts[run_slice] * pixel_size).tolist()
+            ends = (x_min + run_ends[run_slice] * pixel_size).tolist()
+
+            # every other row right to left
+            if row_ind % 2:
+                starts, ends = ends[::-1], starts[::-1]
+
+            lines = ["G0X%.3fY%.3f\n" % (starts[0], y_min + (row + 0.5) * pixel_size)]
+            for run_ind, (start, end) in enumerate(zip(starts, ends)):
+                if run_ind:
+                    lines.append(skip % start)
+                lines.append(burn % end)
+
+            yield TRAILING_ZEROS_REGEX.sub(r'\1', ''.join(lines))
+
+        yield '\n'
+
+    # Deactivate End Effector Signal
+    yield f'M5 ; Disable End-Effector Signal\n\n'
+
+    # Get the tool back and deselect it
+    if settings.tool:
+        yield settings.tool(ToolChange.Deselect, Tool.Laser)
+
+
+def generate_laser_hatch_gcode(gerber_obj: gerber.rs274x.GerberFile, settings) -> Iterator[str]:
+    '''
+    Laser fill of the copper with vector hatching: the outlines shrunk by half the laser spot then hatch lines one spot apart,
+    see get_hatch_fill(). Outlines and hatch lines are ordered to shorten the rapid moves between them
+
+    :param gerber_obj: the gerber file object
+    :param settings: the settings parameter
+
+    :return: yields the gcode content piece by piece as it's created, see GcodeWriter
+    '''
+    ### Preparations
+    outlines, hatch = get_hatch_fill(gerber_obj, settings.laser_spot_size, settings.hatch_angle, settings.chord_tolerance, debug=settings.debug)
+    outlines, outlines_rapid_distances = order_toolpath(outlines, time_budget=settings.travel_optimization_time, debug=settings.debug)
+    end = tuple(outlines.coords[-1, :2]) if outlines.num_vertices else (0, 0)
+    hatch, hatch_rapid_distances = order_open_paths(hatch, end, debug=settings.debug)
+
+    ### Gcode
+
+    yield '\n; PCB laser hatch engraving Gcode\n\n'
+    yield f"; {len(outlines)} outlines and {len(hatch)} hatch lines {settings.laser_spot_size} mm apart\n"
+    yield travel_comment(outlines_rapid_distances, 'outlines')
+    yield travel_comment(hatch_rapid_distances, 'hatch lines')
+
+    # Setting GRBL mode to laser mode
+    yield "; Please Check $32 is equal to 1 for Laser Mode, the laser is off during G0 moves\n\n"
+
+    # Activiate Tool number 1, The Laser Module
+    if settings.tool:
+        yield settings.tool(ToolChange.Select, Tool.Laser)
+
+    # Making sure Modal Group settings are correct
+    yield set_modal_options(MotionMode.USE_FEEDRATE, 
+            DistanceMode.ABSOLUTE, 
+            UnitMode.MM, 
+            PlaneSelect.XY, 
+            FeedRateMode.UNIT_PER_MIN,
+            comment="Setting Modal Groups")
+
+    # Setting the Optimum focal distance by moving the Z position in the correct coordinate
+    yield move(MotionMode.RAPID, z=settings.optimum_laser_Z_position, comment='Moving to correct focal length Z position\n')
+
+    # Laser on in dynamic power mode, GRBL only burns during G1 moves
+    yield set_non_modal_options(feedrate=settings.pcb_trace_feedrate, spindle_speed=settings.laser_power, comment="setting default feedrate and laser power")
+    yield set_modal_options(SpindleState.ON_CCW, comment="Laser ON, dynamic power (M4)\n")
+
+    # G0 to the start of each outline or hatch line (laser off) then G1 along it
+    rapid = MoveTemplate(MotionMode.RAPID, axes='XY')
+    burn = MoveTemplate(MotionMode.USE_FEEDRATE, axes='XY')
+
+    for pass_num in range(settings.laser_passes):
+        yield f'; Pass number: {pass_num+1}\n'
+
+        # the outlines are closed loops, the hatch lines are single segments formatted as (rapid, burn) blocks all at once
+        for coordinate_list in outlines:
+            yield rapid.format(coordinate_list[:1, :2])
+            yield burn.format(coordinate_list[1:, :2])
+
+        yield format_moves((rapid, burn), hatch.coords[:, :2].reshape(-1, 4))
+
+        yield '\n'
+
+    # Deactivate End Effector Signal
+    yield f'M5 ; Disable End-Effector Signal\n\n'
+
+    # Get the tool back and deselect it
+    if settings.tool:
+        yield settings.tool(ToolChange.Deselect, Tool.Laser)
 
-    return gcode
 
-def generate_spindle_engraving_trace_gcode(gerber_obj: gerber.rs274x.GerberFile, settings) -> str:
+def generate_spindle_engraving_trace_gcode(gerber_obj: gerber.rs274x.GerberFile, settings) -> Iterator[str]:
     '''
     :param gerber_file: the gerber file object
     :param settings: the settings parameter
 
-    :return: This function creates the gcode content as string according to the input coordinates
+    :return: yields the gcode content piece by piece as it's created, see GcodeWriter
     '''
     ### Preparations
-    if settings.height_map:
-        with open(settings.height_map, 'r') as f:
-            height_map = json.load(f)
-    else:
-        height_map = None
     coordinate_lists = get_traces_outlines(
             gerber_obj, 
             settings.spindle_bit_offset, 
-            height_map=height_map, 
+            height_map=get_height_map(settings), 
             Z_offset_from_0=settings.spindle_Z_down_engrave,
+            z_tolerance=settings.height_map_z_tolerance,
+            snap_to_grid=settings.union_snap_to_grid,
+            chord_tolerance=settings.chord_tolerance,
+            debug=settings.debug)
+    coordinate_lists, removed_lines = simplify_toolpath(coordinate_lists, settings.simplify_tolerance, settings.min_segment_length, debug=settings.debug)
+    coordinate_lists, rapid_distances = order_toolpath(coordinate_lists, 
+            reverse=is_climb_milling(settings.spindle_milling_direction), 
+            time_budget=settings.travel_optimization_time, 
             debug=settings.debug)
 
     ### Gcode
-    gcode = ''
 
-    gcode += '\n; Spindle trace Spindle engraving Gcode\n\n'
+    yield '\n; Spindle trace Spindle engraving Gcode\n\n'
+    yield simplification_comment(removed_lines)
+    yield travel_comment(rapid_distances)
 
     # Setting GRBL mode to spindle mode
-    gcode += "; Please Check $32 is equal to 0 for Spindle Mode\n\n"
+    yield "; Please Check $32 is equal to 0 for Spindle Mode\n\n"
 
     #  Starting Spindle and Setting the correct spindle speed
-    gcode += set_non_modal_options(spindle_speed=settings.spindle_speed,
+    yield set_non_modal_options(spindle_speed=settings.spindle_speed,
             feedrate=settings.spindle_feedrate_XY_engrave,
             comment="Settings Non Modal Groups")
 
     # Making sure Modal Group settings are correct
-    gcode += set_modal_options(MotionMode.USE_FEEDRATE, 
+    yield set_modal_options(MotionMode.USE_FEEDRATE, 
             DistanceMode.ABSOLUTE, 
             UnitMode.MM, 
             PlaneSelect.XY, 
@@ -759,81 +1164,78 @@ def generate_spindle_engraving_trace_gcode(gerber_obj: gerber.rs274x.GerberFile,
             comment="Setting Modal Groups\n")
 
     # Starting Spindle Away from surface
-    gcode += move(MotionMode.RAPID,
+    yield move(MotionMode.RAPID,
             DistanceMode.ABSOLUTE,
             Z=2,
             comment="Going Up from surface to start spindle")
-    gcode += set_modal_options(SpindleState.ON_CW, 
+    yield set_modal_options(SpindleState.ON_CW, 
             comment="Spindle ON CW")
-    gcode += dwell(2, comment="dwell for 2 seconds so motor reaches full RPM\n")
+    yield dwell(2, comment="dwell for 2 seconds so motor reaches full RPM\n")
     
+    # Same rapid, plunge and retract for every loop
+    rapid_to_loop = MoveTemplate(MotionMode.RAPID, axes='XY', z=float(settings.spindle_Z_up_position))
+    plunge = MoveTemplate(axes='Z', feedrate=settings.spindle_feedrate_Z_engrave)
+    retract = MoveTemplate(MotionMode.RAPID, axes='', Z=settings.spindle_Z_up_position)
+
     # PCB trace engraving Gcode
+    loops_arcs = fit_arcs(coordinate_lists, settings.arc_tolerance)
     for ind, coordinate_list in enumerate(coordinate_lists):
-        gcode += f"; Engraving Trace No. {ind}\n"
-
-        # Go to start of Loop
-        gcode += move(MotionMode.RAPID, 
-                    coordinate=Point(coordinate_list[0].x,
-                                    coordinate_list[0].y,
-                                    settings.spindle_Z_up_position))
+        yield f"; Engraving Trace No. {ind}\n"
 
-        # Spindle Down, Start engraving
-        gcode += move(Z=coordinate_list[0].z, feedrate=settings.spindle_feedrate_Z_engrave)
+        # Go to start of Loop, Spindle Down, Start engraving
+        yield format_moves((rapid_to_loop, plunge), coordinate_list[:1])
 
         # Setting engraving feedrate
-        gcode += set_non_modal_options(feedrate=settings.spindle_feedrate_XY_engrave,
+        yield set_non_modal_options(feedrate=settings.spindle_feedrate_XY_engrave,
                                         comment="setting default feedrate")
 
         # Continue Loop
-        for coordinate in coordinate_list[1:]:
-            gcode += move(coordinate=coordinate)
+        yield move_path_arcs(coordinate_list, loops_arcs[ind])
 
         # Complete the Loop
-        gcode += move(coordinate=coordinate_list[0])
+        yield move_path(coordinate_list[:1])
 
         # CCW spindle movement if wanted
         if settings.add_spindle_trace_ccw_path:
-            gcode += f"\n; Engraving Trace No. {ind} CCW\n"
-            for coordinate in coordinate_list[::-1]:
-                gcode += move(coordinate=coordinate)
+            yield f"\n; Engraving Trace No. {ind} CCW\n"
+            yield move_path_arcs(coordinate_list[::-1], reverse_arcs(loops_arcs[ind], len(coordinate_list)))
 
         # Spindle Up, Stop engraving
-        gcode += move(MotionMode.RAPID,
-                      Z=settings.spindle_Z_up_position)
+        yield retract()
 
-        gcode += '\n'
+        yield '\n'
 
     # Deactivate End Effector Signal
-    gcode += set_modal_options(SpindleState.OFF, comment="Disable Spindle\n")
+    yield set_modal_options(SpindleState.OFF, comment="Disable Spindle\n")
 
-    return gcode
 
-def generate_spindle_edge_cut_gcode(gerber_obj: gerber.rs274x.GerberFile, settings):
+def generate_spindle_edge_cut_gcode(gerber_obj: gerber.rs274x.GerberFile, settings) -> Iterator[str]:
     '''
     :param gerber_file: the gerber file object
     :param settings: the settings parameter
 
-    :return: This function creates the gcode content as string according to the input coordinates
+    :return: yields the gcode content piece by piece as it's created, see GcodeWriter
     '''
     ### Preparations
+    # NOTE: not implemented yet, raises NotImplementedError before any gcode is yielded
     coordinate_lists = get_spindle_edge_cut_coords(gerber_obj, 
-                                settings.spindle_bit_offset)
+                                settings.spindle_bit_offset, 
+                                debug=settings.debug)
 
     ### Gcode
-    gcode = ''
 
-    gcode += '\n; Spindle trace Spindle engraving Gcode\n\n'
+    yield '\n; Spindle trace Spindle engraving Gcode\n\n'
 
     # Setting GRBL mode to spindle mode
-    gcode += "; Please Check $32 is equal to 0 for Spindle Mode\n\n"
+    yield "; Please Check $32 is equal to 0 for Spindle Mode\n\n"
 
     #  Starting Spindle and Setting the correct spindle speed
-    gcode += set_non_modal_options(spindle_speed=settings.spindle_speed,
+    yield set_non_modal_options(spindle_speed=settings.spindle_speed,
             feedrate=settings.spindle_feedrate_XY_engrave,
             comment="Settings Non Modal Groups\n")
 
     # Making sure Modal Group settings are correct
-    gcode += set_modal_options(MotionMode.USE_FEEDRATE, 
+    yield set_modal_options(MotionMode.USE_FEEDRATE, 
             DistanceMode.ABSOLUTE, 
             UnitMode.MM, 
             PlaneSelect.XY, 
@@ -841,57 +1243,663 @@ def generate_spindle_edge_cut_gcode(gerber_obj: gerber.rs274x.GerberFile, settin
             comment="Setting Modal Groups")
 
     # Starting Spindle Away from surface
-    gcode += move(MotionMode.RAPID,
+    yield move(MotionMode.RAPID,
             DistanceMode.ABSOLUTE,
             Z=2,
             comment="Going Up from surface to start spindle")
-    gcode += set_modal_options(SpindleState.ON_CW, 
+    yield set_modal_options(SpindleState.ON_CW, 
             comment="Spindle ON CW")
-    gcode += dwell(2, comment="dwell for 2 seconds so motor reaches full RPM\n")
+    yield dwell(2, comment="dwell for 2 seconds so motor reaches full RPM\n")
 
-    ## PCB Spindle Edge cutting
-    for ind, coordinate_list in enumerate(coordinate_lists1):
-        gcode += f"; Cutting Edge No. {ind}\n"
+    # Same rapid, plunge and retract for every loop
+    rapid_to_loop = MoveTemplate(MotionMode.RAPID, axes='XY', z=float(settings.spindle_Z_up_position))
+    plunge = MoveTemplate(axes='Z', feedrate=settings.spindle_feedrate_Z_engrave)
+    retract = MoveTemplate(MotionMode.RAPID, axes='', Z=settings.spindle_Z_up_position)
 
-        # Go to start of Loop
-        gcode += move(MotionMode.RAPID, 
-                    coordinate=Point(coordinate_list[0].x,
-                                    coordinate_list[0].y,
-                                    settings.spindle_Z_up_position))
+    ## PCB Spindle Edge cutting
+    for ind, coordinate_list in enumerate(coordinate_lists):
+        yield f"; Cutting Edge No. {ind}\n"
 
-        # Spindle Down, Start engraving
-        gcode += move(Z=coordinate_list[0].z, feedrate=settings.spindle_feedrate_Z_engrave)
+        # Go to start of Loop, Spindle Down, Start engraving
+        yield format_moves((rapid_to_loop, plunge), coordinate_list[:1])
 
         # Setting engraving feedrate
-        gcode += set_non_modal_options(feedrate=settings.spindle_feedrate_XY_cutting,
+        yield set_non_modal_options(feedrate=settings.spindle_feedrate_XY_cutting,
                                         comment="setting default feedrate")
 
         # Continue Loop
-        for coordinate in coordinate_list[1:]:
-            gcode += move(coordinate=coordinate)
+        yield move_path(coordinate_list[1:])
 
         # Spindle Up, Stop engraving
-        gcode += move(MotionMode.RAPID,
-                      Z=settings.spindle_Z_up_position)
+        yield retract()
 
-        gcode += '\n'
+        yield '\n'
 
      # Deactivate End Effector Signal
-    gcode += set_modal_options(SpindleState.OFF, comment="Disable Spindle\n")
+    yield set_modal_options(SpindleState.OFF, comment="Disable Spindle\n")
 
-    return gcode
 
 
 
-def export_gcode(gcode: str, file_name: str) -> None:
+GCODE_WORD_REGEX = re.compile(r'([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))')
+GCODE_COMMENT_REGEX = re.compile(r'\([^)]*\)|;.*')
+
+# the modal group of each G and M word, from the option enums
+MODAL_GROUPS = {(command_keyword, float(option.value)): option_group
+                for option_group, command_keyword in ALL_OPTION_GROUPS.items() for option in option_group}
+
+def trim_number(number: str) -> str:
+    '''
+    shortest text of the same decimal number, e.g. 12.000 -> 12, -0.50 -> -.5, -0.0 -> 0, +3 -> 3
+
+    :param number: a gcode word value
+    '''
+    number = number.lstrip('+')
+    sign = '-' if number.startswith('-') else ''
+    number = number.lstrip('-')
+    if '.' in number:
+        number = number.rstrip('0').rstrip('.')
+    number = number.lstrip('0')
+
+    if not number.strip('.0'):
+        return '0'
+    return sign + number
+
+class GcodeCompressor:
+    '''
+    Removes everything a gcode line says that the machine already knows, keeping the exact same meaning:
+    modal G and M words (G1, G90, M3...) equal to the active ones, X, Y, Z words equal to the current position,
+    F and S words equal to the current feedrate and spindle speed, comments, spaces and the zeros of the numbers (X12.0 -> X12).
+    Lines left with nothing to say are dropped.
+
+    Every line is fed through one compressor in order as its state is the machine's state at that line.
+    Nothing is assumed before the first line: the first value of every word is always kept.
+    Lines it doesn't understand ($ commands, unknown letters) are kept as they are, the state they change is forgotten
+
+    compressor = GcodeCompressor()
+    compressor.compress('G90G94\nG1X1.000Y2.0F100\nG1X1.000Y3.0F100  ; comment\n') -> 'G90G94\nG1X1Y2F100\nY3\n'
+    '''
+    AXES = 'XYZ'
+
+    def __init__(self):
+        self.modal_state = {}  # modal group -> active value
+        self.position = {}  # axis -> trimmed absolute value, missing when unknown
+        self.feedrate = None
+        self.spindle_speed = None
+        self.partial_line = ''  # end of a piece of gcode that wasn't a full line yet
+
+    def forget_position(self) -> None:
+        self.position = {}
+
+    def compress(self, gcode: str) -> str:
+        '''
+        :param gcode: gcode lines, the last line is kept for the next call until its end of line arrives
+        :return: the compressed gcode lines
+        '''
+        lines = (self.partial_line + gcode).split('\n')
+        self.partial_line = lines.pop()
+
+        compressed_lines = [self.compress_line(line) for line in lines]
+
+        return ''.join(line + '\n' for line in compressed_lines if line)
+
+    def flush(self) -> str:
+        '''
+        :return: the compressed last line, if the gcode didn't end with an end of line
+        '''
+        line = self.compress_line(self.partial_line)
+        self.partial_line = ''
+        return line + '\n' if line else ''
+
+    def compress_line(self, line: str) -> str:
+        '''
+        :param line: one gcode line without its end of line
+        :return: the compressed line, empty if nothing needs to be sent
+        '''
+        line = GCODE_COMMENT_REGEX.sub('', line).replace(' ', '').replace('\t', '').upper()
+        if not line:
+            return ''
+
+        words = GCODE_WORD_REGEX.findall(line)
+        if ''.join(letter + value for letter, value in words) != line:
+            # system commands and anything not made of letter-number words
+            self.modal_state, self.feedrate, self.spindle_speed = {}, None, None
+            self.forget_position()
+            return line
+
+        words = [(letter, trim_number(value)) for letter, value in words]
+        commands = [(letter, float(value)) for letter, value in words if letter in 'GM']
+
+        ### Step 1: Lines with special commands are kept whole
+        # non modal G words (dwell, homing, coordinate offsets, machine coordinates), probing and unknown M words
+        is_special = any((letter, value) not in MODAL_GROUPS or MODAL_GROUPS[(letter, value)] in (ProgramMode, CoolantState)
+                         for letter, value in commands)
+        is_probe = any(MODAL_GROUPS.get(command) == MotionMode and command[1] >= 38 for command in commands)
+        if is_special or is_probe:
+            for letter, value in words:
+                if letter == 'F':
+                    self.feedrate = value
+                elif letter == 'S':
+                    self.spindle_speed = value
+            for command in commands:
+                if command in MODAL_GROUPS and MODAL_GROUPS[command] not in (ProgramMode, CoolantState):
+                    self.modal_state[MODAL_GROUPS[command]] = command[1]
+            if any(command[0] == 'M' and command[1] in (2, 30) for command in commands):
+                # program end resets the modal state
+                self.modal_state, self.feedrate, self.spindle_speed = {}, None, None
+            if any(command[0] == 'G' and command[1] != 4 for command in commands):
+                self.forget_position()
+            elif self.modal_state.get(DistanceMode) != DistanceMode.ABSOLUTE.value:
+                self.forget_position()
+            else:
+                self.position.update((letter, value) for letter, value in words if letter in self.AXES)
+            return ''.join(letter + value for letter, value in words)
+
+        ### Step 2: Modal words, kept only if they change the active mode
+        motion_mode = self.modal_state.get(MotionMode)
+        compressed_words = []
+        for letter, value in words:
+            if letter in 'GM':
+                option_group = MODAL_GROUPS[(letter, float(value))]
+                if self.modal_state.get(option_group) == float(value):
+                    continue
+                self.modal_state[option_group] = float(value)
+
+                # the position and feedrate were in the old units
+                if option_group in (UnitMode, FeedRateMode):
+                    self.forget_position()
+                    self.feedrate = None
+
+            elif letter == 'F':
+                # inverse time feedrates (G93) are only for their own line
+                if self.modal_state.get(FeedRateMode) != FeedRateMode.UNIT_PER_MIN.value:
+                    self.feedrate = None
+                elif self.feedrate == value:
+                    continue
+                else:
+                    self.feedrate = value
+
+            elif letter == 'S':
+                if self.spindle_speed == value:
+                    continue
+                self.spindle_speed = value
+
+            compressed_words.append((letter, value))
+
+        ### Step 3: Axis words, kept only if they move the machine
+        if self.modal_state.get(DistanceMode) != DistanceMode.ABSOLUTE.value:
+            # incremental (or unknown) distance mode, every axis word is a move
+            self.forget_position()
+        else:
+            moving_words = []
+            for letter, value in compressed_words:
+                if letter in self.AXES:
+                    if self.position.get(letter) == value:
+                        continue
+                    self.position[letter] = value
+                moving_words.append((letter, value))
+
+            # GRBL refuses arcs without an axis word in the plane (e.g. full circles), those keep their end point
+            is_arc = self.modal_state.get(MotionMode) in (MotionMode.CIRCULAR_CW.value, MotionMode.CIRCULAR_CCW.value)
+            if is_arc and not any(letter in self.AXES for letter, value in moving_words):
+                moving_words = compressed_words
+
+            compressed_words = moving_words
+
+            # a motion mode without a move (e.g. closing a loop already closed) waits for the next line that moves
+            if [letter for letter, value in compressed_words] == ['G'] and MODAL_GROUPS[('G', float(compressed_words[0][1]))] == MotionMode:
+                self.modal_state[MotionMode] = motion_mode
+                return ''
 
+        return ''.join(letter + value for letter, value in compressed_words)
+
+    def __repr__(self) -> str:
+        return f"GcodeCompressor(modal_state={self.modal_state}, position={self.position})"
+
+def get_block_times(moves: np.ndarray, feedrates: np.ndarray, max_rates: tuple[float, float, float], accelerations: tuple[float, float, float],
+        junction_deviation: float, entry_speed: float = 0) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Times the straight blocks of one continuous motion the way the GRBL planner runs them (trapezoidal speed profiles):
+    each block accelerates, cruises then decelerates, the speed through the corners is limited by the junction deviation
+    and the machine ends at rest.
+
+    Procedure:
+    Step-1: nominal speed and acceleration of every block, limited by the axes moving in it
+    Step-2: maximum speed through every corner (junction deviation)
+    Step-3: backward then forward pass, the entry speeds reachable by decelerating and accelerating along the blocks
+    Step-4: time of each trapezoid (or triangle when the block is too short to reach its nominal speed)
+    Done :D
+
+    :param moves: (n, 3) X, Y, Z displacements in mm
+    :param feedrates: (n,) wanted feedrate of each block in mm/min, np.inf for rapid moves
+    :param max_rates: X, Y, Z maximum rates in mm/min (GRBL $110, $111, $112)
+    :param accelerations: X, Y, Z accelerations in mm/sec^2 (GRBL $120, $121, $122)
+    :param junction_deviation: GRBL $11 in mm
+    :param entry_speed: speed at the start of the first block in mm/sec, 0 when starting from rest
+
+    :return: (n,) seconds spent on each block, (n,) entry speed of each block in mm/sec,
+        (n,) whether the block enters at its maximum speed: the blocks before it keep their times whatever blocks come
+        after the last one (GRBL's planned blocks)
+    '''
+    times = np.zeros(len(moves))
+    all_entry_speeds = np.zeros(len(moves))
+    all_is_planned = np.zeros(len(moves), dtype=bool)
+    lengths = np.linalg.norm(moves, axis=1)
+    moving = lengths > 1e-9  # GRBL drops the blocks that don't move
+    if not moving.any():
+        return times, all_entry_speeds, all_is_planned
+
+    moves, lengths = moves[moving], lengths[moving]
+    units = moves / lengths[:, None]
+
+    def limit_by_axes(values: np.ndarray, directions: np.ndarray) -> np.ndarray:
+        # the value along each direction such that no axis goes above its own value
+        with np.errstate(divide='ignore'):
+            return np.min(np.where(directions != 0, values / np.abs(directions), np.inf), axis=1)
+
+    ### Step 1: nominal speeds and accelerations, mm/sec
+    nominal_speeds = np.minimum(np.asarray(feedrates, dtype=float)[moving], limit_by_axes(np.asarray(max_rates, dtype=float), units)) / 60
+    block_accelerations = limit_by_axes(np.asarray(accelerations, dtype=float), units)
+
+    ### Step 2: junction speeds (squared)
+    cos_theta = -np.sum(units[:-1] * units[1:], axis=1)
+    junction_units = units[1:] - units[:-1]
+    junction_norms = np.linalg.norm(junction_units, axis=1)
+    junction_units = junction_units / np.where(junction_norms > 0, junction_norms, 1)[:, None]
+    junction_accelerations = limit_by_axes(np.asarray(accelerations, dtype=float), junction_units)
+
+    sin_theta_d2 = np.sqrt(np.clip(0.5 * (1 - cos_theta), 0, 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        junction_speeds_sqr = junction_accelerations * junction_deviation * sin_theta_d2 / (1 - sin_theta_d2)
+    junction_speeds_sqr[cos_theta > 0.999999] = 0  # reversing
+    junction_speeds_sqr[cos_theta < -0.999999] = np.inf  # straight on
+
+    max_entry_speeds_sqr = np.empty(len(units))
+    max_entry_speeds_sqr[0] = entry_speed**2
+    max_entry_speeds_sqr[1:] = np.minimum(junction_speeds_sqr, np.minimum(nominal_speeds[:-1], nominal_speeds[1:])**2)
+
+    ### Step 3: planner passes
+    speed_changes_sqr = (2 * block_accelerations * lengths).tolist()
+    entry_speeds_sqr = max_entry_speeds_sqr.tolist()
+
+    exit_speed_sqr = 0
+    for ind in range(len(entry_speeds_sqr) - 1, -1, -1):
+        exit_speed_sqr = entry_speeds_sqr[ind] = min(entry_speeds_sqr[ind], exit_speed_sqr + speed_changes_sqr[ind])
+    all_is_planned[moving] = np.array(entry_speeds_sqr) == max_entry_speeds_sqr
+
+    for ind in range(len(entry_speeds_sqr) - 1):
+        entry_speeds_sqr[ind+1] = min(entry_speeds_sqr[ind+1], entry_speeds_sqr[ind] + speed_changes_sqr[ind])
+
+    entry_speeds = np.sqrt(entry_speeds_sqr)
+    exit_speeds = np.append(entry_speeds[1:], 0)
+
+    ### Step 4: trapezoids
+    peak_speeds = np.sqrt((2 * block_accelerations * lengths + entry_speeds**2 + exit_speeds**2) / 2)
+    peak_speeds = np.minimum(peak_speeds, nominal_speeds)
+    ramps_lengths = (2 * peak_speeds**2 - entry_speeds**2 - exit_speeds**2) / (2 * block_accelerations)
+    times[moving] = (2 * peak_speeds - entry_speeds - exit_speeds) / block_accelerations + np.maximum(lengths - ramps_lengths, 0) / peak_speeds
+    all_entry_speeds[moving] = entry_speeds
+
+    return times, all_entry_speeds, all_is_planned
+
+PLANNER_BLOCK_COUNT = 16  # blocks GRBL plans ahead, BLOCK_BUFFER_SIZE on an Arduino Uno
+PLANNER_WINDOW = 1024  # blocks the estimator keeps before timing the older ones
+
+def format_duration(seconds: float) -> str:
+    '''
+    :return: H:MM:SS
+    '''
+    seconds = round(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+class MachiningTimeEstimator:
+    '''
+    Walks the gcode lines as they are written and estimates how long the machine takes to run them with get_block_times(),
+    with the lengths cut and travelled and the plunge and line counts, for each operation (holes, spindle, laser, edge cut)
+
+    The motion stops (the planned blocks end at rest) at every dwell, program pause and spindle change like GRBL,
+    arcs are split in straight segments like GRBL does with its $12 arc tolerance.
+    Only the last PLANNER_WINDOW blocks are kept, the older ones are timed with at least PLANNER_BLOCK_COUNT blocks
+    planned after them like GRBL, so the memory doesn't grow with the gcode.
+    The machine is assumed to start at (0, 0, 0), in absolute distance mode and millimeters
+
+    estimator = MachiningTimeEstimator((500, 500, 500), (10, 10, 10), 0.01)
+    estimator.set_operation('holes')
+    estimator.estimate(gcode)
+    estimator.finish() -> {'holes': {'time': 341.2, 'cut_length': 40.2, 'rapid_length': 611.3, 'plunges': 12, 'lines': 40}}
     '''
-    :param gcode: the actual gcode file content
+    def __init__(self, max_rates: tuple[float, float, float], accelerations: tuple[float, float, float], junction_deviation: float,
+            arc_tolerance: float = 0.002):
+        '''
+        :param max_rates: X, Y, Z maximum rates in mm/min (GRBL $110, $111, $112), also the speed of the rapid moves
+        :param accelerations: X, Y, Z accelerations in mm/sec^2 (GRBL $120, $121, $122)
+        :param junction_deviation: GRBL $11 in mm
+        :param arc_tolerance: GRBL $12 in mm
+        '''
+        self.max_rates = tuple(max_rates)
+        self.accelerations = tuple(accelerations)
+        self.junction_deviation = junction_deviation
+        self.arc_tolerance = arc_tolerance
+
+        self.metrics = {}  # operation -> metrics
+        self.operation = None
+        self.set_operation('setup')
+
+        # machine state
+        self.position = [0.0, 0.0, 0.0]
+        self.motion_mode = MotionMode.RAPID.value
+        self.absolute = True
+        self.units_scale = 1  # mm per unit
+        self.feedrate = 0
+
+        self.blocks = []  # (dx, dy, dz, feedrate) of the blocks not timed yet
+        self.entry_speed = 0  # mm/sec at the start of self.blocks[0]
+        self.partial_line = ''  # end of a piece of gcode that wasn't a full line yet
+
+    def set_operation(self, operation: str) -> None:
+        '''
+        the lines estimated from now on belong to operation
+
+        :param operation: name of the operation, e.g. 'holes'
+        '''
+        if operation == self.operation:
+            return
+
+        if self.operation is not None:
+            self.plan()
+        self.operation = operation
+        self.metrics.setdefault(operation, {'time': 0, 'cut_length': 0, 'rapid_length': 0, 'plunges': 0, 'lines': 0})
+
+    def plan(self, stop: bool = True) -> None:
+        '''
+        times the blocks not timed yet
+
+        :param stop: the motion stops after the last block. If False, only the blocks before the last one entered
+            at its maximum speed are timed (at least PLANNER_BLOCK_COUNT blocks are kept), the blocks still to come
+            can't change their times, and the next blocks start at the speed the planner reached
+        '''
+        if not self.blocks or (not stop and len(self.blocks) <= PLANNER_BLOCK_COUNT):
+            return
+
+        blocks = np.array(self.blocks)
+        times, entry_speeds, is_planned = get_block_times(blocks[:, :3], blocks[:, 3], self.max_rates, self.accelerations,
+                                                          self.junction_deviation, self.entry_speed)
+        if stop:
+            timed = len(self.blocks)
+        else:
+            planned_inds = np.flatnonzero(is_planned[1:len(self.blocks) - PLANNER_BLOCK_COUNT + 1]) + 1
+            # a window too short to reach the top speed and stop, timed as if GRBL stops at its end
+            timed = int(planned_inds[-1]) if len(planned_inds) else len(self.blocks) - PLANNER_BLOCK_COUNT
+
+        self.metrics[self.operation]['time'] += float(times[:timed].sum())
+        self.entry_speed = 0 if stop else float(entry_speeds[timed])
+        del self.blocks[:timed]
+
+    def estimate(self, gcode: str) -> None:
+        '''
+        :param gcode: gcode lines, the last line is kept for the next call until its end of line arrives
+        '''
+        lines = (self.partial_line + gcode).split('\n')
+        self.partial_line = lines.pop()
+
+        for line in lines:
+            self.estimate_line(line)
+
+    def estimate_line(self, line: str) -> None:
+        '''
+        :param line: one gcode line without its end of line
+        '''
+        if '(' in line or ';' in line:
+            line = GCODE_COMMENT_REGEX.sub('', line)
+        line = line.replace(' ', '').replace('\t', '').upper()
+        if not line:
+            return
+        metrics = self.metrics[self.operation]
+        metrics['lines'] += 1
+
+        if GCODE_WORD_REGEX.sub('', line):
+            # system commands, the machine waits for the motion to stop
+            self.plan()
+            return
+
+        values = {}
+        moves = True
+        dwell = False
+        for letter, value in GCODE_WORD_REGEX.findall(line):
+            value = float(value)
+            if letter == 'G':
+                if value in (0, 1, 2, 3, 38.2, 38.3, 38.4, 38.5):
+                    self.motion_mode = value
+                elif value in (90, 91):
+                    self.absolute = value == 90
+                elif value in (20, 21):
+                    self.units_scale = 25.4 if value == 20 else 1
+                elif value == 4:
+                    self.plan()
+                    dwell = True
+                elif value in (10, 28, 30, 92):
+                    # coordinate offsets and homing, the position isn't followed through those
+                    self.plan()
+                    moves = False
+            elif letter == 'M':
+                # program pauses and spindle changes stop the motion
+                self.plan()
+            elif letter == 'F':
+                self.feedrate = value * self.units_scale
+            else:
+                values[letter] = value
+
+        # dwell, P seconds
+        if dwell and 'P' in values:
+            metrics['time'] += values['P']
+
+        axes = [ind for ind, axis in enumerate('XYZ') if axis in values]
+        is_arc = self.motion_mode in (2, 3)
+        if not moves or not (axes or (is_arc and ('I' in values or 'J' in values))):
+            return
+
+        target = list(self.position)
+        for ind in axes:
+            value = values['XYZ'[ind]] * self.units_scale
+            target[ind] = value if self.absolute else target[ind] + value
+
+        feedrate = np.inf if self.motion_mode == 0 or not self.feedrate else self.feedrate
+        if is_arc:
+            offset = np.array([values.get('I', 0), values.get('J', 0)]) * self.units_scale
+            moves_array = np.diff(np.vstack((self.position, self.get_arc_points(np.array(target), offset, self.motion_mode == 2))), axis=0)
+            length = float(np.linalg.norm(moves_array, axis=1).sum())
+            self.blocks.extend((*move, feedrate) for move in moves_array.tolist())
+        else:
+            # straight moves are most of the lines, kept out of numpy
+            move = (target[0] - self.position[0], target[1] - self.position[1], target[2] - self.position[2])
+            length = sqrt(move[0]**2 + move[1]**2 + move[2]**2)
+            if length > 1e-9:  # GRBL drops the blocks that don't move
+                self.blocks.append((*move, feedrate))
+
+        if self.motion_mode == 0:
+            metrics['rapid_length'] += length
+        else:
+            metrics['cut_length'] += length
+            if not is_arc and target[2] < self.position[2] and target[:2] == self.position[:2]:
+                metrics['plunges'] += 1
+
+        self.position = target
+
+        if len(self.blocks) >= PLANNER_WINDOW:
+            self.plan(stop=False)
+
+    def get_arc_points(self, target: np.ndarray, offset: np.ndarray, clockwise: bool) -> np.ndarray:
+        '''
+        the end points of the straight segments GRBL splits an XY plane arc into (mc_arc())
+
+        :param target: the arc end point
+        :param offset: I, J the center relative to the arc start
+        :return: (n, 3) points, the last one is target
+        '''
+        center = np.array(self.position[:2]) + offset
+        radius = float(np.hypot(*offset))
+        start_vector, end_vector = -offset, target[:2] - center
+        angular_travel = atan2(start_vector[0]*end_vector[1] - start_vector[1]*end_vector[0], start_vector @ end_vector)
+        if clockwise and angular_travel >= -5e-7:
+            angular_travel -= 2*pi
+        elif not clockwise and angular_travel <= 5e-7:
+            angular_travel += 2*pi
+
+        segments = 0
+        if 2*radius > self.arc_tolerance:
+            segments = floor(abs(0.5 * angular_travel * radius) / sqrt(self.arc_tolerance * (2*radius - self.arc_tolerance)))
+
+        # every segment end but the last one, which is the target itself
+        fractions = np.arange(1, max(segments, 1)) / max(segments, 1)
+        angles = atan2(start_vector[1], start_vector[0]) + angular_travel * fractions
+        points = np.column_stack((center[0] + radius * np.cos(angles),
+                                  center[1] + radius * np.sin(angles),
+                                  self.position[2] + (target[2] - self.position[2]) * fractions))
+
+        return np.vstack((points, target))
+
+    def finish(self) -> dict[str, dict]:
+        '''
+        the end of the gcode, the machine stops
+
+        :return: {operation: {'time': seconds, 'cut_length': mm, 'rapid_length': mm, 'plunges': count, 'lines': count}}
+        '''
+        if self.partial_line:
+            self.estimate_line(self.partial_line)
+            self.partial_line = ''
+        self.plan()
+
+        return {operation: dict(metrics) for operation, metrics in self.metrics.items() if metrics['lines']}
+
+    def get_total(self) -> dict:
+        '''
+        :return: the metrics of all the operations together, see finish()
+        '''
+        metrics = self.finish()
+        return {key: sum(operation_metrics[key] for operation_metrics in metrics.values())
+                for key in ('time', 'cut_length', 'rapid_length', 'plunges', 'lines')}
+
+    def get_header(self) -> str:
+        '''
+        :return: Gcode comments with the estimate of every operation and the total
+        '''
+        machine = (f"GRBL planner with X, Y, Z max rates {', '.join(f'{rate:g}' for rate in self.max_rates)} mm/min, "
+                   f"accelerations {', '.join(f'{acceleration:g}' for acceleration in self.accelerations)} mm/sec^2, "
+                   f"junction deviation {self.junction_deviation:g} mm")
+        header = f"; Machining time estimate: {format_duration(self.get_total()['time'])} ({machine})\n"
+        for operation, metrics in self.finish().items():
+            header += (f";   {operation}: {format_duration(metrics['time'])}, {metrics['cut_length']:.1f} mm cut, "
+                       f"{metrics['rapid_length']:.1f} mm rapid, {metrics['plunges']} plunges, {metrics['lines']} lines\n")
+
+        return header + '\n'
+
+    def get_report(self) -> dict:
+        '''
+        :return: everything in get_header() as a json serializable dict
+        '''
+        return {'total': self.get_total(),
+                'operations': self.finish(),
+                'machine': {'max_rates': self.max_rates,
+                            'accelerations': self.accelerations,
+                            'junction_deviation': self.junction_deviation,
+                            'arc_tolerance': self.arc_tolerance}}
+
+    def __repr__(self) -> str:
+        return f"MachiningTimeEstimator({self.max_rates}, {self.accelerations}, {self.junction_deviation})"
+
+class GcodeWriter:
+    '''
+    Buffered gcode file writer, the gcode is written progressively as the generators produce it so it is never held
+    in memory as a whole. It goes to a temporary file next to file_name which replaces file_name (atomic rename)
+    only once everything was written, a failed run never leaves a half written gcode file behind
+
+    with a MachiningTimeEstimator, the estimate of each operation is put at the top of the file
+    and in a json file next to it (file_name + '.json')
+
+    with GcodeWriter('pcb.gcode') as writer:
+        writer.write(general_machine_init())
+        writer.write(generate_holes_gcode(gerber_obj, settings), operation='holes')
+    '''
+    def __init__(self, file_name: str, buffer_size: int = 1 << 20, compress: bool = False, estimator: Optional[MachiningTimeEstimator] = None):
+        '''
+        :param file_name: the wanted gcode filename
+        :param buffer_size: bytes buffered before each write to the disk
+        :param compress: remove the words the machine already knows and the comments, see GcodeCompressor
+        :param estimator: estimates the machining time of the gcode written, None for no estimate
+        '''
+        self.file_name = file_name
+        self.buffer_size = buffer_size
+        dir_path, base_name = os.path.split(file_name)
+        self.temp_file_name = os.path.join(dir_path, f".{base_name}.{os.getpid()}.tmp")
+        self.file = None
+        self.compressor = GcodeCompressor() if compress else None
+        self.estimator = estimator
+
+    def __enter__(self) -> GcodeWriter:
+        self.file = open(self.temp_file_name, 'w', buffering=self.buffer_size)
+        return self
+
+    def write(self, gcode: str | Iterable[str], operation: str = 'setup') -> None:
+        '''
+        :param gcode: gcode string or the pieces of gcode yielded by a generator
+        :param operation: what the gcode does, its time is estimated separately e.g. 'holes', 'spindle'
+        '''
+        if type(gcode) == str:
+            gcode = (gcode,)
+
+        if self.estimator is not None:
+            self.estimator.set_operation(operation)
+
+        for gcode_piece in gcode:
+            self.write_piece(gcode_piece)
+
+    def write_piece(self, gcode_piece: str) -> None:
+        if self.compressor is not None:
+            gcode_piece = self.compressor.compress(gcode_piece)
+        if self.estimator is not None:
+            self.estimator.estimate(gcode_piece)
+        self.file.write(gcode_piece)
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self.compressor is not None and exc_type is None:
+            self.write_piece(self.compressor.flush())
+        self.file.close()
+
+        if exc_type is not None:
+            os.remove(self.temp_file_name)
+            return
+
+        if self.estimator is None:
+            os.replace(self.temp_file_name, self.file_name)
+            return
+
+        # the estimate goes on top (even when compressing, it's only a few comments), the file is copied once after it
+        header_file_name = self.temp_file_name + '.header'
+        try:
+            with open(header_file_name, 'w', buffering=self.buffer_size) as header_file, open(self.temp_file_name, 'r') as body_file:
+                header_file.write(self.estimator.get_header())
+                shutil.copyfileobj(body_file, header_file, self.buffer_size)
+            os.replace(header_file_name, self.file_name)
+        finally:
+            os.remove(self.temp_file_name)
+            if os.path.exists(header_file_name):
+                os.remove(header_file_name)
+
+        with open(self.file_name + '.json', 'w') as json_file:
+            json.dump(self.estimator.get_report(), json_file, indent=4)
+
+    def __repr__(self) -> str:
+        return f"GcodeWriter({self.file_name!r})"
+
+def export_gcode(gcode: str | Iterable[str], file_name: str) -> None:
+
+    '''
+    :param gcode: the actual gcode file content, as one string or the pieces yielded by a generator
     :param file_name: the wanted gcode filename
     creates the gcode file
     '''
-    with open(file_name, 'w') as g_file:
-        g_file.write(gcode)
+    with GcodeWriter(file_name) as writer:
+        writer.write(gcode)
 
 @contextmanager
 def temp_timeout(ser, timeout: int):
@@ -901,7 +1909,7 @@ def temp_timeout(ser, timeout: int):
     old_timeout = ser.timeout
     ser.timeout = timeout
     try:
-        yeild
+        yield
     finally:
         ser.timeout = old_timeout
 
@@ -923,61 +1931,57 @@ class GenerateHeightMap:
         self.gerber_obj = gerber_obj
         self.settings = settings
         self.height_map = self.generate_height_map_datastructure()
-        
+        probe_order = self.get_probe_order()
+
         ### Starting the Sequence
+        print(f"\nProbing {len(probe_order)} points every {self.settings.height_map_resolution}mm, "
+              f"estimated time: {format_duration(self.estimate_probing_time(probe_order))}")
         self.check_user_is_ready()
 
         # Establishing Connection
+        import serial  # only needed when talking to a real machine
         with serial.Serial(self.settings.serial_port, self.settings.serial_baud, timeout=2) as ser:
             self.read_grbl_initial_msg(ser)
             self.g54_offset, self.g92_offset = self.get_grbl_g54_g92_offsets(ser)
             #TODO: Make sure we are on the G54 offset
 
-            for ind, coord in enumerate(self.height_map):
-                # Step 1: Go next height map grid point
-                ser.write(move(MotionMode.RAPID, 
-                    DistanceMode.ABSOLUTE, 
-                    z=1).encode())
-                ser.write(move(MotionMode.RAPID, 
-                    DistanceMode.ABSOLUTE, 
-                    x=coord[0], y=coord[1]).encode())
+            start_time = time.perf_counter()
+            last_z = 0  # Z0 touches the PCB at the origin
+            for count, ind in enumerate(probe_order):
+                coord = self.height_map[ind]
+                probe_start_time = time.perf_counter()
+
+                # Step 1: Go next height map grid point, rising above the last probed surface on the way
+                ser.write(self.get_travel_gcode(coord, last_z).encode())
 
                 # Step2: Confirm Command is received
-                confirmation = ser.readline().decode()
-                confirmation += ser.readline().decode()
-                if 'ok' not in confirmation:
-                    raise ValueError("Didn't receive 'ok' after sending gcode")
-                else:
-                    print(f"Getting Probe Value at Coord({coord[0]}, {coord[1]}) -> ({ind}/{len(self.height_map)-1})")
-
-                # Step3: Send Probe Command
-                ser.write(move(MotionMode.PROBE_TOWARD_ERROR, 
-                               DistanceMode.INCREMENTAL,
-                               z=-2,
-                               feedrate=10).encode())
-
-                # Step4: Process Probe response
-                probe_value_response = ser.readline().decode()
-                while 'PRB' not in probe_value_response:
-                    probe_value_response = ser.readline().decode()
-                    if 'alarm' in probe_value_response.lower():
-                        raise ValueError(f"ALARM detected!!\n{probe_value_response}")
-                matches = re.findall(r"\[PRB:([^,]+),([^,]+),([^,:]+)", probe_value_response)
-                if matches:
-                    probe_value = round(float(matches[0][2]) - self.g54_offset.z - self.g92_offset.z, 4)
-                    print(f"Got Probe Value: {probe_value}\n")
-                else:
-                    raise ValueError(f"Couldn't regex match the probe string!!\nProbe String from Grbl: {probe_value_response}")
-                
+                self.wait_for_ok(ser)
+                print(f"Getting Probe Value at Coord({coord[0]}, {coord[1]}) -> ({count}/{len(probe_order)-1})")
+
+                # Step3: Seek the surface fast, down to 1mm under the last probed surface
+                contact_z = self.probe(ser, self.settings.height_map_clearance + 1, self.settings.probe_seek_feedrate)
+
+                # Step4: Back off from the contact then probe it again slowly for the accurate value
+                ser.write(move(MotionMode.RAPID, 
+                               DistanceMode.ABSOLUTE, 
+                               z=contact_z + self.settings.probe_backoff).encode())
+                self.wait_for_ok(ser)
+                probe_value = self.probe(ser, 2 * self.settings.probe_backoff, self.settings.probe_latch_feedrate)
+                print(f"Got Probe Value: {probe_value} in {time.perf_counter() - probe_start_time:.1f}s\n")
+
                 # Step 5: Save height map value :D
-                # finally, skeywordet the probe Z value
+                # stored at its place in the grid order whatever the probing order
                 self.height_map[ind][2] = probe_value 
+                last_z = probe_value
         
             # Go back to ORIGIN
             ser.write(move(MotionMode.RAPID,
                            DistanceMode.ABSOLUTE,
                            x = 0, y = 0, z = 2).encode())
 
+            probing_time = time.perf_counter() - start_time
+            print(f"Probed {len(probe_order)} points in {format_duration(probing_time)}, {probing_time / len(probe_order):.1f}s per point")
+
     def check_user_is_ready(self):
         '''
         Checks if user has the ASSUMPTIONS CORRECT
@@ -1002,6 +2006,91 @@ class GenerateHeightMap:
         height_map.append([ceil(x_size), ceil(y_size), 0])  # Making sure not out of bound coords can be passed to interpolation function
         return height_map
 
+    def get_probe_order(self) -> list[int]:
+        '''
+        serpentine probing order: up a column of the grid then down the next one, so every hop is to a neighbouring point
+        instead of sweeping back to the bottom of the board after each column
+
+        :return: indices of self.height_map in the order to probe them
+        '''
+        columns = {}
+        for ind, coord in enumerate(self.height_map):
+            columns.setdefault(coord[0], []).append(ind)
+
+        probe_order = []
+        for column_ind, column in enumerate(columns.values()):
+            probe_order.extend(column if column_ind % 2 == 0 else reversed(column))
+
+        return probe_order
+
+    def get_travel_gcode(self, coord: list[float], last_z: float) -> str:
+        '''
+        one rapid from the last probed point to above the next one, the Z retract is done on the way
+
+        :param last_z: the last probed Z, the probe starts height_map_clearance above it as the next point is close to it
+        '''
+        return move(MotionMode.RAPID, 
+                    DistanceMode.ABSOLUTE, 
+                    x=coord[0], y=coord[1], z=round(last_z + self.settings.height_map_clearance, 4))
+
+    def probe(self, ser: serial.Serial, distance: float, feedrate: float) -> float:
+        '''
+        probes down until the probe touches the PCB
+
+        :param distance: how far down the probe may go in mm, there is an ALARM if it touches nothing
+        :param feedrate: probing speed in mm/min
+        :return: the Z work coordinate where the probe touched
+        '''
+        ser.write(move(MotionMode.PROBE_TOWARD_ERROR, 
+                       DistanceMode.INCREMENTAL,
+                       z=-distance,
+                       feedrate=feedrate).encode())
+
+        probe_value_response = ser.readline().decode()
+        while 'PRB' not in probe_value_response:
+            if 'alarm' in probe_value_response.lower():
+                raise ValueError(f"ALARM detected!!\n{probe_value_response}")
+            probe_value_response = ser.readline().decode()
+
+        matches = re.findall(r"\[PRB:([^,]+),([^,]+),([^,:]+)", probe_value_response)
+        if not matches:
+            raise ValueError(f"Couldn't regex match the probe string!!\nProbe String from Grbl: {probe_value_response}")
+
+        # the probe report is followed by the 'ok' of the probe command
+        self.wait_for_ok(ser)
+
+        return round(float(matches[0][2]) - self.g54_offset.z - self.g92_offset.z, 4)
+
+    def wait_for_ok(self, ser: serial.Serial) -> None:
+        '''
+        reads the 'ok' of the last command sent
+        '''
+        confirmation = ser.readline().decode()
+        if 'ok' not in confirmation:
+            raise ValueError(f"Didn't receive 'ok' after sending gcode, got: {confirmation}")
+
+    def estimate_probing_time(self, probe_order: list[int]) -> float:
+        '''
+        estimates the probing time with the GRBL planner of MachiningTimeEstimator, assuming the probe touches at Z0
+
+        :return: seconds
+        '''
+        estimator = MachiningTimeEstimator((self.settings.rapid_feedrate, self.settings.rapid_feedrate, self.settings.z_max_rate), 
+                                           (self.settings.xy_acceleration, self.settings.xy_acceleration, self.settings.z_acceleration), 
+                                           self.settings.junction_deviation)
+
+        # the probes stop at the surface, the estimate probes down to Z0 instead of the full probe distance
+        probe_cycle = [move(MotionMode.PROBE_TOWARD_ERROR, DistanceMode.ABSOLUTE, z=0, feedrate=self.settings.probe_seek_feedrate),
+                       move(MotionMode.RAPID, DistanceMode.ABSOLUTE, z=self.settings.probe_backoff),
+                       move(MotionMode.PROBE_TOWARD_ERROR, DistanceMode.ABSOLUTE, z=0, feedrate=self.settings.probe_latch_feedrate)]
+        for ind in probe_order:
+            # GRBL waits for the motion to stop before and after each probe
+            for gcode in [self.get_travel_gcode(self.height_map[ind], 0)] + probe_cycle:
+                estimator.estimate(gcode)
+                estimator.plan()
+
+        return estimator.get_total()['time']
+
     def read_grbl_initial_msg(self, ser: serial.Serial):
         '''
         read the "GrblHAL 1.1f ['$' or '$help' for help]"
@@ -1061,6 +2150,172 @@ class GenerateHeightMap:
         return g54_offset, g92_offset
 
 
+GRBL_STATUS_REGEX = re.compile(r"<([A-Za-z]+)")
+GRBL_BUFFER_STATE_REGEX = re.compile(r"\|Bf:(\d+),(\d+)")
+
+@dataclass
+class StreamReport:
+    lines: int  # lines acknowledged by GRBL
+    seconds: float  # from the first line sent to the last one acknowledged
+    errors: list[tuple[int, str, str]]  # (line number, line, 'error:N') of each rejected line
+    underruns: Optional[int]  # status reports with the planner (nearly) empty before the end, None if GRBL doesn't report its buffers ($10)
+
+    @property
+    def lines_per_second(self) -> float:
+        return self.lines / self.seconds if self.seconds else 0
+
+    def __str__(self) -> str:
+        underruns = 'unknown (enable the buffer state in the GRBL status reports, $10)' if self.underruns is None else self.underruns
+        return (f"Streamed {self.lines} lines in {format_duration(self.seconds)} ({self.lines_per_second:.1f} lines/sec), "
+                f"{len(self.errors)} errors, planner underruns: {underruns}")
+
+class GrblStreamer:
+    '''
+    Streams gcode to GRBL with its character counting protocol: lines are sent as long as they fit in what's left of the
+    GRBL serial RX buffer (128 bytes) counting the bytes of the lines not acknowledged yet, instead of waiting for the 'ok' of each line.
+    The buffer stays full and the planner always has the next lines, the machine doesn't stop between short segments
+
+    Every response is handled: 'ok' and 'error:N' acknowledge the oldest line in the buffer, 'ALARM' aborts the stream,
+    status reports ('?' sent every status_report_interval) count the planner underruns, see StreamReport.
+    Program pauses (M0, e.g. drill bit changes) wait for resume() then send the cycle start
+
+    with serial.Serial('/dev/ttyACM0', 115200, timeout=2) as ser:
+        streamer = GrblStreamer(ser)
+        streamer.wait_for_greeting()
+        print(streamer.stream(open('pcb.gcode')))
+    '''
+    def __init__(self, ser: serial.Serial, rx_buffer_size: int = 128, status_report_interval: float = 0.2, stop_on_error: bool = True,
+            resume: Optional[Callable] = None, verbose: bool = True):
+        '''
+        :param ser: the serial port of GRBL, or any object with the same write(), readline() and timeout
+        :param rx_buffer_size: size of the GRBL serial RX buffer in bytes (RX_BUFFER_SIZE, 128 on an Arduino Uno)
+        :param status_report_interval: seconds between the status reports requests, 0 for none
+        :param stop_on_error: stop sending lines at the first 'error:' response, the lines already sent are still acknowledged
+        :param resume: called when the program is paused (M0), the stream goes on when it returns. None waits for the machine's cycle start button
+        :param verbose: print the messages and errors from GRBL
+        '''
+        self.ser = ser
+        self.rx_buffer_size = rx_buffer_size
+        self.status_report_interval = status_report_interval
+        self.stop_on_error = stop_on_error
+        self.resume = resume
+        self.verbose = verbose
+
+    def wait_for_greeting(self, timeout: float = 5) -> str:
+        '''
+        GRBL resets when the serial port is opened, waits for its "Grbl 1.1h ['$' for help]"
+
+        :return: the greeting
+        '''
+        end = time.perf_counter() + timeout
+        while time.perf_counter() < end:
+            response = self.ser.readline().decode().strip()
+            if 'grbl' in response.lower():
+                return response
+
+        raise ValueError("Expected Grbl Greeting Message Upon connection!")
+
+    def stream(self, gcode: Iterable[str]) -> StreamReport:
+        '''
+        :param gcode: the gcode lines, e.g. an opened gcode file. Comments, spaces and empty lines aren't sent
+        :return: the StreamReport
+        '''
+        lines = ((number, GCODE_COMMENT_REGEX.sub('', line).replace(' ', '').replace('\t', '').strip()) for number, line in enumerate(gcode, 1))
+        lines = ((number, line) for number, line in lines if line)
+
+        self.pending = deque()  # (line number, line, bytes) sent but not acknowledged yet
+        self.buffered_bytes = 0
+        self.acknowledged = 0
+        self.errors = []
+        self.stopped = False
+        self.underruns = None
+        self.max_planner_available = 0
+        self.is_holding = False
+
+        next_line = next(lines, None)
+        start = None
+        next_status_time = 0
+        with temp_timeout(self.ser, self.status_report_interval or 1):
+            while (next_line is not None and not self.stopped) or self.pending:
+                now = time.perf_counter()
+                if self.status_report_interval and now >= next_status_time and start is not None:
+                    self.ser.write(b'?')  # real time command, not counted in the buffer
+                    next_status_time = now + self.status_report_interval
+
+                ### Sending as long as the line fits in the RX buffer
+                if next_line is not None and not self.stopped:
+                    number, line = next_line
+                    line_bytes = len(line) + 1
+                    if line_bytes > self.rx_buffer_size:
+                        raise ValueError(f"Line {number} is longer than the GRBL RX buffer ({self.rx_buffer_size} bytes): {line}")
+
+                    if self.buffered_bytes + line_bytes <= self.rx_buffer_size:
+                        self.ser.write((line + '\n').encode())
+                        self.pending.append((number, line, line_bytes))
+                        self.buffered_bytes += line_bytes
+                        start = now if start is None else start
+                        next_line = next(lines, None)
+                        continue
+
+                ### Waiting for the next response, until the next status report request at most
+                response = self.ser.readline().decode().strip()
+                if response:
+                    self.handle_response(response, next_line is not None)
+
+        return StreamReport(self.acknowledged, time.perf_counter() - start if start is not None else 0, self.errors, self.underruns)
+
+    def handle_response(self, response: str, lines_left: bool) -> None:
+        '''
+        :param response: one line received from GRBL
+        :param lines_left: lines remain to be sent
+        '''
+        if response == 'ok' or response.startswith('error'):
+            number, line, line_bytes = self.pending.popleft()
+            self.buffered_bytes -= line_bytes
+            self.acknowledged += 1
+
+            if response.startswith('error'):
+                self.errors.append((number, line, response))
+                if self.verbose:
+                    print(f"GRBL {response} on line {number}: {line}")
+                if self.stop_on_error:
+                    self.stopped = True
+
+        elif response.startswith('ALARM'):
+            raise ValueError(f"ALARM detected!!\n{response}\nStopped after line {self.pending[0][0] if self.pending else '?'}")
+
+        elif response.startswith('<'):
+            match = GRBL_STATUS_REGEX.match(response)
+            if not match:
+                return
+            state = match.group(1)
+
+            # the planner has at most the block being run left while the job isn't finished, the machine is about to stop (or stopped)
+            buffer_state = GRBL_BUFFER_STATE_REGEX.search(response)
+            if buffer_state:
+                planner_available = int(buffer_state.group(1))
+                self.underruns = self.underruns or 0
+                if planner_available > self.max_planner_available:
+                    self.max_planner_available = planner_available
+                elif state in ('Run', 'Idle') and planner_available >= self.max_planner_available - 1 and (lines_left or len(self.pending) > 1):
+                    self.underruns += 1
+
+            # program pause
+            if state == 'Hold' and not self.is_holding:
+                self.is_holding = True
+                if self.resume is not None:
+                    self.resume()
+                    self.ser.write(b'~')  # cycle start
+            elif state != 'Hold':
+                self.is_holding = False
+
+        elif self.verbose:
+            print(f"GRBL: {response}")
+
+    def __repr__(self) -> str:
+        return f"GrblStreamer({self.ser!r}, rx_buffer_size={self.rx_buffer_size})"
+
+
 if __name__ == '__main__':
 
     #NOTE!!!! The gerber file is assumed to be mirrorred!!!!!
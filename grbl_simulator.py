@@ -0,0 +1,493 @@
+'''
+Software stand-in for a GRBL controller, to run GenerateHeightMap and GrblStreamer without a machine attached
+
+It answers like GRBL 1.1 over a serial link: greeting, 'ok' / 'error:N' for every line, '$#' offsets, '?' status reports,
+probing (G38.2) against a synthetic warped PCB surface, with GRBL's RX buffer size, a planner of blocks that take
+their time to run and a processing latency per line.
+
+As a pyserial like object:
+    with SimulatedGrbl() as ser:
+        streamer = GrblStreamer(ser)
+
+Or as a serial port for any program (e.g. 'python cli.py board.gbr --create-height-map --serial-port /dev/pts/3'):
+    python grbl_simulator.py
+'''
+from __future__ import annotations
+
+from typing import Callable, Optional
+from collections import deque
+from math import sin, cos, pi, sqrt
+import argparse
+import os
+import queue
+import select
+import threading
+import time
+import tty
+
+from gcode_tools import GCODE_WORD_REGEX, GCODE_COMMENT_REGEX
+
+GRBL_GREETING = "Grbl 1.1h ['$' for help]"
+GRBL_LINE_BUFFER_SIZE = 80  # longest line GRBL reads, LINE_BUFFER_SIZE
+REAL_TIME_COMMANDS = {b'?'[0], b'!'[0], b'~'[0], 0x18}
+
+def warped_surface(x: float, y: float) -> float:
+    '''
+    a PCB surface as a height map would find it: tilted by the bed and warped by a few hundredths of a mm
+
+    :param x: X work coordinate in mm
+    :param y: Y work coordinate in mm
+    :return: Z of the surface in work coordinates (Z0 touches the PCB at the origin)
+    '''
+    return 0.002 * x - 0.001 * y + 0.05 * sin(2 * pi * x / 60) * cos(2 * pi * y / 45)
+
+class SimulatedGrbl:
+    '''
+    Simulated GRBL controller with the interface of serial.Serial: write(), readline(), read(), in_waiting, timeout, close()
+
+    A worker thread runs the controller: the received lines wait in the RX buffer (bytes beyond rx_buffer_size are lost,
+    like on GRBL, see rx_overflows) until the parser takes them, line_latency seconds each, motion lines also wait for
+    a free planner block. Moves take their length / feedrate (rapids at max_rate) times time_scale seconds.
+    Probes, dwells and program pauses wait for the planner to empty first, like GRBL.
+
+    Only what the PCB-CAM gcode and GenerateHeightMap use is simulated: G0, G1, G2, G3 (timed as straight moves), G4, G17, G20, G21,
+    G38.2 to G38.5, G54, G80, G90, G91, G92, G93, G94, M0 to M9, M30, F, S, T and $#, $H, $X, $I
+    '''
+    def __init__(self, surface: Callable[[float, float], float] = warped_surface, g54_offset: tuple[float, float, float] = (0, 0, 0),
+            g92_offset: tuple[float, float, float] = (0, 0, 0), rx_buffer_size: int = 128, planner_size: int = 15,
+            line_latency: float = 0.0005, max_rate: float = 500, time_scale: float = 1, timeout: Optional[float] = 2):
+        '''
+        :param surface: Z of the PCB surface at X, Y in work coordinates, where the probes touch
+        :param g54_offset: G54 work coordinate offset, machine coordinates = work coordinates + G54 + G92
+        :param g92_offset: G92 offset
+        :param rx_buffer_size: serial RX buffer size in bytes (RX_BUFFER_SIZE, 128 on an Arduino Uno)
+        :param planner_size: number of motion blocks the planner holds (BLOCK_BUFFER_SIZE - 1)
+        :param line_latency: seconds the parser spends on each line
+        :param max_rate: speed of rapid moves in mm/min
+        :param time_scale: simulated seconds per motion second, 0 for instant moves, probes and dwells
+        :param timeout: readline() timeout in seconds like serial.Serial, None waits forever
+        '''
+        self.surface = surface
+        self.g54_offset = list(g54_offset)
+        self.g92_offset = list(g92_offset)
+        self.rx_buffer_size = rx_buffer_size
+        self.planner_size = planner_size
+        self.line_latency = line_latency
+        self.max_rate = max_rate
+        self.time_scale = time_scale
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.output = queue.Queue()
+        self.output_buffer = b''
+        self.rx_overflows = 0  # bytes lost because the RX buffer was full
+        self.lines_received = 0
+        self.reset()
+
+        self.running = True
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def reset(self) -> None:
+        '''
+        power up or soft reset (ctrl-x): buffers emptied, modal state back to the defaults, then the greeting
+        '''
+        with self.lock:
+            self.rx_buffer = bytearray()
+            self.planner = deque()  # (duration in seconds, machine position at the end) of each block
+            self.block_end_time = None
+            self.machine_position = [0.0, 0.0, 0.0]
+            self.planned_position = [0.0, 0.0, 0.0]  # machine position at the end of the planned blocks
+            self.absolute = True
+            self.units_scale = 1
+            self.motion_mode = 0
+            self.feedrate = 0
+            self.state = 'Idle'
+            self.hold = False
+            self.send('')
+            self.send(GRBL_GREETING)
+
+    ### Serial side
+    def write(self, data: bytes) -> int:
+        '''
+        receives bytes, the real time commands ('?', '!', '~', ctrl-x) are handled right away and don't use the RX buffer
+        '''
+        for byte in data:
+            if byte in REAL_TIME_COMMANDS:
+                self.real_time_command(byte)
+                continue
+
+            with self.lock:
+                if len(self.rx_buffer) < self.rx_buffer_size:
+                    self.rx_buffer.append(byte)
+                else:
+                    self.rx_overflows += 1
+
+        return len(data)
+
+    def readline(self) -> bytes:
+        '''
+        :return: the next response line, b'' if none came within timeout
+        '''
+        try:
+            return self.output.get(timeout=self.timeout)
+        except queue.Empty:
+            return b''
+
+    def read(self, size: int = 1) -> bytes:
+        while len(self.output_buffer) < size:
+            line = self.readline()
+            if not line:
+                break
+            self.output_buffer += line
+        data, self.output_buffer = self.output_buffer[:size], self.output_buffer[size:]
+        return data
+
+    @property
+    def in_waiting(self) -> int:
+        return self.output.qsize()
+
+    def reset_input_buffer(self) -> None:
+        while not self.output.empty():
+            self.output.get_nowait()
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.running = False
+        self.worker.join()
+
+    def __enter__(self) -> SimulatedGrbl:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def send(self, response: str) -> None:
+        self.output.put(f"{response}\r\n".encode())
+
+    def real_time_command(self, byte: int) -> None:
+        if byte == 0x18:
+            self.reset()
+            return
+
+        with self.lock:
+            if byte == b'?'[0]:
+                self.send(self.get_status_report())
+            elif byte == b'!'[0] and self.state in ('Run', 'Idle'):
+                self.hold = True
+                self.state = 'Hold'
+            elif byte == b'~'[0] and self.hold:
+                self.hold = False
+                self.state = 'Run' if self.planner else 'Idle'
+
+    def get_status_report(self) -> str:
+        machine_position = ','.join(f"{value:.3f}" for value in self.machine_position)
+        feedrate = self.feedrate if self.state == 'Run' else 0
+        return (f"<{self.state}{':0' if self.state == 'Hold' else ''}|MPos:{machine_position}|"
+                f"Bf:{self.planner_size - len(self.planner)},{self.rx_buffer_size - len(self.rx_buffer)}|FS:{feedrate:g},0>")
+
+    ### Controller side
+    def run(self) -> None:
+        '''
+        the controller main loop: runs the planned blocks and parses the received lines
+        '''
+        while self.running:
+            with self.lock:
+                self.run_motion()
+                line = None
+                if b'\n' in self.rx_buffer and not self.hold:
+                    line = self.peek_line()
+                    if line is not None and self.is_motion_line(line) and len(self.planner) >= self.planner_size:
+                        line = None  # waiting for a free planner block, the RX buffer fills up meanwhile
+                    elif line is not None:
+                        del self.rx_buffer[:self.rx_buffer.index(b'\n') + 1]
+
+            if line is None:
+                time.sleep(0.0002)
+                continue
+
+            if self.line_latency:
+                time.sleep(self.line_latency)
+            self.lines_received += 1
+            for response in self.execute_line(line):
+                self.send(response)
+
+    def peek_line(self) -> Optional[str]:
+        return self.rx_buffer[:self.rx_buffer.index(b'\n')].decode(errors='replace').strip()
+
+    def run_motion(self) -> None:
+        '''
+        removes the blocks that finished running, starts the next one
+        '''
+        now = time.perf_counter()
+        while self.planner and not self.hold:
+            duration, end_position = self.planner[0]
+            if self.block_end_time is None:
+                self.block_end_time = now + duration
+                self.state = 'Run'
+            if now < self.block_end_time:
+                return
+            self.planner.popleft()
+            self.machine_position = end_position
+            self.block_end_time = None
+
+        if not self.planner and not self.hold and self.state == 'Run':
+            self.state = 'Idle'
+
+    def wait_for_planner(self) -> None:
+        '''
+        the synchronizing commands (probe, dwell, pause, $ commands) wait for the motion to end
+        '''
+        while self.running:
+            with self.lock:
+                self.run_motion()
+                if not self.planner:
+                    return
+            time.sleep(0.0002)
+
+    def sleep(self, seconds: float) -> None:
+        if seconds * self.time_scale > 0:
+            time.sleep(seconds * self.time_scale)
+
+    def is_motion_line(self, line: str) -> bool:
+        line = GCODE_COMMENT_REGEX.sub('', line).upper()
+        return any(letter in 'XYZ' for letter, value in GCODE_WORD_REGEX.findall(line))
+
+    def execute_line(self, line: str) -> list[str]:
+        '''
+        :param line: one line received
+        :return: GRBL's responses to it
+        '''
+        line = GCODE_COMMENT_REGEX.sub('', line).replace(' ', '').upper()
+        if not line:
+            return ['ok']
+        if len(line) >= GRBL_LINE_BUFFER_SIZE:
+            return ['error:11']
+
+        if line.startswith('$'):
+            return self.execute_system_command(line)
+
+        if self.state == 'Alarm':
+            return ['error:9']
+
+        words = GCODE_WORD_REGEX.findall(line)
+        if ''.join(letter + value for letter, value in words) != line:
+            return ['error:1']
+
+        ### Step 1: Modal words
+        values = {}
+        motion_mode = None
+        non_modal = None
+        for letter, value in words:
+            value = float(value)
+            if letter == 'G':
+                if value in (0, 1, 2, 3, 38.2, 38.3, 38.4, 38.5, 80):
+                    motion_mode = value
+                elif value in (90, 91):
+                    self.absolute = value == 90
+                elif value in (20, 21):
+                    self.units_scale = 25.4 if value == 20 else 1
+                elif value in (4, 92):
+                    non_modal = value
+                elif value not in (17, 54, 93, 94):
+                    return ['error:20']
+            elif letter == 'M':
+                if value in (0, 1):
+                    non_modal = 'M0'
+                elif value in (2, 30):
+                    non_modal = 'M2'
+                elif value not in (3, 4, 5, 7, 8, 9):
+                    return ['error:20']
+            elif letter == 'F':
+                self.feedrate = value * self.units_scale
+            elif letter in 'XYZIJKPRST':
+                values[letter] = value
+            else:
+                return ['error:20']
+
+        if motion_mode is not None:
+            self.motion_mode = motion_mode
+
+        ### Step 2: Non modal commands
+        if non_modal == 4:
+            self.wait_for_planner()
+            self.sleep(values.get('P', 0))
+            return ['ok']
+
+        if non_modal == 92:
+            # the current position becomes the given work coordinates
+            for ind, axis in enumerate('XYZ'):
+                if axis in values:
+                    self.g92_offset[ind] = self.planned_position[ind] - self.g54_offset[ind] - values[axis] * self.units_scale
+            return ['ok']
+
+        if non_modal == 'M0':
+            self.wait_for_planner()
+            with self.lock:
+                self.hold = True
+                self.state = 'Hold'
+            while self.running and self.hold:
+                time.sleep(0.001)
+            return ['ok']
+
+        if non_modal == 'M2':
+            self.wait_for_planner()
+            with self.lock:
+                self.absolute, self.units_scale, self.motion_mode = True, 1, 1
+            return ['ok']
+
+        ### Step 3: Motion
+        target = list(self.planned_position)
+        for ind, axis in enumerate('XYZ'):
+            if axis in values:
+                value = values[axis] * self.units_scale
+                target[ind] = value + self.g54_offset[ind] + self.g92_offset[ind] if self.absolute else target[ind] + value
+
+        if target == self.planned_position and self.motion_mode not in (2, 3):
+            return ['ok']
+
+        if self.motion_mode in (38.2, 38.3, 38.4, 38.5):
+            return self.probe(target)
+
+        if self.motion_mode == 80:
+            return ['error:31']  # axis words without a motion mode
+
+        if self.motion_mode != 0 and not self.feedrate:
+            return ['error:22']  # undefined feed rate
+
+        length = sqrt(sum((end - start)**2 for start, end in zip(self.planned_position, target)))
+        speed = self.max_rate if self.motion_mode == 0 else min(self.feedrate, self.max_rate)
+        with self.lock:
+            self.planner.append((length / speed * 60 * self.time_scale, target))
+        self.planned_position = target
+
+        return ['ok']
+
+    def probe(self, target: list[float]) -> list[str]:
+        '''
+        probes toward target, stops where the probe touches the surface
+
+        :return: the [PRB:...] report then ok, or ALARM:4 / ALARM:5 when G38.2 / G38.4 fail
+        '''
+        self.wait_for_planner()
+
+        start = list(self.planned_position)
+        work_x = start[0] - self.g54_offset[0] - self.g92_offset[0]
+        work_y = start[1] - self.g54_offset[1] - self.g92_offset[1]
+        surface_z = self.surface(work_x, work_y) + self.g54_offset[2] + self.g92_offset[2]
+
+        toward = self.motion_mode in (38.2, 38.3)
+        if toward and start[2] <= surface_z:
+            # already touching
+            return ['ALARM:4'] if self.motion_mode == 38.2 else ['ok']
+
+        touched = target[2] <= surface_z <= start[2] if toward else start[2] <= surface_z
+        end = [target[0], target[1], surface_z] if touched and toward else target
+
+        self.sleep(abs(end[2] - start[2]) / max(self.feedrate, 1e-9) * 60)
+        with self.lock:
+            self.machine_position = list(end)
+        self.planned_position = list(end)
+
+        if not touched and self.motion_mode in (38.2, 38.4):
+            with self.lock:
+                self.state = 'Alarm'
+            return ['ALARM:5']
+
+        return [f"[PRB:{end[0]:.3f},{end[1]:.3f},{end[2]:.3f}:{int(touched)}]", 'ok']
+
+    def execute_system_command(self, line: str) -> list[str]:
+        '''
+        the '$' commands
+        '''
+        if line == '$#':
+            self.wait_for_planner()
+            offsets = lambda offset: ','.join(f"{value:.3f}" for value in offset)
+            return ([f"[{coordinate_system}:{offsets((0, 0, 0))}]" for coordinate_system in ('G55', 'G56', 'G57', 'G58', 'G59', 'G28', 'G30')]
+                    + [f"[G54:{offsets(self.g54_offset)}]", f"[G92:{offsets(self.g92_offset)}]", "[TLO:0.000]",
+                       f"[PRB:{offsets(self.machine_position)}:0]", 'ok'])
+
+        if line == '$X':
+            self.state = 'Idle'
+            return ['[MSG:Caution: Unlocked]', 'ok']
+
+        if line == '$H':
+            self.wait_for_planner()
+            with self.lock:
+                self.machine_position = [0.0, 0.0, 0.0]
+                self.state = 'Idle'
+            self.planned_position = [0.0, 0.0, 0.0]
+            return ['ok']
+
+        if line == '$I':
+            return ['[VER:1.1h.20190825:simulated]', 'ok']
+
+        return ['error:3']
+
+    def __repr__(self) -> str:
+        return f"SimulatedGrbl(rx_buffer_size={self.rx_buffer_size}, planner_size={self.planner_size}, line_latency={self.line_latency})"
+
+def open_pty(simulator: SimulatedGrbl, boot_time: float = 0.1) -> str:
+    '''
+    exposes the simulator as a serial port: a pseudo terminal whose other end is served by the simulator
+
+    Like an Arduino that resets when its port is opened, the simulator restarts and sends its greeting boot_time seconds
+    after a program opens the port (pyserial empties the input when opening, an earlier greeting would be lost)
+
+    :return: path of the serial port to open, e.g. /dev/pts/3
+    '''
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(slave_fd)  # no echo, no line ending translations
+    port = os.ttyname(slave_fd)
+    os.close(slave_fd)  # the master end hangs up until a program opens the port
+
+    connected = threading.Event()
+
+    def to_simulator():
+        poller = select.poll()
+        poller.register(master_fd, select.POLLIN)
+        while simulator.running:
+            events = dict(poller.poll(100))
+            if events.get(master_fd, 0) & select.POLLHUP:
+                connected.clear()
+                time.sleep(0.01)
+                continue
+
+            if not connected.is_set():
+                time.sleep(boot_time)
+                simulator.reset_input_buffer()
+                simulator.reset()
+                connected.set()
+
+            if events.get(master_fd, 0) & select.POLLIN:
+                simulator.write(os.read(master_fd, 1024))
+
+    def from_simulator():
+        while simulator.running:
+            line = simulator.readline()
+            if line and connected.is_set():
+                os.write(master_fd, line)
+
+    simulator.timeout = 0.1
+    threading.Thread(target=to_simulator, daemon=True).start()
+    threading.Thread(target=from_simulator, daemon=True).start()
+
+    return port
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulated GRBL controller on a pseudo terminal, pass its path as --serial-port")
+    parser.add_argument('--rx-buffer-size', type=int, default=128, help="serial RX buffer size in bytes")
+    parser.add_argument('--line-latency', type=float, default=0.0005, help="seconds the parser spends on each line")
+    parser.add_argument('--time-scale', type=float, default=1, help="simulated seconds per motion second, 0 for instant motion")
+    parser.add_argument('--g54-offset', type=float, nargs=3, default=(0, 0, 0), help="G54 work coordinate offset X Y Z")
+    args = parser.parse_args()
+
+    simulator = SimulatedGrbl(g54_offset=args.g54_offset, rx_buffer_size=args.rx_buffer_size, line_latency=args.line_latency, time_scale=args.time_scale)
+    print(f"Simulated GRBL on {open_pty(simulator)}, Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.close()
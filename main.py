@@ -11,6 +11,7 @@ with warnings.catch_warnings():
     import gerber
 
 from gcode_tools import *
+from cam import get_transform_matrix
 import default_settings
 import os
 
@@ -50,11 +51,33 @@ class Settings:
             pass
 
 
+def stream_gcode_file(settings: Settings) -> None:
+    '''
+    Sends the settings.src gcode file to the grbl controller, see GrblStreamer
+    '''
+    import serial  # only needed when talking to a real machine
+
+    def resume():
+        input("\nProgram paused (M0), press Enter to resume..")
+
+    with serial.Serial(settings.serial_port, settings.serial_baud, timeout=2) as ser, open(settings.src) as gcode_file:
+        streamer = GrblStreamer(ser, settings.grbl_rx_buffer_size, settings.status_report_interval, resume=resume)
+        print(f"\nEstablished Successful Connection to {streamer.wait_for_greeting()}\n")
+        print(streamer.stream(gcode_file))
+
+
 def main(settings: Settings):
     '''
     ### Main Code ###
     '''
     # Error checking the arguments
+    if settings.stream and (settings.create_height_map or settings.holes or settings.laser or settings.spindle or settings.spindle_edge_cut):
+        raise ValueError("can't stream a gcode file and create height map or generate PCB gcode at once!")
+
+    elif settings.stream:
+        stream_gcode_file(settings)
+        return None
+
     if settings.create_height_map and (settings.holes or settings.laser or settings.spindle or settings.spindle_edge_cut):
         raise ValueError("can't create height map and generate PCB gcode at once!")
 
@@ -68,16 +91,9 @@ def main(settings: Settings):
     # Read the gerber file
     gerber_obj = gerber.read(settings.src)
 
-    # Recenter Gerber File with wanted Offset
-    gerber_obj.recenter_gerber_file(settings.x_offset, settings.y_offset)
-
-    # Mirror Gerber File
-    if settings.mirrored:
-        gerber_obj.mirror()
-
-    # Rotate Gerber File
-    if settings.rotated:
-        gerber_obj.rotate_90()
+    # Mirror, rotate and recenter Gerber File with wanted Offset, all in one pass
+    rotation = settings.rotation + 90 if settings.rotated else settings.rotation
+    gerber_obj.transform(get_transform_matrix(settings.mirrored, rotation), settings.x_offset, settings.y_offset)
 
     # Create height_map mode
     if settings.create_height_map:
@@ -97,7 +113,14 @@ def main(settings: Settings):
         return None
 
     # Saving New Gerber File
-    if not settings.dont_export_gbr:
+    # the gerber apertures can't hold a rotation, rectangles, obrounds, polygons and macros only turn by swapping or keeping their sides
+    exportable_rotation = rotation % 90 == 0 or all(stmt.shape == 'C' for stmt in gerber_obj.statements 
+                                                    if type(stmt) == gerber.gerber_statements.ADParamStmt)
+    if not settings.dont_export_gbr and not exportable_rotation:
+        print(f"\nNot exporting {settings.new_gbr_name}: the apertures can't be rotated by {rotation % 360:g} degrees in a gerber file, "
+              f"only by multiples of 90 degrees\n")
+
+    elif not settings.dont_export_gbr:
         dir_path = os.path.dirname(settings.src)
         if dir_path and dir_path.endswith('/'):
             dir_path_with_slash = dir_path
@@ -108,44 +131,60 @@ def main(settings: Settings):
         gerber_obj.write(dir_path_with_slash + settings.new_gbr_name)
 
     ### Creating the Gcode file
-    gcode = ""
     debug_msg = f"\n\nPCB Dimension Width: {gerber_obj.size[0]}, Height: {gerber_obj.size[1]}.\n\n"
 
-    gcode += general_machine_init()
-    gcode += f"\n; PCB Dimension Width: {gerber_obj.size[0]}, Height: {gerber_obj.size[1]}.\n"
-
-    ### DEPRECATED ###
-    # # Creating the PCB ink laying Gcode
-    # if settings.all_gcode or settings.ink:
-    #     gcode += generate_ink_laying_gcode(gerber_obj, settings.tool, settings.tip_thickness, 
-    #                                        settings.pen_down_position, settings.ink_laying_feedrate, debug=settings.debug)
-    #     debug_msg += "Exported Ink Laying Gcode..\n"
-    ##################
-
-    # Creating the PCB traces by spindle engraving
-    if settings.spindle:
-        gcode += generate_spindle_engraving_trace_gcode(gerber_obj, settings)
-        debug_msg += "Exported Spindle PCB engraving Gcode..\n"
-
-    # Creating the PCB traces by laser engraving
-    if  settings.laser:
-        gcode += generate_laser_engraving_trace_gcode(gerber_obj, settings)
-        debug_msg += "Exported laser PCB engraving Gcode..\n"
-
-    # Creating the holes_gcode
-    if settings.holes:
-        gcode += generate_holes_gcode(gerber_obj, settings)
-        debug_msg += "Exported spindle hole drilling Gcode..\n"
-
-    if settings.spindle_edge_cut:
-        gcode += generate_spindle_edge_cut_gcode(gerber_obj, settings)
-        debug_msg += "Exported spindle Edge Cut Gcode..\n"
-
-    # Machine Deinit
-    gcode += general_machine_deinit()
-
-    # exporting the created Gcode
-    export_gcode(gcode, settings.dest)
+    # the gcode is written to the file progressively as it is created, the file only appears once it is complete
+    if settings.estimate_machining_time:
+        estimator = MachiningTimeEstimator((settings.rapid_feedrate, settings.rapid_feedrate, settings.z_max_rate), 
+                                           (settings.xy_acceleration, settings.xy_acceleration, settings.z_acceleration), 
+                                           settings.junction_deviation)
+    else:
+        estimator = None
+
+    with GcodeWriter(settings.dest, compress=settings.compress_gcode, estimator=estimator) as writer:
+        writer.write(general_machine_init())
+        writer.write(f"\n; PCB Dimension Width: {gerber_obj.size[0]}, Height: {gerber_obj.size[1]}.\n")
+
+        ### DEPRECATED ###
+        # # Creating the PCB ink laying Gcode
+        # if settings.all_gcode or settings.ink:
+        #     writer.write(generate_ink_laying_gcode(gerber_obj, settings.tool, settings.tip_thickness, 
+        #                                        settings.pen_down_position, settings.ink_laying_feedrate, debug=settings.debug))
+        #     debug_msg += "Exported Ink Laying Gcode..\n"
+        ##################
+
+        # Creating the PCB traces by spindle engraving
+        if settings.spindle:
+            writer.write(generate_spindle_engraving_trace_gcode(gerber_obj, settings), operation='spindle')
+            debug_msg += "Exported Spindle PCB engraving Gcode..\n"
+
+        # Creating the PCB traces by laser engraving
+        if  settings.laser and settings.laser_raster:
+            writer.write(generate_laser_raster_gcode(gerber_obj, settings), operation='laser')
+            debug_msg += "Exported laser PCB raster engraving Gcode..\n"
+
+        elif  settings.laser and settings.laser_hatch:
+            writer.write(generate_laser_hatch_gcode(gerber_obj, settings), operation='laser')
+            debug_msg += "Exported laser PCB hatch engraving Gcode..\n"
+
+        elif  settings.laser:
+            writer.write(generate_laser_engraving_trace_gcode(gerber_obj, settings), operation='laser')
+            debug_msg += "Exported laser PCB engraving Gcode..\n"
+
+        # Creating the holes_gcode
+        if settings.holes:
+            writer.write(generate_holes_gcode(gerber_obj, settings), operation='holes')
+            debug_msg += "Exported spindle hole drilling Gcode..\n"
+
+        if settings.spindle_edge_cut:
+            writer.write(generate_spindle_edge_cut_gcode(gerber_obj, settings), operation='edge_cut')
+            debug_msg += "Exported spindle Edge Cut Gcode..\n"
+
+        # Machine Deinit
+        writer.write(general_machine_deinit(), operation='deinit')
+
+    if estimator is not None:
+        debug_msg += f"Estimated machining time: {format_duration(estimator.get_total()['time'])}, see {settings.dest}.json\n"
 
     # End statement
     print(debug_msg)
@@ -0,0 +1,35 @@
+g21 g90 (units) ; comment
+G0 X1.000 Y2.000 Z3.0
+G0X1.000Y2.0Z3
+G1X1Y2Z3F100.0
+G1X1Y2Z3F100
+G2X1Y2I5J0
+G2X1Y2I5J0F100
+G91
+G1X1Y0
+G1X1Y0
+G90
+G1X1Y0
+G93 G1 X2 F10
+G1X3F10
+G94
+G1X4F100
+G38.2Z-5F10
+G1Z0
+G1Z0
+G28
+G0X0Y0
+$H
+G0X0Y0
+G4 P1.50
+M3 S1000
+M3 S1000
+M5
+M3
+G20
+G1X0Y0F5
+G21
+G1X0Y0F5
+M2
+G0X0Y0
++000.0500
@@ -0,0 +1,40 @@
+'''
+Shared fixtures, the tests run from the repository root modules (python -m pytest)
+'''
+import os
+import sys
+import warnings
+
+import pytest
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+with warnings.catch_warnings():
+    # suppressing a stupid syntax warning to convert 'is not' to '!='
+    warnings.filterwarnings("ignore", category=SyntaxWarning)
+    import gerber
+
+from main import Settings
+from cam import get_transform_matrix
+
+DEFAULT_GERBER_PATH = os.path.join(REPO_PATH, 'gerber_files', 'default.gbr')
+
+def load_gerber(settings: Settings, path: str = DEFAULT_GERBER_PATH) -> gerber.rs274x.GerberFile:
+    '''
+    reads and transforms the gerber file like main() does
+
+    NOTE: read with gerber.common.loads() as gerber.read() opens files in 'rU' mode, removed in python 3.11
+    '''
+    with open(path) as f:
+        gerber_obj = gerber.common.loads(f.read(), path)
+
+    rotation = settings.rotation + 90 if settings.rotated else settings.rotation
+    gerber_obj.transform(get_transform_matrix(settings.mirrored, rotation), settings.x_offset, settings.y_offset)
+
+    return gerber_obj
+
+@pytest.fixture
+def settings() -> Settings:
+    # no height map unless a test gives one, the CLI default is None too
+    return Settings({'height_map': None})
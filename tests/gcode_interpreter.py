@@ -0,0 +1,90 @@
+'''
+A small G-code interpreter written independently of gcode_tools, to check that two G-code files make the machine do the same thing
+
+actions(gcode) -> the list of what the machine does: moves with their full target and the modal state they run in,
+non modal commands (dwells, homing, probing...) and system commands
+'''
+import re
+
+WORD_REGEX = re.compile(r'([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+))')
+COMMENT_REGEX = re.compile(r'\([^)]*\)|;.*')
+
+# (letter, value) -> modal group
+MODAL_GROUPS = {}
+for group, values in {'motion': (0, 1, 2, 3, 38.2, 38.3, 38.4, 38.5, 80), 'plane': (17, 18, 19), 'units': (20, 21),
+                      'distance': (90, 91), 'feed_mode': (93, 94)}.items():
+    for value in values:
+        MODAL_GROUPS[('G', value)] = group
+for value in (3, 4, 5):
+    MODAL_GROUPS[('M', value)] = 'spindle'
+
+MOVE_CONTEXT = ('motion', 'plane', 'units', 'distance', 'feed_mode', 'spindle', 'S')
+
+def actions(gcode: str, distance: float = None) -> list[tuple]:
+    '''
+    :param gcode: the G-code file content
+    :param distance: distance mode (90 or 91) the machine is in before the file, None for unknown
+    :return: ('move', modal context, (x, y, z) target, other words) / ('cmd', (letter, value), other words, axis words) / 
+        ('spindle', M value, S) when the spindle starts, stops or changes direction / ('sys', line)
+        unknown coordinates are None (machine position before any absolute move, after homing or probing)
+    '''
+    state = {'motion': None, 'plane': None, 'units': None, 'distance': distance, 'feed_mode': None, 'spindle': None, 'F': None, 'S': None}
+    position = {'X': None, 'Y': None, 'Z': None}
+    machine_actions = []
+
+    for line in gcode.split('\n'):
+        line = COMMENT_REGEX.sub('', line).strip()
+        if not line:
+            continue
+        if line.startswith('$'):
+            machine_actions.append(('sys', line))
+            continue
+
+        axes, others, non_modal = {}, {}, []
+        spindle = state['spindle']
+        for letter, value in WORD_REGEX.findall(line):
+            letter, value = letter.upper(), float(value)
+            if letter in 'GM':
+                if (letter, value) in MODAL_GROUPS:
+                    state[MODAL_GROUPS[(letter, value)]] = value
+                else:
+                    non_modal.append((letter, value))
+            elif letter in 'XYZ':
+                axes[letter] = value
+            elif letter in 'FS':
+                state[letter] = value
+            else:
+                others[letter] = value
+
+        if state['spindle'] != spindle:
+            machine_actions.append(('spindle', state['spindle'], state['S']))
+
+        for command in non_modal:
+            machine_actions.append(('cmd', command, tuple(sorted(others.items())), tuple(sorted(axes.items()))))
+
+        # the axis words of non modal G commands (G28, G92...) aren't a move, the position is lost after them
+        if any(letter == 'G' and value != 4 for letter, value in non_modal):
+            position = {'X': None, 'Y': None, 'Z': None}
+            continue
+
+        if not axes and not (state['motion'] in (2, 3) and ('I' in others or 'J' in others)):
+            continue
+
+        target = {}
+        for axis in 'XYZ':
+            if axis not in axes:
+                target[axis] = position[axis]
+            elif state['distance'] == 90:
+                target[axis] = axes[axis]
+            else:
+                target[axis] = None if position[axis] is None else position[axis] + axes[axis]
+
+        # a straight move to where the machine already is does nothing
+        if state['motion'] in (0, 1) and target == position:
+            continue
+
+        context = tuple(state[key] for key in MOVE_CONTEXT) + (state['F'] if state['motion'] != 0 else None,)
+        machine_actions.append(('move', context, tuple(target.values()), tuple(sorted(others.items()))))
+        position = target
+
+    return machine_actions
@@ -0,0 +1,76 @@
+'''
+GcodeCompressor must not change what the machine does: the compressed G-code is run through an independent
+interpreter (gcode_interpreter.py) and must give the same actions as the raw G-code, whatever distance mode
+the machine starts in
+'''
+import os
+import random
+
+import pytest
+
+from gcode_interpreter import actions
+from conftest import load_gerber
+from gcode_tools import (GcodeCompressor, general_machine_init, general_machine_deinit, generate_holes_gcode,
+                         generate_spindle_engraving_trace_gcode, generate_laser_raster_gcode,
+                         generate_laser_hatch_gcode)
+
+STRESS_GCODE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compressor_stress.gcode')
+
+def compress(gcode: str, max_piece_length: int = 0, seed: int = 0) -> str:
+    '''
+    :param max_piece_length: if given, the gcode is given to the compressor in random pieces up to this length
+    '''
+    compressor = GcodeCompressor()
+    if not max_piece_length:
+        return compressor.compress(gcode) + compressor.flush()
+
+    pieces = []
+    random_generator = random.Random(seed)
+    ind = 0
+    while ind < len(gcode):
+        piece_length = random_generator.randint(1, max_piece_length)
+        pieces.append(compressor.compress(gcode[ind:ind+piece_length]))
+        ind += piece_length
+
+    return ''.join(pieces) + compressor.flush()
+
+def assert_same_actions(gcode: str, compressed_gcode: str) -> None:
+    for distance in (90, 91):
+        assert actions(compressed_gcode, distance) == actions(gcode, distance), f"different actions starting in G{distance}"
+
+def test_stress_file():
+    '''
+    repeated modes, axes and feedrates, arcs, G91 and G93 sections, probing, homing, unit changes and system commands
+    '''
+    with open(STRESS_GCODE_PATH) as f:
+        gcode = f.read()
+
+    compressed_gcode = compress(gcode)
+    assert_same_actions(gcode, compressed_gcode)
+    assert len(compressed_gcode) < len(gcode)
+
+@pytest.mark.parametrize('seed', range(50))
+def test_stress_file_in_pieces(seed):
+    '''
+    the G-code arrives in pieces cut anywhere, like from the GcodeWriter
+    '''
+    with open(STRESS_GCODE_PATH) as f:
+        gcode = f.read()
+
+    assert compress(gcode, max_piece_length=12, seed=seed) == compress(gcode)
+
+@pytest.mark.parametrize('generator, operation_settings', [
+    (generate_spindle_engraving_trace_gcode, {'spindle': True}),
+    (generate_spindle_engraving_trace_gcode, {'spindle': True, 'add_spindle_trace_ccw_path': True}),
+    (generate_holes_gcode, {'holes': True}),
+    (generate_laser_raster_gcode, {'laser': True, 'laser_raster': True}),
+    (generate_laser_hatch_gcode, {'laser': True, 'laser_hatch': True}),
+    ], ids=['spindle', 'spindle_ccw', 'holes', 'raster', 'hatch'])
+def test_generated_gcode(settings, generator, operation_settings):
+    settings.settings_dict.update(operation_settings)
+    gerber_obj = load_gerber(settings)
+    gcode = general_machine_init() + ''.join(generator(gerber_obj, settings)) + general_machine_deinit()
+
+    compressed_gcode = compress(gcode)
+    assert_same_actions(gcode, compressed_gcode)
+    assert len(compressed_gcode) < len(gcode)
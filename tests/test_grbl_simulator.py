@@ -0,0 +1,77 @@
+'''
+Streaming and probing against the simulated GRBL controller (grbl_simulator.py), no machine attached
+'''
+import os
+
+import pytest
+
+from conftest import load_gerber
+from grbl_simulator import SimulatedGrbl, open_pty, warped_surface
+from gcode_tools import (GCODE_COMMENT_REGEX, GrblStreamer, GenerateHeightMap, general_machine_init, general_machine_deinit, generate_holes_gcode,
+                         generate_spindle_engraving_trace_gcode, generate_laser_raster_gcode)
+
+def get_sent_lines(gcode: str) -> list[str]:
+    '''
+    the lines GrblStreamer sends: without comments, spaces and empty lines
+    '''
+    return [line for line in (GCODE_COMMENT_REGEX.sub('', line).replace(' ', '').strip() for line in gcode.split('\n')) if line]
+
+@pytest.mark.parametrize('generator, operation_settings', [
+    (generate_spindle_engraving_trace_gcode, {'spindle': True}),
+    (generate_holes_gcode, {'holes': True}),
+    (generate_laser_raster_gcode, {'laser': True, 'laser_raster': True}),
+    ], ids=['spindle', 'holes', 'raster'])
+def test_stream(settings, generator, operation_settings):
+    settings.settings_dict.update(operation_settings)
+    gcode = general_machine_init() + ''.join(generator(load_gerber(settings), settings)) + general_machine_deinit()
+
+    with SimulatedGrbl(time_scale=0, line_latency=0.0001) as ser:
+        streamer = GrblStreamer(ser, verbose=False)
+        assert 'Grbl' in streamer.wait_for_greeting()
+        report = streamer.stream(gcode.split('\n'))
+
+        assert report.errors == []
+        assert report.lines == len(get_sent_lines(gcode)) == ser.lines_received
+        assert ser.rx_overflows == 0  # never more than the RX buffer size in flight
+        assert report.lines_per_second > 0
+
+def test_stream_stops_on_error():
+    gcode = ['G21G90', 'G0X1Y1', 'G1X2F100', 'G1X3Q5', 'G1X4', 'G1X5']
+
+    with SimulatedGrbl(time_scale=0, line_latency=0.001) as ser:
+        streamer = GrblStreamer(ser, verbose=False)
+        streamer.wait_for_greeting()
+        report = streamer.stream(gcode)
+
+        assert report.errors == [(4, 'G1X3Q5', 'error:20')]
+
+def test_stream_alarm():
+    # the probe touches nothing
+    gcode = ['G21G90', 'G0Z5', 'G38.2G91Z-2F100', 'G0X1']
+
+    with SimulatedGrbl(time_scale=0) as ser:
+        streamer = GrblStreamer(ser, verbose=False)
+        streamer.wait_for_greeting()
+        with pytest.raises(ValueError, match='ALARM'):
+            streamer.stream(gcode)
+
+def test_create_height_map(settings, monkeypatch):
+    pytest.importorskip('serial')
+    if not hasattr(os, 'openpty'):
+        pytest.skip("needs a pseudo terminal")
+
+    simulator = SimulatedGrbl(g54_offset=(10, 20, -30), g92_offset=(0, 0, 1.5), time_scale=0, line_latency=0)
+    try:
+        settings.settings_dict.update({'serial_port': open_pty(simulator), 'height_map_resolution': 10})
+        monkeypatch.setattr('builtins.input', lambda prompt: 'y')
+
+        height_map_generator = GenerateHeightMap(load_gerber(settings), settings)
+
+    finally:
+        simulator.close()
+
+    height_map = height_map_generator.height_map
+    assert [coord[:2] for coord in height_map] == [coord[:2] for coord in height_map_generator.generate_height_map_datastructure()]
+    for x, y, z in height_map:
+        # GRBL reports 3 decimals
+        assert z == pytest.approx(warped_surface(x, y), abs=0.0005)
@@ -0,0 +1,65 @@
+'''
+MachiningTimeEstimator against hand-computed trapezoids, and the per-operation metrics of a GcodeWriter run
+'''
+import json
+import os
+
+import pytest
+
+from conftest import load_gerber
+from gcode_tools import (PLANNER_WINDOW, GcodeWriter, MachiningTimeEstimator, general_machine_init, general_machine_deinit,
+                         generate_holes_gcode)
+
+def estimate(gcode: str) -> dict:
+    # the rates are high enough to never limit the F600 moves
+    estimator = MachiningTimeEstimator((1000, 1000, 1000), (10, 10, 10), 0.01)
+    estimator.set_operation('cut')
+    estimator.estimate(gcode)
+    return estimator.finish()['cut']
+
+def test_straight_line():
+    # 10 mm/sec reached in 1 sec over 5 mm, 90 mm cruising in 9 sec then 1 sec to stop: 11 sec
+    metrics = estimate("G1X100F600\n")
+    assert metrics['time'] == pytest.approx(11.0)
+    assert metrics['cut_length'] == pytest.approx(100)
+    assert metrics['lines'] == 1
+
+@pytest.mark.parametrize('block_count', [100, 3 * PLANNER_WINDOW])
+def test_split_line(block_count):
+    '''
+    the same line in collinear blocks doesn't slow down at the junctions, even over several planner windows
+    '''
+    gcode = 'F600\n' + ''.join(f"G1X{100 * (ind + 1) / block_count:.6f}\n" for ind in range(block_count))
+    metrics = estimate(gcode)
+    assert metrics['time'] == pytest.approx(11.0)
+    assert metrics['cut_length'] == pytest.approx(100)
+
+def test_dwell_stops_the_motion():
+    # two separate 11 sec lines and the 2 sec dwell between them
+    metrics = estimate("G1X100F600\nG4P2\nG1X200\n")
+    assert metrics['time'] == pytest.approx(24.0)
+
+def test_writer_operations(settings, tmp_path):
+    settings.settings_dict.update({'holes': True})
+    file_name = str(tmp_path / 'holes.gcode')
+    estimator = MachiningTimeEstimator((settings.rapid_feedrate, settings.rapid_feedrate, settings.z_max_rate),
+                                       (settings.xy_acceleration, settings.xy_acceleration, settings.z_acceleration),
+                                       settings.junction_deviation)
+
+    with GcodeWriter(file_name, estimator=estimator) as writer:
+        writer.write(general_machine_init())
+        writer.write(generate_holes_gcode(load_gerber(settings), settings), operation='holes')
+        writer.write(general_machine_deinit(), operation='deinit')
+
+    operations = estimator.finish()
+    assert operations['holes']['plunges'] > 0
+    # the return move home is not setup time
+    assert operations['deinit']['rapid_length'] > 0
+    assert operations.get('setup', {}).get('rapid_length', 0) == 0
+
+    with open(file_name + '.json') as f:
+        assert json.load(f)['operations'] == operations
+    with open(file_name) as f:
+        assert f.readline().startswith('; Machining time estimate')
+    # no temporary file left behind
+    assert sorted(os.listdir(tmp_path)) == ['holes.gcode', 'holes.gcode.json']